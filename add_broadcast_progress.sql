@@ -0,0 +1,11 @@
+-- Migration: Live broadcast progress and dry-run projections
+-- Requires add_broadcast_runs.sql and add_broadcast_shards.sql.
+-- Workers publish progress/ETA to broadcast_runs.progress while sending.
+-- Dry runs (POST /api/tgms/send with "dry_run": true) are stored as runs with
+-- status 'dry_run' and the projection in broadcast_runs.results.
+-- Run this in Supabase SQL Editor
+
+ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS progress JSONB;
+
+COMMENT ON COLUMN broadcast_runs.progress IS 'Live progress written by the sending worker: sent, failed, remaining, observed_rate, eta_seconds.';
+COMMENT ON COLUMN broadcast_runs.status IS 'running, completed, or dry_run (projection only, nothing sent).';
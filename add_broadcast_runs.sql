@@ -0,0 +1,49 @@
+-- Migration: Resumable TGMS broadcasts with per-target delivery state
+-- A broadcast job creates one broadcast_runs row and one broadcast_targets row per
+-- group. Workers claim pending targets in chunks (FOR UPDATE SKIP LOCKED), so a
+-- restarted or additional worker continues exactly where the previous one stopped.
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS broadcast_runs (
+    run_id BIGSERIAL PRIMARY KEY,
+    job_id BIGINT UNIQUE REFERENCES jobs(job_id) ON DELETE SET NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'running', -- running, completed
+    total_targets INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+COMMENT ON TABLE broadcast_runs IS 'One row per broadcast; the job that created it is jobs.job_id.';
+
+CREATE TABLE IF NOT EXISTS broadcast_targets (
+    run_id BIGINT NOT NULL REFERENCES broadcast_runs(run_id) ON DELETE CASCADE,
+    group_id BIGINT NOT NULL,
+    state VARCHAR(10) NOT NULL DEFAULT 'pending'
+        CHECK (state IN ('pending', 'sending', 'sent', 'failed')),
+    debug_code VARCHAR(50) NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by VARCHAR(100),
+    claimed_at TIMESTAMPTZ,
+    telegram_message_id BIGINT,
+    error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, group_id)
+);
+
+COMMENT ON TABLE broadcast_targets IS 'Delivery state of one broadcast to one managed group.';
+COMMENT ON COLUMN broadcast_targets.state IS 'pending -> sending (claimed by a worker) -> sent | failed. Stale sending claims are reclaimed.';
+COMMENT ON COLUMN broadcast_targets.debug_code IS 'Fixed per target so a re-send after a crash is traceable in sent_messages.';
+
+-- Claim lookups only touch unfinished targets
+CREATE INDEX IF NOT EXISTS idx_broadcast_targets_open
+    ON broadcast_targets(run_id, group_id)
+    WHERE state IN ('pending', 'sending');
+
+-- Progress of recent broadcasts:
+-- SELECT r.run_id, r.status, t.state, COUNT(*)
+-- FROM broadcast_runs r JOIN broadcast_targets t USING (run_id)
+-- GROUP BY r.run_id, r.status, t.state ORDER BY r.run_id DESC;
@@ -0,0 +1,26 @@
+-- Migration: Sharded broadcasts and a shared Telegram rate budget
+-- Requires add_broadcast_runs.sql.
+-- A broadcast run's targets are split into shards (group_id hash or fixed-size chunks);
+-- each shard is drained by its own tgms_broadcast_shard job, so every running TGMS
+-- worker can take part. rate_limit_buckets holds one token bucket per bot that all
+-- workers draw from, keeping the combined send rate under Telegram's limit.
+-- Run this in Supabase SQL Editor
+
+ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS shard_count INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS results JSONB;
+
+COMMENT ON COLUMN broadcast_runs.results IS 'Aggregated summary written once by the worker that completes the run.';
+
+ALTER TABLE broadcast_targets ADD COLUMN IF NOT EXISTS shard INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_targets_open_shard
+    ON broadcast_targets(run_id, shard, group_id)
+    WHERE state IN ('pending', 'sending');
+
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    name VARCHAR(100) PRIMARY KEY,          -- e.g. 'telegram:<bot id>'
+    tokens DOUBLE PRECISION NOT NULL,       -- may go negative while a 429 flood wait is in force
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+
+COMMENT ON TABLE rate_limit_buckets IS 'Token buckets shared by all TGMS workers (TGMS_RATE_LIMITER=postgres).';
@@ -0,0 +1,30 @@
+-- Migration: resumable main-bot broadcasts (broadcast_message jobs)
+-- One row per (job, group) records each group's outcome, so a retried or
+-- deferred job only sends to groups still pending (see worker/fanout.py).
+-- jobs.result holds live progress and the final summary.
+-- Run this in Supabase SQL Editor
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS result JSONB;
+COMMENT ON COLUMN jobs.result IS 'Progress/summary written by the handler (e.g. broadcast_message counts).';
+
+CREATE TABLE IF NOT EXISTS chat_broadcast_targets (
+    job_id BIGINT NOT NULL REFERENCES jobs(job_id) ON DELETE CASCADE,
+    chat_id TEXT NOT NULL,                -- chat_groups.chat_id
+    state VARCHAR(10) NOT NULL DEFAULT 'pending',  -- pending, sent, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    telegram_message_id BIGINT,
+    error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (job_id, chat_id)
+);
+
+COMMENT ON TABLE chat_broadcast_targets IS 'Per-group delivery state of main-bot broadcast_message jobs.';
+
+-- Resume lookups only touch unfinished targets
+CREATE INDEX IF NOT EXISTS idx_chat_broadcast_targets_pending
+    ON chat_broadcast_targets(job_id, chat_id)
+    WHERE state = 'pending';
+
+-- Progress of a broadcast job:
+-- SELECT status, result FROM jobs WHERE job_id = <job_id>;
+-- SELECT state, COUNT(*) FROM chat_broadcast_targets WHERE job_id = <job_id> GROUP BY state;
@@ -0,0 +1,25 @@
+-- Migration: single-leader live checker
+-- Several checker processes (e.g. Railway plus a local PC) may run for redundancy, but
+-- only the lease holder writes insta_links / live_sessions. Each cycle the leader takes
+-- a transaction-level advisory lock, renews its lease here and bumps the fencing number
+-- in the same transaction as its writes; a standby claims the lease once it expires.
+-- A leader that lost the lease (paused, partitioned) cannot renew it, so its late
+-- writes roll back (worker/checker_lease.py).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS checker_leases (
+    name TEXT PRIMARY KEY,                  -- e.g. instagram_live_checker
+    holder TEXT NOT NULL,                   -- <IG_CHECKER_NAME>:<pid>
+    fence BIGINT NOT NULL DEFAULT 0,        -- +1 per leader cycle, never reset
+    acquired_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    renewed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+COMMENT ON TABLE checker_leases IS 'Leader lease and fencing number per checker role.';
+
+-- The fencing number of the cycle that wrote each heartbeat
+ALTER TABLE live_checker_heartbeat ADD COLUMN IF NOT EXISTS fence BIGINT;
+
+-- Check:
+-- SELECT name, holder, fence, expires_at - NOW() AS remaining FROM checker_leases;
@@ -0,0 +1,43 @@
+-- Migration: broadcast audience health fields
+-- Brings managed_groups in line with chat_groups' health columns and adds a
+-- computed health_score, so the TGMS audience is resolved in one indexed query
+-- (see BROADCAST_AUDIENCE_FILTER in tgms_worker/database.py).
+-- Scores are refreshed in bulk by the tgms_recompute_group_health job.
+-- Run this in Supabase SQL Editor
+
+ALTER TABLE managed_groups
+    ADD COLUMN IF NOT EXISTS is_disabled BOOLEAN NOT NULL DEFAULT false,
+    ADD COLUMN IF NOT EXISTS disabled_until TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS is_text_only BOOLEAN NOT NULL DEFAULT false,
+    ADD COLUMN IF NOT EXISTS photo_error_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS health_score REAL NOT NULL DEFAULT 0.5,
+    ADD COLUMN IF NOT EXISTS health_updated_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN managed_groups.is_disabled IS 'Temporarily excluded from broadcasts; eligible again once disabled_until has passed.';
+COMMENT ON COLUMN managed_groups.is_text_only IS 'Photos are refused here; broadcasts fall back to text (set after repeated photo errors).';
+COMMENT ON COLUMN managed_groups.photo_error_count IS 'sendPhoto permission errors so far.';
+COMMENT ON COLUMN managed_groups.health_score IS '0-1 delivery score: smoothed 30-day delivery ratio, reduced by the failure streak. Targets below TGMS_MIN_HEALTH_SCORE are skipped.';
+
+-- Older rows may have NULLs from before the NOT NULL defaults
+UPDATE managed_groups SET final_message_allowed = true WHERE final_message_allowed IS NULL;
+UPDATE managed_groups SET consecutive_failures = 0 WHERE consecutive_failures IS NULL;
+
+-- Audience resolution: healthiest first, only rows that can be broadcast to
+CREATE INDEX IF NOT EXISTS idx_managed_groups_audience
+    ON managed_groups(health_score DESC, group_id)
+    WHERE is_active AND final_message_allowed;
+
+-- Per-target snapshot of the audience decision
+ALTER TABLE broadcast_targets
+    ADD COLUMN IF NOT EXISTS text_only BOOLEAN NOT NULL DEFAULT false,
+    ADD COLUMN IF NOT EXISTS health_score REAL NOT NULL DEFAULT 0.5;
+
+-- Claims take the healthiest open targets first
+DROP INDEX IF EXISTS idx_broadcast_targets_open;
+CREATE INDEX IF NOT EXISTS idx_broadcast_targets_open
+    ON broadcast_targets(run_id, health_score DESC, group_id)
+    WHERE state IN ('pending', 'sending');
+
+-- Audience health overview:
+-- SELECT is_text_only, is_disabled, width_bucket(health_score, 0, 1, 5) AS bucket, COUNT(*)
+-- FROM managed_groups WHERE is_active GROUP BY 1, 2, 3 ORDER BY 1, 2, 3;
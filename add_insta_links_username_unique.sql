@@ -0,0 +1,40 @@
+-- Migration: one insta_links row per username
+-- The live checkers apply each cycle as a single upsert (INSERT ... ON CONFLICT (username)),
+-- which needs a unique index on username. Existing duplicates are merged into the oldest
+-- row first: live state, last live time and live count are combined, the rest of the
+-- oldest row (links, monetization, sent flags) is kept.
+-- Run this in Supabase SQL Editor
+
+BEGIN;
+
+WITH merged AS (
+    SELECT username,
+           MIN(id) AS keep_id,
+           BOOL_OR(is_live) AS is_live,
+           MAX(last_live_at) AS last_live_at,
+           SUM(COALESCE(total_lives, 0)) AS total_lives,
+           MAX(last_updated) AS last_updated
+    FROM insta_links
+    WHERE username IS NOT NULL
+    GROUP BY username
+    HAVING COUNT(*) > 1
+)
+UPDATE insta_links l
+SET is_live = m.is_live,
+    last_live_at = m.last_live_at,
+    total_lives = m.total_lives,
+    last_updated = m.last_updated
+FROM merged m
+WHERE l.id = m.keep_id;
+
+DELETE FROM insta_links l
+USING insta_links keep
+WHERE keep.username = l.username
+  AND keep.id < l.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_insta_links_username ON insta_links (username);
+
+COMMIT;
+
+-- Verify:
+-- SELECT username, COUNT(*) FROM insta_links GROUP BY username HAVING COUNT(*) > 1;  -- no rows
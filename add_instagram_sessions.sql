@@ -0,0 +1,24 @@
+-- Migration: shared Instagram session store
+-- instagrapi session settings (cookies, device ids, tokens) per Instagram account,
+-- Fernet-encrypted with IG_SESSION_KEY before they leave the process. Every checker
+-- loads the session from here at startup instead of logging in from scratch, and saves
+-- it back after successful calls (at most every IG_SESSION_SAVE_SECONDS, only when it
+-- changed). A fresh login is claimed through refreshing_by/refresh_until so only one
+-- process logs an account in at a time; the others wait for its session
+-- (worker/session_store.py).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS instagram_sessions (
+    username TEXT PRIMARY KEY,              -- Instagram account
+    settings BYTEA,                         -- Fernet token of the instagrapi settings JSON
+    version BIGINT NOT NULL DEFAULT 0,      -- +1 per save
+    updated_at TIMESTAMPTZ,
+    updated_by TEXT,                        -- <IG_CHECKER_NAME>:<pid>
+    refreshing_by TEXT,                     -- process currently logging the account in
+    refresh_until TIMESTAMPTZ               -- its claim lapses after this
+);
+
+COMMENT ON TABLE instagram_sessions IS 'Encrypted instagrapi sessions shared by all checker processes.';
+
+-- Check (no secrets):
+-- SELECT username, version, updated_at, updated_by, refreshing_by, refresh_until FROM instagram_sessions;
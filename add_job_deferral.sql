@@ -0,0 +1,19 @@
+-- Migration: Job deferral for circuit breakers
+-- Jobs that hit an open circuit (Telegram/Instagram down) are pushed back with
+-- run_after instead of consuming one of their 3 retries.
+-- Run this in Supabase SQL Editor
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_after TIMESTAMPTZ;
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS deferrals INTEGER NOT NULL DEFAULT 0;
+
+COMMENT ON COLUMN jobs.run_after IS 'Job is invisible to workers until this time (NULL = runnable now).';
+COMMENT ON COLUMN jobs.deferrals IS 'Times the job was deferred by an open circuit breaker (drives the backoff).';
+
+-- Workers poll pending jobs per bot in created_at order; run_after is carried in the
+-- index so the run_after filter is checked without visiting the heap
+CREATE INDEX IF NOT EXISTS idx_jobs_pending_bot_run_after
+    ON jobs(bot_token, created_at) INCLUDE (run_after)
+    WHERE status = 'pending';
+
+-- Circuit breaker states are written to bot_health as rows named
+-- 'telegram:<bot id>' and 'instagram:<username>' (healthy / degraded / down).
@@ -0,0 +1,35 @@
+-- Migration: live checker heartbeat
+-- The live checkers now write only transitions (went live / ended) to insta_links, so a
+-- user who stays live keeps the last_updated of the moment they went live. Freshness is
+-- tracked per checker instead: every cycle upserts one row here.
+-- expire_stale_live_statuses() (auto_expire_live_status.sql) is redefined to expire live
+-- rows only when no checker has reported for 5 minutes.
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS live_checker_heartbeat (
+    checker TEXT PRIMARY KEY,               -- IG_CHECKER_NAME, default hostname
+    checked_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    live_count INTEGER NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE live_checker_heartbeat IS 'Last completed live check per Instagram checker process.';
+
+-- Each cycle turns off the live rows missing from the checker's live set
+CREATE INDEX IF NOT EXISTS idx_insta_links_live ON insta_links(username) WHERE is_live = TRUE;
+
+CREATE OR REPLACE FUNCTION expire_stale_live_statuses()
+RETURNS void AS $$
+BEGIN
+  UPDATE insta_links
+  SET is_live = FALSE
+  WHERE is_live = TRUE
+    AND last_updated < NOW() - INTERVAL '5 minutes'
+    AND NOT EXISTS (
+      SELECT 1 FROM live_checker_heartbeat
+      WHERE checked_at >= NOW() - INTERVAL '5 minutes'
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Check:
+-- SELECT checker, checked_at, NOW() - checked_at AS age, live_count FROM live_checker_heartbeat;
@@ -0,0 +1,40 @@
+-- Migration: live broadcast history
+-- One append-only row per Instagram broadcast (keyed by broadcast_id), opened when the
+-- checker first sees it and closed when it is gone. Each check appends the viewer count
+-- to a compact sample series: parallel integer arrays of seconds since start and viewers.
+-- Written by the live checkers once per cycle (worker/live_sessions.py).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS live_sessions (
+    broadcast_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    title TEXT,
+    started_at TIMESTAMPTZ NOT NULL,        -- first seen live
+    last_seen_at TIMESTAMPTZ NOT NULL,
+    ended_at TIMESTAMPTZ,                   -- NULL while live; last_seen_at once gone
+    viewer_count INTEGER NOT NULL DEFAULT 0,    -- latest sample
+    peak_viewers INTEGER NOT NULL DEFAULT 0,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    sample_offsets INTEGER[] NOT NULL DEFAULT '{}',  -- seconds since started_at
+    viewer_samples INTEGER[] NOT NULL DEFAULT '{}'
+);
+
+-- Currently live, sorted by viewers
+CREATE INDEX IF NOT EXISTS idx_live_sessions_open
+    ON live_sessions (viewer_count DESC)
+    WHERE ended_at IS NULL;
+
+-- Top broadcasts by peak viewers
+CREATE INDEX IF NOT EXISTS idx_live_sessions_peak
+    ON live_sessions (peak_viewers DESC, started_at DESC);
+
+-- History for a user
+CREATE INDEX IF NOT EXISTS idx_live_sessions_user
+    ON live_sessions (username, started_at DESC);
+
+COMMENT ON TABLE live_sessions IS 'One row per Instagram live broadcast with viewer-count samples.';
+
+-- Examples:
+-- SELECT username, title, viewer_count FROM live_sessions WHERE ended_at IS NULL ORDER BY viewer_count DESC;
+-- SELECT username, started_at, ended_at - started_at AS duration, peak_viewers
+--   FROM live_sessions WHERE username = 'someone' ORDER BY started_at DESC LIMIT 20;
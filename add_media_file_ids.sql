@@ -0,0 +1,22 @@
+-- Migration: Telegram file_id cache for broadcast media
+-- Extends the image_cache idea (image path -> hosted URL) one step further:
+-- hosted URL -> file_id returned by Telegram, so a broadcast photo is fetched
+-- from our host once and every later sendPhoto references the stored file.
+-- file_ids are only valid for the bot that received them, hence bot_id in the key.
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS media_file_ids (
+    bot_id VARCHAR(20) NOT NULL,            -- numeric prefix of the bot token
+    source_url TEXT NOT NULL,
+    media_type VARCHAR(20) NOT NULL DEFAULT 'photo',
+    file_id TEXT NOT NULL,
+    file_unique_id TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_used_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (bot_id, source_url)
+);
+
+COMMENT ON TABLE media_file_ids IS 'Telegram file_id per (bot, media URL); rows are deleted when Telegram rejects the file_id.';
+
+-- Optional cleanup (run periodically):
+-- DELETE FROM media_file_ids WHERE last_used_at < NOW() - INTERVAL '90 days';
@@ -0,0 +1,19 @@
+-- Migration: Rendered-message fingerprints for skipping no-op editMessageText calls
+-- Optional: only needed when MESSAGE_FINGERPRINT_DB=true (shares fingerprints across worker replicas)
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS message_fingerprints (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    fingerprint VARCHAR(40) NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (chat_id, message_id)
+);
+
+COMMENT ON TABLE message_fingerprints IS 'SHA1 of the last rendered text+markup per bot message, used to skip identical edits.';
+
+-- Old menus are never edited again; keep the table small
+CREATE INDEX IF NOT EXISTS idx_message_fingerprints_updated_at ON message_fingerprints(updated_at);
+
+-- Optional cleanup (run periodically):
+-- DELETE FROM message_fingerprints WHERE updated_at < NOW() - INTERVAL '7 days';
@@ -0,0 +1,36 @@
+-- Migration: adaptive send rate (AIMD) controller metrics
+-- Both workers write one row per bot every TELEGRAM_METRICS_INTERVAL seconds
+-- summarising the rate controller's decisions (see tgms_worker/rate_controller.py).
+-- Read by /api/admin/dashboard/metrics (send_rate_last_hour).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS send_rate_stats (
+    id BIGSERIAL PRIMARY KEY,
+    source VARCHAR(20) NOT NULL,          -- worker, tgms
+    bot_id VARCHAR(20) NOT NULL,          -- numeric part of the bot token (never the secret)
+    window_start TIMESTAMPTZ NOT NULL,
+    window_end TIMESTAMPTZ NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 0,   -- responses fed to the controller
+    rate_avg REAL,                        -- msgs/sec, averaged over responses
+    rate_min REAL,
+    rate_max REAL,
+    rate_last REAL,
+    max_rate REAL,                        -- configured ceiling (TGMS_RATE_MAX / TELEGRAM_RATE_MAX)
+    ceiling_share REAL,                   -- share of responses seen while running at the ceiling
+    increases INTEGER NOT NULL DEFAULT 0,
+    backoffs_429 INTEGER NOT NULL DEFAULT 0,
+    backoffs_latency INTEGER NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE send_rate_stats IS 'Periodic per-bot summaries of the adaptive Telegram send rate controller.';
+
+CREATE INDEX IF NOT EXISTS idx_send_rate_stats_window_end ON send_rate_stats(window_end);
+
+-- Example: how close to the ceiling each bot ran today
+-- SELECT bot_id, window_end, rate_avg, max_rate, ceiling_share, backoffs_429
+-- FROM send_rate_stats
+-- WHERE window_end >= NOW() - INTERVAL '1 day'
+-- ORDER BY bot_id, window_end;
+
+-- Optional cleanup (run periodically):
+-- DELETE FROM send_rate_stats WHERE window_end < NOW() - INTERVAL '30 days';
@@ -0,0 +1,40 @@
+-- Migration: Telegram Bot API call instrumentation
+-- Both workers write one summary row per (bot, method) every TELEGRAM_METRICS_INTERVAL seconds.
+-- Read by /api/admin/dashboard/metrics (telegram_calls_last_hour).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS telegram_call_stats (
+    id BIGSERIAL PRIMARY KEY,
+    source VARCHAR(20) NOT NULL,          -- worker, tgms
+    bot_id VARCHAR(20) NOT NULL,          -- numeric part of the bot token (never the secret)
+    method VARCHAR(50) NOT NULL,
+    window_start TIMESTAMPTZ NOT NULL,
+    window_end TIMESTAMPTZ NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    bytes_sent BIGINT NOT NULL DEFAULT 0,
+    latency_avg_ms REAL,
+    latency_p50_ms REAL,
+    latency_p95_ms REAL,
+    latency_p99_ms REAL,
+    latency_max_ms REAL,
+    latency_buckets JSONB,                -- {"25": n, "50": n, ..., "inf": n} (ms upper bounds)
+    status_codes JSONB,                   -- {"200": n, "429": n, "network_error": n}
+    error_codes JSONB,                    -- Bot API error_code counts
+    retry_counts JSONB                    -- {"0": n, "1": n, "2": n} retries per call
+);
+
+COMMENT ON TABLE telegram_call_stats IS 'Periodic per-method Telegram Bot API latency/status summaries from the workers.';
+
+CREATE INDEX IF NOT EXISTS idx_telegram_call_stats_window_end ON telegram_call_stats(window_end);
+CREATE INDEX IF NOT EXISTS idx_telegram_call_stats_method ON telegram_call_stats(method, window_end);
+
+-- Example: editMessageText latency over the last day
+-- SELECT window_end, calls, latency_p50_ms, latency_p99_ms
+-- FROM telegram_call_stats
+-- WHERE method = 'editMessageText' AND window_end >= NOW() - INTERVAL '1 day'
+-- ORDER BY window_end;
+
+-- Optional cleanup (run periodically):
+-- DELETE FROM telegram_call_stats WHERE window_end < NOW() - INTERVAL '30 days';
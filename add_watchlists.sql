@@ -0,0 +1,34 @@
+-- Migration: go-live notifications for user watchlists
+-- watchlists maps Telegram users to the Instagram usernames they follow (/watch, /unwatch).
+-- live_notifications is the per-broadcast outbox: one row per (broadcast_id, watcher),
+-- filled in bulk from watchlists when a notify_live job starts, so a broadcast notifies
+-- each watcher at most once however often it is enqueued (worker/live_notifications.py).
+-- Run this in Supabase SQL Editor
+
+CREATE TABLE IF NOT EXISTS watchlists (
+    user_id BIGINT NOT NULL,
+    username TEXT NOT NULL,                 -- Instagram username, lowercase, no @
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, username)
+);
+
+-- Subscriber lookup at go-live
+CREATE INDEX IF NOT EXISTS idx_watchlists_username ON watchlists (username);
+
+CREATE TABLE IF NOT EXISTS live_notifications (
+    broadcast_id TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    username TEXT NOT NULL,
+    state VARCHAR(10) NOT NULL DEFAULT 'pending',   -- pending, sent, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ,
+    PRIMARY KEY (broadcast_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_live_notifications_pending
+    ON live_notifications (broadcast_id, user_id) WHERE state = 'pending';
+
+COMMENT ON TABLE watchlists IS 'Instagram usernames each Telegram user is notified about when they go live';
+COMMENT ON TABLE live_notifications IS 'Go-live notification outbox, deduplicated per broadcast and watcher';
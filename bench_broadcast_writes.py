@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Benchmark: broadcast bookkeeping writes, per-group vs. buffered.
+
+Simulates the DB side of a TGMS broadcast to N groups (no Telegram calls):
+  per-group  - log_sent_message + reset_failure_count, or increment_failure_count
+               (+ deactivate_group), one statement and commit each
+  buffered   - DatabaseManager.write_buffer(): multi-row INSERT / UPDATE ... FROM (VALUES ...)
+               flushed every N rows, including broadcast_targets states
+
+Runs in a throwaway schema (via search_path) so it never touches real tables.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql://... python bench_broadcast_writes.py --groups 10000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'tgms_worker'))
+from database import DatabaseManager  # noqa: E402
+
+SCHEMA_DDL = """
+CREATE TABLE managed_groups (
+    group_id BIGINT PRIMARY KEY,
+    title TEXT,
+    is_active BOOLEAN NOT NULL DEFAULT true,
+    final_message_allowed BOOLEAN NOT NULL DEFAULT true,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE sent_messages (
+    message_id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    telegram_message_id BIGINT,
+    debug_code VARCHAR(50) UNIQUE,
+    sent_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE broadcast_targets (
+    run_id BIGINT NOT NULL,
+    group_id BIGINT NOT NULL,
+    state VARCHAR(10) NOT NULL DEFAULT 'sending',
+    debug_code VARCHAR(50) NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    claimed_by VARCHAR(100),
+    claimed_at TIMESTAMPTZ,
+    telegram_message_id BIGINT,
+    error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (run_id, group_id)
+);
+"""
+
+
+def simulate_outcomes(groups: int, failure_rate: float, seed: int):
+    """(group_id, message_id or None, debug_code, error or None) per group"""
+    rng = random.Random(seed)
+    outcomes = []
+    for i in range(groups):
+        group_id = -1000000000000 - i
+        debug_code = f"DBG:{i:06X}"
+        if rng.random() < failure_rate:
+            outcomes.append((group_id, None, debug_code, "Forbidden: bot was kicked from the group chat"))
+        else:
+            outcomes.append((group_id, rng.randint(1, 10 ** 6), debug_code, None))
+    return outcomes
+
+
+def reset(conn, groups: int, run_id: int):
+    conn.execute(text("TRUNCATE managed_groups, sent_messages, broadcast_targets"))
+    conn.execute(text("""
+        INSERT INTO managed_groups (group_id, title, consecutive_failures)
+        SELECT -1000000000000 - i, 'Group ' || i, (i % 3)
+        FROM generate_series(0, :n - 1) AS i
+    """), {"n": groups})
+    conn.execute(text("""
+        INSERT INTO broadcast_targets (run_id, group_id, debug_code)
+        SELECT :run_id, group_id, 'DBG:' || group_id FROM managed_groups
+    """), {"run_id": run_id})
+    conn.commit()
+
+
+def run_per_group(db: DatabaseManager, outcomes):
+    statements = 0
+    for group_id, message_id, debug_code, error in outcomes:
+        if error is None:
+            db.log_sent_message(group_id, message_id, debug_code)
+            db.reset_failure_count(group_id)
+            statements += 2
+        else:
+            failures = db.increment_failure_count(group_id)
+            statements += 1
+            if failures >= 3:
+                db.deactivate_group(group_id, error)
+                statements += 1
+    return statements
+
+
+def run_buffered(db: DatabaseManager, outcomes, batch: int, run_id: int):
+    flushes = 0
+    buffer = db.write_buffer(run_id=run_id, max_rows=batch, max_delay_ms=1000)
+    for group_id, message_id, debug_code, error in outcomes:
+        if error is None:
+            buffer.log_sent_message(group_id, message_id, debug_code)
+        else:
+            buffer.record_failure(group_id, error)
+        if buffer.due():
+            buffer.flush()
+            flushes += 1
+    if len(buffer):
+        buffer.flush()
+        flushes += 1
+    return flushes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=10000)
+    parser.add_argument('--failure-rate', type=float, default=0.02)
+    parser.add_argument('--batch', type=int, default=200, help='rows per buffered flush')
+    parser.add_argument('--schema', default='bench_broadcast_writes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the bench schema afterwards')
+    args = parser.parse_args()
+
+    database_url = os.environ.get('BENCH_DATABASE_URL') or os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit("Set BENCH_DATABASE_URL (or DATABASE_URL)")
+
+    admin = create_engine(database_url)
+    with admin.connect() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {args.schema}"))
+        conn.execute(text(f"SET search_path TO {args.schema}"))
+        conn.execute(text(SCHEMA_DDL))
+        conn.commit()
+
+    bench_url = make_url(database_url).update_query_dict({"options": f"-csearch_path={args.schema}"})
+    db = DatabaseManager(bench_url.render_as_string(hide_password=False))
+    outcomes = simulate_outcomes(args.groups, args.failure_rate, args.seed)
+    failures = sum(1 for o in outcomes if o[3] is not None)
+    print(f"{args.groups} groups, {failures} failures, batch {args.batch}")
+
+    try:
+        run_id = 1
+        with db.get_connection() as conn:
+            reset(conn, args.groups, run_id)
+        started = time.perf_counter()
+        statements = run_per_group(db, outcomes)
+        per_group = time.perf_counter() - started
+        print(f"per-group : {per_group:8.2f}s  {args.groups / per_group:9.0f} groups/s  "
+              f"{statements} statements/commits")
+
+        with db.get_connection() as conn:
+            reset(conn, args.groups, run_id)
+        started = time.perf_counter()
+        flushes = run_buffered(db, outcomes, args.batch, run_id)
+        buffered = time.perf_counter() - started
+        print(f"buffered  : {buffered:8.2f}s  {args.groups / buffered:9.0f} groups/s  "
+              f"{flushes} transactions")
+        print(f"speedup   : {per_group / buffered:8.1f}x")
+
+        with db.get_connection() as conn:
+            counts = conn.execute(text("""
+                SELECT (SELECT COUNT(*) FROM sent_messages) AS sent,
+                       (SELECT COUNT(*) FROM managed_groups WHERE NOT is_active) AS deactivated,
+                       (SELECT COUNT(*) FROM broadcast_targets WHERE state = 'sending') AS unrecorded
+            """)).fetchone()
+            print(f"check     : {counts.sent} sent_messages, {counts.deactivated} deactivated, "
+                  f"{counts.unrecorded} targets left unrecorded")
+    finally:
+        db.close()
+        if not args.keep:
+            with admin.connect() as conn:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+                conn.commit()
+
+
+if __name__ == '__main__':
+    main()
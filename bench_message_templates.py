@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-group message rendering for N broadcast targets.
+
+Renders one broadcast to N synthetic groups (no Telegram or DB calls):
+  baseline     - identical text + debug code by f-string concatenation (no personalization)
+  per-target   - parse + validate the template for every target, then format it
+  precompiled  - compile_template() once, MessageTemplate.render() per target
+
+Group titles are drawn with Markdown specials in them, so the escaping cost is
+included in both personalized modes.
+
+Usage:
+    python bench_message_templates.py --targets 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'tgms_worker'))
+from message_template import TEXT_LIMIT, compile_template  # noqa: E402
+from broadcast_engine import generate_debug_code  # noqa: E402
+
+DEFAULT_TEMPLATE = (
+    "🔴 *Live now!* Hey {title} 👋\n"
+    "Join the stream with the other {member_count:,} members: [watch here](https://instagram.com/)"
+)
+TITLE_WORDS = ["Insta", "Live", "Fans", "club_", "*VIP*", "Lovers", "[EN]", "Official", "Chat", "`Stars`"]
+
+
+def make_targets(count: int, seed: int):
+    rng = random.Random(seed)
+    return [
+        {
+            "group_id": -1000000000000 - i,
+            "title": " ".join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 5))),
+            "member_count": rng.randint(3, 200000),
+            "debug_code": generate_debug_code(),
+        }
+        for i in range(count)
+    ]
+
+
+def run_baseline(source: str, targets):
+    for group in targets:
+        f"{source}\n\n{group['debug_code']}"
+
+
+def run_per_target(source: str, targets):
+    for group in targets:
+        compile_template(source, "Markdown", TEXT_LIMIT).render(group)
+
+
+def run_precompiled(source: str, targets):
+    template = compile_template(source, "Markdown", TEXT_LIMIT)
+    for group in targets:
+        template.render(group)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=int, default=100000)
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    targets = make_targets(args.targets, args.seed)
+    sample = compile_template(args.template).render(targets[0])
+    print(f"{args.targets} targets, template {len(args.template)} chars; first render:\n{sample}\n")
+
+    timings = {}
+    for name, run in (("baseline", run_baseline), ("per-target", run_per_target),
+                      ("precompiled", run_precompiled)):
+        started = time.perf_counter()
+        run(args.template, targets)
+        timings[name] = time.perf_counter() - started
+        print(f"{name:<12}: {timings[name]:8.3f}s  {timings[name] / args.targets * 1e6:7.2f} µs/target  "
+              f"{args.targets / timings[name]:10.0f} targets/s")
+    print(f"speedup     : {timings['per-target'] / timings['precompiled']:8.1f}x precompiled vs per-target")
+
+
+if __name__ == '__main__':
+    main()
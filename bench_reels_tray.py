@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Benchmark: bytes and parse time per live check for each detection path.
+
+Replays recorded (or synthetic) Instagram response bodies, no network:
+  timeline+tray  - the old check: full timeline feed parse, then the tray (no lives in the feed)
+  tray parsed    - feed/reels_tray/ through instagrapi's private_request: full JSON parse
+  tray lean      - feed/reels_tray/ raw body, only the broadcasts array parsed (reels_tray.py)
+Bytes are the response bodies as received (decompressed) and gzipped (about what
+goes over the wire).
+
+Fixtures are raw bodies named reels_tray*.json and timeline_feed*.json. Record
+them with a logged-in account (IG_USERNAME/IG_PASSWORD, or the session file):
+    python bench_reels_tray.py --record fixtures/
+Usage:
+    python bench_reels_tray.py --fixtures fixtures/
+    python bench_reels_tray.py --synthetic --tray-size 150 --lives 3
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'worker'))
+from reels_tray import REELS_TRAY_ENDPOINT, TrayFormatError, extract_broadcasts  # noqa: E402
+
+
+def synthetic_user(rng, pk):
+    return {
+        "pk": pk, "pk_id": str(pk), "username": f"user_{pk}", "full_name": f"User {pk}",
+        "is_private": rng.random() < 0.3, "is_verified": rng.random() < 0.05,
+        "profile_pic_url": f"https://scontent.cdninstagram.com/v/t51.2885-19/{pk}_n.jpg?stp=dst-jpg_s150x150&_nc_ht=scontent&oh=00_{pk:x}&oe=66",
+        "profile_pic_id": f"{pk}_{pk * 7}", "friendship_status": {"following": True, "is_bestie": False,
+                                                                  "is_restricted": False, "muting": False},
+    }
+
+
+def synthetic_tray(rng, size, lives):
+    """A reels_tray body: `size` story reels and `lives` active broadcasts."""
+    tray = []
+    for i in range(size):
+        pk = 10_000_000 + i
+        tray.append({
+            "id": pk, "strong_id__": str(pk), "latest_reel_media": 1760000000 + i, "expiring_at": 1760086400 + i,
+            "seen": 0, "can_reply": True, "can_reshare": True, "reel_type": "user_reel",
+            "ranked_position": i + 1, "seen_ranked_position": i + 1, "muted": False, "media_count": rng.randint(1, 8),
+            "media_ids": [str(rng.getrandbits(60)) for _ in range(rng.randint(1, 8))],
+            "has_besties_media": False, "has_video": rng.random() < 0.5,
+            "user": synthetic_user(rng, pk),
+        })
+    broadcasts = [{
+        "id": str(17_000_000_000_000_000 + i), "broadcast_status": "active", "viewer_count": rng.randint(5, 5000),
+        "title": f"Live {i}", "published_time": 1760000000, "dash_playback_url": f"https://live.cdn/{i}.mpd",
+        "cover_frame_url": f"https://live.cdn/{i}.jpg", "broadcast_owner": synthetic_user(rng, 20_000_000 + i),
+    } for i in range(lives)]
+    return json.dumps({"tray": tray, "broadcasts": broadcasts, "story_ranking_token": "x" * 36,
+                       "sticker_version": 123, "face_filter_nux_version": 4, "status": "ok"}).encode()
+
+
+def synthetic_timeline(rng, items):
+    """A timeline feed body with `items` media posts (carousel captions, comments, candidates)."""
+    feed = []
+    for i in range(items):
+        pk = 30_000_000 + i
+        feed.append({"media_or_ad": {
+            "pk": pk, "id": f"{pk}_{pk}", "taken_at": 1760000000 - i * 600, "media_type": 1,
+            "code": f"C{pk:x}", "user": synthetic_user(rng, pk), "like_count": rng.randint(0, 100000),
+            "comment_count": rng.randint(0, 500),
+            "caption": {"pk": str(pk), "text": " ".join(rng.choice(["great", "day", "#live", "✨", "summer", "vibes"])
+                                                         for _ in range(rng.randint(5, 60)))},
+            "image_versions2": {"candidates": [{"width": w, "height": w, "url": f"https://scontent/{pk}_{w}.jpg?oh=00_{pk:x}"}
+                                               for w in (1080, 750, 640, 480, 320, 240, 150)]},
+            "preview_comments": [{"pk": str(pk + c), "text": "nice " * rng.randint(1, 10), "user": synthetic_user(rng, pk + c)}
+                                 for c in range(rng.randint(0, 3))],
+        }})
+    return json.dumps({"num_results": items, "feed_items": feed, "more_available": True,
+                       "next_max_id": "QVFE" * 20, "status": "ok"}).encode()
+
+
+def load_fixtures(directory):
+    def read(pattern):
+        bodies = []
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            with open(path, 'rb') as f:
+                bodies.append(f.read())
+        return bodies
+    return read('reels_tray*.json'), read('timeline_feed*.json')
+
+
+async def record(directory, count, pause):
+    from instagram_service import InstagramService
+    os.makedirs(directory, exist_ok=True)
+    service = InstagramService()
+    if not await service.login():
+        sys.exit("Instagram login failed")
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    for i in range(count):
+        for name, call in (('reels_tray', lambda: service.client.private_request(REELS_TRAY_ENDPOINT)),
+                           ('timeline_feed', service.client.get_timeline_feed)):
+            await service._run(call)
+            path = os.path.join(directory, f"{name}_{stamp}_{i}.json")
+            with open(path, 'wb') as f:
+                f.write(service.client.last_response.content)
+            print(f"recorded {path} ({len(service.client.last_response.content):,} bytes)")
+        if i + 1 < count:
+            await asyncio.sleep(pause)
+
+
+def timed(func, bodies, repeat):
+    """Mean seconds per body over `repeat` passes."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for body in bodies:
+            func(body)
+        samples.append((time.perf_counter() - started) / len(bodies))
+    return statistics.fmean(samples)
+
+
+def parse_timeline(body):
+    return json.loads(body).get('broadcast')
+
+
+def parse_tray(body):
+    return json.loads(body).get('broadcasts') or []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', help='directory of recorded reels_tray*/timeline_feed* bodies')
+    parser.add_argument('--record', metavar='DIR', help='record fixtures with a logged-in account, then exit')
+    parser.add_argument('--count', type=int, default=3, help='responses to record per endpoint')
+    parser.add_argument('--pause', type=float, default=60, help='seconds between recordings')
+    parser.add_argument('--synthetic', action='store_true', help='use generated bodies')
+    parser.add_argument('--tray-size', type=int, default=150, help='synthetic story reels in the tray')
+    parser.add_argument('--lives', type=int, default=3, help='synthetic active broadcasts')
+    parser.add_argument('--feed-items', type=int, default=12, help='synthetic timeline posts')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.record:
+        asyncio.run(record(args.record, args.count, args.pause))
+        return
+    if args.fixtures:
+        trays, timelines = load_fixtures(args.fixtures)
+    elif args.synthetic:
+        rng = random.Random(args.seed)
+        trays = [synthetic_tray(rng, args.tray_size, args.lives) for _ in range(5)]
+        timelines = [synthetic_timeline(rng, args.feed_items) for _ in range(5)]
+    else:
+        parser.error("pass --fixtures DIR, --synthetic or --record DIR")
+    if not trays or not timelines:
+        sys.exit("Need at least one reels_tray and one timeline_feed body")
+
+    for body in trays:
+        try:
+            lean = extract_broadcasts(body)
+        except TrayFormatError as e:
+            sys.exit(f"A reels_tray body cannot be used: {e}")
+        if lean != parse_tray(body):
+            sys.exit("extract_broadcasts disagrees with the full parse")
+
+    def mean_size(bodies, compress=False):
+        return statistics.fmean(len(gzip.compress(b, 6)) if compress else len(b) for b in bodies)
+
+    tray_bytes, tray_gz = mean_size(trays), mean_size(trays, True)
+    feed_bytes, feed_gz = mean_size(timelines), mean_size(timelines, True)
+    tray_full = timed(parse_tray, trays, args.repeat)
+    tray_lean = timed(extract_broadcasts, trays, args.repeat)
+    feed_full = timed(parse_timeline, timelines, args.repeat)
+
+    print(f"{len(trays)} tray / {len(timelines)} timeline bodies, {args.repeat} passes, "
+          f"{statistics.fmean(len(extract_broadcasts(b)) for b in trays):.1f} broadcasts per tray")
+    print(f"{'path':<15}{'requests':>9}{'body KB':>10}{'gzip KB':>10}{'parse ms':>10}")
+    rows = (
+        ('timeline+tray', 2, feed_bytes + tray_bytes, feed_gz + tray_gz, feed_full + tray_full),
+        ('tray parsed', 1, tray_bytes, tray_gz, tray_full),
+        ('tray lean', 1, tray_bytes, tray_gz, tray_lean),
+    )
+    for name, requests, body, gz, seconds in rows:
+        print(f"{name:<15}{requests:>9}{body / 1024:>10.1f}{gz / 1024:>10.1f}{seconds * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ Environment Variables Required:
     - DATABASE_URL: PostgreSQL connection string (from Railway)
     - IG_USERNAME: Instagram username
     - IG_PASSWORD: Instagram password
+      (or IG_ACCOUNTS: JSON list of accounts to poll with, see worker/instagram_pool.py)
     - IG_CHECK_INTERVAL: Check interval (optional, default 150)
 """
 
@@ -23,9 +24,8 @@ import sys
 import asyncio
 import logging
 import random
-from datetime import datetime, timezone
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Load environment
@@ -45,7 +45,11 @@ logger = logging.getLogger(__name__)
 
 # Import Instagram service
 sys.path.insert(0, 'worker')
-from instagram_service import InstagramService, ensure_instagram_login
+from instagram_pool import get_account_pool
+from circuit_breaker import CircuitOpenError, write_breaker_health
+from live_state import LiveStateTracker
+from checker_lease import CheckerLease, lease_ttl
+from live_notifications import notify_job_enqueuer
 
 # Configuration
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -85,15 +89,26 @@ async def check_and_update_lives():
     
     consecutive_errors = 0
     max_consecutive_errors = 5
+    pool = await get_account_pool(SessionFactory)
+    # Only the lease holder writes; with a second checker running this one may stand by.
+    # The lease is sized from the pool's cycle (checker_lease.lease_ttl)
+    tracker = LiveStateTracker(lease=CheckerLease(ttl=lease_ttl(pool.cycle_seconds)))
+    # Go-lives queue notify_live jobs for the worker to message watchers
+    tracker.subscribe(notify_job_enqueuer(SessionFactory))
     
     while True:
         try:
-            # Get Instagram service (with session)
-            ig_service = await ensure_instagram_login()
-            
-            # Check for lives
+            if not tracker.lease.held:
+                # Standby: wait for the leader's lease to expire (or for our first claim)
+                await tracker.lease.wait_until_available(SessionFactory)
+            # Sleeps until the next account is due (staggered), polls it and merges
+            # the latest results of every account
             logger.info("🔍 Checking story tray for live broadcasts...")
-            live_users = await ig_service.get_live_users()
+            live_users = await pool.poll_next()
+            if live_users is None:
+                # No account has a recent result; leave live statuses to the auto-expire job
+                logger.warning(f"⚠️ No Instagram account available: {pool.health()}")
+                continue
             
             # Reset error counter on success
             consecutive_errors = 0
@@ -101,68 +116,35 @@ async def check_and_update_lives():
             # Update database
             session = SessionFactory()
             try:
-                # Mark all as offline first
-                session.execute(text("""
-                    UPDATE insta_links
-                    SET is_live = FALSE,
-                        last_updated = :now
-                    WHERE is_live = TRUE
-                """), {'now': datetime.now(timezone.utc)})
-                
-                # Mark live users
-                for user in live_users:
-                    username = user['username'].lstrip('@')
-                    
-                    # Check if exists
-                    exists = session.execute(
-                        text("SELECT id FROM insta_links WHERE username = :username"),
-                        {'username': username}
-                    ).fetchone()
-                    
-                    if exists:
-                        # Update existing
-                        session.execute(text("""
-                            UPDATE insta_links
-                            SET is_live = TRUE,
-                                last_live_at = :now,
-                                total_lives = COALESCE(total_lives, 0) + CASE WHEN is_live = FALSE THEN 1 ELSE 0 END,
-                                last_updated = :now
-                            WHERE username = :username
-                        """), {
-                            'username': username,
-                            'now': datetime.now(timezone.utc)
-                        })
-                        logger.info(f"✅ @{username} is LIVE (Viewers: {user['viewer_count']})")
-                    else:
-                        # Insert new
-                        session.execute(text("""
-                            INSERT INTO insta_links (username, is_live, last_live_at, total_lives, last_updated, link)
-                            VALUES (:username, TRUE, :now, 1, :now, :link)
-                        """), {
-                            'username': username,
-                            'now': datetime.now(timezone.utc),
-                            'link': f'https://instagram.com/{username}'
-                        })
-                        logger.info(f"✅ NEW USER @{username} is LIVE (Viewers: {user['viewer_count']})")
-                
-                session.commit()
-                logger.info(f"📊 Live status updated: {len(live_users)} user(s) live")
+                if pool.schedule.stale():
+                    # Re-learn when people go live (live_sessions) to place the poll budget
+                    pool.schedule.refresh(session)
+                # Transitions only (went live / ended), plus the heartbeat
+                changes = tracker.apply(session, live_users)
+                if changes is None:
+                    logger.info("⏸️ Another checker holds the lease; results discarded, standing by")
+                    continue
+                logger.info(
+                    f"📊 Live status updated: {len(live_users)} user(s) live, "
+                    f"{len(changes['went_live'])} went live, {len(changes['ended'])} ended"
+                )
                 
             except Exception as e:
                 logger.error(f"❌ Database update error: {e}")
                 session.rollback()
             finally:
+                write_breaker_health(session)
                 session.close()
-            
-            # Wait before next check (random interval for stealth)
-            next_check = get_random_interval()
-            logger.info(f"⏰ Next check in {next_check}s ({next_check/60:.1f} min)")
             logger.info("-"*60)
-            await asyncio.sleep(next_check)
             
         except KeyboardInterrupt:
             logger.info("\n🛑 Stopping Instagram checker...")
             break
+        except CircuitOpenError as e:
+            # Instagram keeps failing; don't hammer it (or count it as a new error)
+            wait = max(get_random_interval(), int(e.retry_after))
+            logger.warning(f"⚠️ {e}. Next check in {wait}s")
+            await asyncio.sleep(wait)
         except Exception as e:
             consecutive_errors += 1
             logger.error(f"❌ Error in main loop ({consecutive_errors}/{max_consecutive_errors}): {e}")
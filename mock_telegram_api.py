@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Mock Telegram Bot API Server
+============================
+
+A self-contained stand-in for api.telegram.org, used for benchmarks, load
+tests and offline runs of the workers. No real tokens or network access needed.
+
+Implements the methods used by worker/telegram_helper.py and
+tgms_worker/telegram_api.py (sendMessage, editMessageText, sendPhoto,
+answerCallbackQuery, approveChatJoinRequest, getChatMember,
+getChatMemberCount, getMe, banChatMember, ...) and records every call.
+
+Usage:
+    python mock_telegram_api.py --port 8081 --latency uniform:0.05:0.25 \
+        --rate-limit-rate 0.01 --retry-after 3 --error-rate 0.02 --flood-limit 30
+
+    # Then point the clients at it:
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python tgms_worker/main.py
+
+From Python (e.g. in a benchmark):
+    with MockTelegramServer(latency="lognormal:0.12:0.5") as mock:
+        api = TelegramAPI("123:abc", api_url=mock.base_url)
+        api.send_message(-100123, "hello")
+        assert mock.calls_for("sendMessage")[0]["params"]["text"] == "hello"
+
+Inspection endpoints (handy when the server runs in another process):
+    GET  /_mock/calls   -> recorded calls as JSON
+    GET  /_mock/stats   -> per-method call counts
+    POST /_mock/reset   -> clear recorded calls
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def parse_latency(spec):
+    """
+    Build a latency sampler (returning seconds) from a spec string.
+
+    Supported specs:
+        fixed:0.1              always 100 ms
+        uniform:0.05:0.3       uniform between 50 and 300 ms
+        normal:0.15:0.05       gaussian with mean/stddev (clamped at 0)
+        lognormal:0.12:0.5     lognormal with median 120 ms and sigma 0.5 (long tail)
+    """
+    if callable(spec):
+        return spec
+    if spec is None or spec in ('', 'none', '0'):
+        return lambda: 0.0
+
+    kind, _, rest = str(spec).partition(':')
+    args = [float(x) for x in rest.split(':') if x]
+
+    if kind == 'fixed':
+        return lambda: args[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(args[0], args[1]))
+    if kind == 'lognormal':
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+class MockTelegramServer:
+    """Threaded mock Bot API server with latency, 429 and error injection."""
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        latency=None,
+        rate_limit_rate: float = 0.0,
+        retry_after: int = 1,
+        error_rate: float = 0.0,
+        flood_limit: float = 0.0,
+        method_latency: dict = None,
+        chat_member_status: str = 'administrator',
+        member_count: int = 100,
+    ):
+        """
+        Args:
+            host/port: Bind address (port 0 picks a free port)
+            latency: Latency spec applied to every method (see parse_latency)
+            rate_limit_rate: Probability (0-1) of answering 429 Too Many Requests
+            retry_after: retry_after value sent with injected 429s
+            error_rate: Probability (0-1) of answering 500 Internal Server Error
+            flood_limit: Like Telegram's flood control, answer 429 once a bot makes
+                more than this many calls within one second (0 disables)
+            method_latency: Optional per-method latency specs overriding `latency`
+            chat_member_status: Status returned by getChatMember
+            member_count: Value returned by getChatMemberCount
+        """
+        self.latency = parse_latency(latency)
+        self.method_latency = {m: parse_latency(s) for m, s in (method_latency or {}).items()}
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.flood_limit = flood_limit
+        self._recent = {}  # token -> deque of recent call times (flood_limit)
+        self.chat_member_status = chat_member_status
+        self.member_count = member_count
+
+        self.calls = []
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._messages = {}  # (chat_id, message_id) -> (text, reply_markup)
+
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    # --- Lifecycle ---
+
+    @property
+    def base_url(self) -> str:
+        """Base URL to hand to the clients (without the /bot<token> part)."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Mock Telegram API listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # --- Recorded calls ---
+
+    def calls_for(self, method: str):
+        """Return recorded calls for a single Bot API method."""
+        with self._lock:
+            return [c for c in self.calls if c['method'] == method]
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self._messages.clear()
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for call in self.calls:
+                key = call['method']
+                counts.setdefault(key, {'calls': 0, 'status': {}})
+                counts[key]['calls'] += 1
+                status = str(call['status'])
+                counts[key]['status'][status] = counts[key]['status'].get(status, 0) + 1
+            return counts
+
+    # --- Bot API methods ---
+
+    def _message(self, params, **extra):
+        chat_id = params.get('chat_id')
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': _as_int(chat_id), 'type': 'supergroup' if str(chat_id).startswith('-') else 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'MockBot', 'username': 'mock_bot'},
+        }
+        message.update(extra)
+        return message
+
+    def _send_message(self, params):
+        message = self._message(params, text=params.get('text', ''))
+        with self._lock:
+            self._messages[(str(params.get('chat_id')), message['message_id'])] = (
+                params.get('text'), _normalize_markup(params.get('reply_markup'))
+            )
+        return 200, {'ok': True, 'result': message}
+
+    def _edit_message_text(self, params):
+        key = (str(params.get('chat_id')), _as_int(params.get('message_id')))
+        new_state = (params.get('text'), _normalize_markup(params.get('reply_markup')))
+        with self._lock:
+            if self._messages.get(key) == new_state:
+                return 400, {
+                    'ok': False,
+                    'error_code': 400,
+                    'description': 'Bad Request: message is not modified: specified new message content '
+                                   'and reply markup are exactly the same as a current content and reply '
+                                   'markup of the message',
+                }
+            self._messages[key] = new_state
+        message = self._message(params, text=params.get('text', ''))
+        message['message_id'] = key[1]
+        return 200, {'ok': True, 'result': message}
+
+    def _send_photo(self, params):
+        photo = params.get('photo', '')
+        if isinstance(photo, str) and photo.startswith('MOCKFILE_'):
+            file_id = photo
+        else:
+            file_id = f"MOCKFILE_{next(self._file_ids)}"
+        sizes = [
+            {'file_id': f"{file_id}", 'file_unique_id': f"u{file_id}", 'width': w, 'height': w, 'file_size': w * 40}
+            for w in (90, 320, 800)
+        ]
+        message = self._message(params, photo=sizes)
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        return 200, {'ok': True, 'result': message}
+
+    def _get_chat_member(self, params):
+        user_id = _as_int(params.get('user_id'))
+        return 200, {'ok': True, 'result': {
+            'status': self.chat_member_status,
+            'user': {'id': user_id, 'is_bot': user_id == 1, 'first_name': 'Mock'},
+        }}
+
+    def _get_me(self, params):
+        return 200, {'ok': True, 'result': {
+            'id': 1, 'is_bot': True, 'first_name': 'MockBot', 'username': 'mock_bot',
+        }}
+
+    def _ok_true(self, params):
+        return 200, {'ok': True, 'result': True}
+
+    def _member_count(self, params):
+        return 200, {'ok': True, 'result': self.member_count}
+
+    def dispatch(self, token: str, method: str, params: dict):
+        """Apply fault injection, run the method and record the call."""
+        started = time.perf_counter()
+        sampler = self.method_latency.get(method, self.latency)
+        delay = sampler()
+        if delay > 0:
+            time.sleep(delay)
+
+        handlers = {
+            'sendMessage': self._send_message,
+            'editMessageText': self._edit_message_text,
+            'sendPhoto': self._send_photo,
+            'answerCallbackQuery': self._ok_true,
+            'approveChatJoinRequest': self._ok_true,
+            'declineChatJoinRequest': self._ok_true,
+            'banChatMember': self._ok_true,
+            'deleteMessage': self._ok_true,
+            'sendChatAction': self._ok_true,
+            'getChatMember': self._get_chat_member,
+            'getChatMemberCount': self._member_count,
+            'getChatMembersCount': self._member_count,
+            'getMe': self._get_me,
+        }
+
+        roll = random.random()
+        if method not in handlers:
+            status, body = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        elif roll < self.rate_limit_rate or self._flooded(token):
+            status, body = 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        elif roll < self.rate_limit_rate + self.error_rate:
+            status, body = 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+        else:
+            status, body = handlers[method](params)
+
+        with self._lock:
+            self.calls.append({
+                'method': method,
+                'token': token,
+                'params': params,
+                'status': status,
+                'latency': time.perf_counter() - started,
+                'at': time.time(),
+            })
+        return status, body
+
+    def _flooded(self, token) -> bool:
+        """True if this call takes the bot over flood_limit calls in the last second"""
+        if not self.flood_limit:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            recent = self._recent.setdefault(token, deque())
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            if len(recent) >= self.flood_limit:
+                return True
+            recent.append(now)
+            return False
+
+    # --- HTTP plumbing ---
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                logger.debug(fmt % args)
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    raw = self.rfile.read(length)
+                    content_type = self.headers.get('Content-Type', '')
+                    if 'application/json' in content_type:
+                        params.update(json.loads(raw or b'{}'))
+                    elif 'application/x-www-form-urlencoded' in content_type:
+                        params.update(parse_qsl(raw.decode('utf-8')))
+                return url.path, params
+
+            def _handle(self):
+                path, params = self._params()
+
+                if path == '/_mock/calls':
+                    with server._lock:
+                        return self._reply(200, {'ok': True, 'result': list(server.calls)})
+                if path == '/_mock/stats':
+                    return self._reply(200, {'ok': True, 'result': server.stats()})
+                if path == '/_mock/reset':
+                    server.reset()
+                    return self._reply(200, {'ok': True, 'result': True})
+
+                # Expected shape: /bot<token>/<method>
+                parts = path.strip('/').split('/')
+                if len(parts) != 2 or not parts[0].startswith('bot'):
+                    return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+                status, body = server.dispatch(parts[0][3:], parts[1], params)
+                self._reply(status, body)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _normalize_markup(markup):
+    """reply_markup may arrive as a dict (JSON body) or a JSON string (form body)."""
+    if isinstance(markup, str):
+        try:
+            markup = json.loads(markup)
+        except ValueError:
+            return markup
+    return json.dumps(markup, sort_keys=True) if markup is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Telegram Bot API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', default='lognormal:0.12:0.5',
+                        help="fixed:S | uniform:A:B | normal:MEAN:STD | lognormal:MEDIAN:SIGMA | none")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help="Probability of answering 429 with retry_after")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Probability of answering 500")
+    parser.add_argument('--flood-limit', type=float, default=0.0,
+                        help="Answer 429 above this many calls/sec per bot (0 = off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    mock = MockTelegramServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        error_rate=args.error_rate,
+        flood_limit=args.flood_limit,
+    )
+    mock.start()
+    logger.info(f"Set TELEGRAM_API_URL={mock.base_url} to point the workers here. Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logger.info("Stopping mock Telegram API")
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Offline simulator: live detection latency for a daily poll budget.
+
+Learns the hourly go-live/end rates from the training part of a live history
+exactly as the checker does (worker/poll_schedule.py), then replays the test
+part against:
+  uniform   - polls every 86400/budget seconds on average, same jitter and bounds
+  adaptive  - the history-driven schedule for the same budget
+and reports how long go-lives and ends took to be seen, and how many broadcasts
+ended before any poll saw them.
+
+History comes from live_sessions (DATABASE_URL / --database-url), or from a
+synthetic evening-heavy history with --synthetic.
+
+Usage:
+    python simulate_poll_schedule.py --synthetic --budget 480
+    DATABASE_URL=postgresql://... python simulate_poll_schedule.py --train-days 21 --test-days 7
+"""
+import os
+import sys
+import math
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'worker'))
+from poll_schedule import (  # noqa: E402
+    AdaptiveSchedule, JITTER, MAX_INTERVAL, MIN_INTERVAL, POLL_BUDGET, expected_rates,
+)
+
+# Relative go-live rate by UTC hour for --synthetic (quiet nights, busy evenings)
+SYNTHETIC_PROFILE = [0.2, 0.1, 0.05, 0.05, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7,
+                     0.8, 0.8, 0.9, 1.0, 1.2, 1.5, 2.0, 2.6, 3.0, 2.8, 1.8, 0.8]
+
+
+def synthetic_sessions(start, days, per_day, seed):
+    """(started_at, ended_at) pairs: Poisson go-lives shaped by SYNTHETIC_PROFILE, ~20 min lognormal lives"""
+    rng = random.Random(seed)
+    scale = per_day / sum(SYNTHETIC_PROFILE)
+    sessions = []
+    for hour in range(days * 24):
+        at = start + timedelta(hours=hour)
+        rate = SYNTHETIC_PROFILE[at.hour] * scale * (1.3 if at.isoweekday() >= 6 else 1.0)
+        t = 0.0
+        while True:
+            t += rng.expovariate(rate / 3600.0)
+            if t >= 3600:
+                break
+            began = at + timedelta(seconds=t)
+            sessions.append((began, began + timedelta(seconds=rng.lognormvariate(math.log(900), 0.8))))
+    return sessions
+
+
+def load_sessions(database_url, since):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT started_at, COALESCE(ended_at, last_seen_at) AS ended_at
+            FROM live_sessions WHERE started_at >= :since ORDER BY started_at
+        """), {'since': since}).fetchall()
+    return [(row.started_at, row.ended_at) for row in rows]
+
+
+def count_transitions(sessions, start, end):
+    counts = {}
+    for began, ended in sessions:
+        for at in (began, ended):
+            if start <= at < end:
+                key = (at.isoweekday(), at.hour)
+                counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def poll_times(start, end, accounts, next_interval, seed):
+    """Merged poll timestamps of `accounts` staggered accounts, each paced by next_interval(now)"""
+    random.seed(seed)
+    polls = []
+    for i in range(accounts):
+        at = start + timedelta(seconds=i * (MIN_INTERVAL + MAX_INTERVAL) / 2 / accounts)
+        while at < end:
+            polls.append(at)
+            at += timedelta(seconds=next_interval(at))
+    return sorted(polls)
+
+
+def replay(sessions, polls):
+    """Latencies (s) from go-live/end to the first poll after it; go-lives never polled while live are missed"""
+    import bisect
+    stamps = [p.timestamp() for p in polls]
+    live_latency, end_latency, missed = [], [], 0
+    for began, ended in sessions:
+        i = bisect.bisect_left(stamps, began.timestamp())
+        if i == len(stamps):
+            continue
+        if stamps[i] > ended.timestamp():
+            missed += 1
+            continue
+        live_latency.append(stamps[i] - began.timestamp())
+        j = bisect.bisect_left(stamps, ended.timestamp())
+        if j < len(stamps):
+            end_latency.append(stamps[j] - ended.timestamp())
+    return live_latency, end_latency, missed
+
+
+def summarize(name, latencies, end_latencies, missed, polls, days):
+    def pct(values, q):
+        return sorted(values)[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+    print(f"{name:<9}: {len(polls) / days:7.0f} polls/day  go-live latency mean {statistics.fmean(latencies):6.1f}s "
+          f"p50 {pct(latencies, 0.5):6.1f}s p90 {pct(latencies, 0.9):6.1f}s  "
+          f"end latency mean {statistics.fmean(end_latencies):6.1f}s  missed {missed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=int, default=POLL_BUDGET, help='polls per account per day')
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--train-days', type=int, default=21)
+    parser.add_argument('--test-days', type=int, default=7)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--synthetic', action='store_true', help='use a synthetic history instead of live_sessions')
+    parser.add_argument('--lives-per-day', type=int, default=300, help='synthetic go-lives per day')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        start = datetime(2026, 1, 5, tzinfo=timezone.utc)
+        sessions = synthetic_sessions(start, args.train_days + args.test_days, args.lives_per_day, args.seed)
+    elif args.database_url:
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        start = now - timedelta(days=args.train_days + args.test_days)
+        sessions = load_sessions(args.database_url, start)
+    else:
+        parser.error("pass --synthetic or set DATABASE_URL")
+    split = start + timedelta(days=args.train_days)
+    end = split + timedelta(days=args.test_days)
+    train = [s for s in sessions if s[0] < split]
+    test = [s for s in sessions if split <= s[0] < end]
+    print(f"{len(train)} training broadcasts ({args.train_days}d), {len(test)} replayed ({args.test_days}d), "
+          f"budget {args.budget} polls/account/day, {args.accounts} account(s), bounds {MIN_INTERVAL}-{MAX_INTERVAL}s")
+    if not train or not test:
+        print("Not enough history to simulate")
+        return
+
+    flat = min(MAX_INTERVAL, max(MIN_INTERVAL, 86400 / args.budget))
+
+    def uniform(now):
+        return min(MAX_INTERVAL, max(MIN_INTERVAL, flat * random.uniform(1 - JITTER, 1 + JITTER)))
+
+    schedule = AdaptiveSchedule(budget=args.budget)
+    schedule.set_rates(expected_rates(count_transitions(train, start, split), days=args.train_days))
+
+    for name, next_interval in (("uniform", uniform), ("adaptive", schedule.next_interval)):
+        polls = poll_times(split, end, args.accounts, next_interval, args.seed)
+        live_latency, end_latency, missed = replay(test, polls)
+        summarize(name, live_latency, end_latency, missed, polls, args.test_days * args.accounts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Shared helpers for the test suite.
+
+worker/ and tgms_worker/ are separate deployables with same-named modules
+(message_template, circuit_breaker, ...), so tests load a module from an
+explicit file instead of putting both directories on sys.path.
+"""
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(relative_path, name):
+    """Import ROOT/relative_path as a module called `name`."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_with_siblings(directory, module, name):
+    """
+    Import ROOT/directory/module.py as `name`, resolving its bare sibling
+    imports (`from circuit_breaker import ...`) from the same directory.
+    Siblings are dropped from sys.modules again afterwards, so the other
+    deployable's same-named modules never get mixed in.
+    """
+    siblings = {f[:-3] for f in os.listdir(os.path.join(ROOT, directory)) if f.endswith('.py')}
+    saved = {key: sys.modules.pop(key) for key in list(sys.modules) if key in siblings}
+    sys.path.insert(0, os.path.join(ROOT, directory))
+    try:
+        return load_module(os.path.join(directory, module + '.py'), name)
+    finally:
+        sys.path.remove(os.path.join(ROOT, directory))
+        for key in siblings:
+            sys.modules.pop(key, None)
+        sys.modules.update(saved)
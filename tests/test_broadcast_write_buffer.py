@@ -0,0 +1,64 @@
+"""BroadcastWriteBuffer flushes (tgms_worker/database.py), against a recording connection."""
+from contextlib import contextmanager
+
+from conftest import load_module
+
+database = load_module('tgms_worker/database.py', 'tgms_database')
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+        self.committed = False
+
+    def execute(self, statement, params=None):
+        self.statements.append((str(statement), params or {}))
+        return self
+
+    def fetchall(self):
+        return []
+
+    def commit(self):
+        self.committed = True
+
+
+class RecordingDB:
+    def __init__(self):
+        self.connection = RecordingConnection()
+
+    @contextmanager
+    def get_connection(self):
+        yield self.connection
+
+
+def test_flush_with_only_photo_errors_skips_target_states():
+    db = RecordingDB()
+    buffer = database.BroadcastWriteBuffer(db, run_id=7)
+    buffer.record_photo_error(-100123)
+    buffer.record_photo_error(-100123)
+
+    assert buffer.flush() == []
+
+    statements = [sql for sql, _ in db.connection.statements]
+    assert db.connection.committed
+    assert len(statements) == 1
+    assert 'photo_error_count' in statements[0]
+    assert 'broadcast_targets' not in statements[0]
+    assert 'VALUES )' not in statements[0]
+    assert len(buffer) == 0
+
+
+def test_flush_writes_target_states_for_sent_and_failed():
+    db = RecordingDB()
+    buffer = database.BroadcastWriteBuffer(db, run_id=7)
+    buffer.log_sent_message(-1001, 55, 'ab12')
+    buffer.record_failure(-1002, 'Forbidden')
+    buffer.record_photo_error(-1003)
+
+    buffer.flush()
+
+    targets = [(sql, params) for sql, params in db.connection.statements if 'broadcast_targets' in sql]
+    assert len(targets) == 1
+    sql, params = targets[0]
+    assert params['run_id'] == 7
+    assert sorted(v for k, v in params.items() if k.startswith('t_') and k.endswith('_1')) == ['failed', 'sent']
@@ -0,0 +1,60 @@
+"""Group health accounting of broadcast results (worker/fanout.py), against a recording session."""
+from conftest import load_module
+
+load_module('worker/circuit_breaker.py', 'circuit_breaker')
+fanout = load_module('worker/fanout.py', 'worker_fanout')
+
+
+class RecordingSession:
+    def __init__(self):
+        self.statements = []
+        self.committed = False
+
+    def execute(self, statement, params=None):
+        self.statements.append((str(statement), params or {}))
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def test_classify_chat_error():
+    classify = fanout.classify_chat_error
+    assert classify(400, "Bad Request: chat not found") == fanout.FAULT_GONE
+    assert classify(403, "Forbidden: bot was kicked from the supergroup chat") == fanout.FAULT_GONE
+    assert classify(403, "Forbidden: bot can't send messages to the chat") == fanout.FAULT_CHAT
+    assert classify(400, "Bad Request: not enough rights to send text messages to the chat") == fanout.FAULT_CHAT
+    assert classify(400, "Bad Request: can't parse entities: Can't find end of the entity") is None
+    assert classify(400, None) is None
+
+
+def test_content_errors_leave_group_health_alone():
+    session = RecordingSession()
+    writer = fanout.ResultWriter(session, job_id=9)
+    parse_error = "Bad Request: can't parse entities"
+    writer.add('-1001', 'failed', 1, error=parse_error, fault=fanout.classify_chat_error(400, parse_error))
+    writer.add('-1002', 'failed', 1, error="Forbidden", fault=fanout.FAULT_CHAT)
+    writer.add('-1003', 'failed', 1, error="chat not found", fault=fanout.FAULT_GONE)
+
+    writer.write(writer.take())
+
+    assert session.committed
+    targets = [params for sql, params in session.statements if 'chat_broadcast_targets' in sql]
+    assert len(targets) == 1 and 't_2_0' in targets[0]
+    failures = [params for sql, params in session.statements if 'consecutive_failures + 1' in sql]
+    assert len(failures) == 1
+    counted = {(failures[0][f'f_{i}_0'], failures[0][f'f_{i}_1']) for i in range(2)}
+    assert counted == {('-1002', False), ('-1003', True)}
+    assert 'f_2_0' not in failures[0]
+
+
+def test_only_content_errors_skip_the_group_update():
+    session = RecordingSession()
+    writer = fanout.ResultWriter(session, job_id=9)
+    writer.add('-1001', 'failed', 1, error="Bad Request: message is too long")
+
+    writer.write(writer.take())
+
+    assert not any('chat_groups' in sql for sql, _ in session.statements)
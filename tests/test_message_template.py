@@ -0,0 +1,40 @@
+"""Placeholder rendering of both message_template.py copies (worker/ and tgms_worker/)."""
+import pytest
+
+from conftest import load_module
+
+COPIES = [
+    load_module('worker/message_template.py', 'worker_message_template'),
+    load_module('tgms_worker/message_template.py', 'tgms_message_template'),
+]
+
+
+@pytest.fixture(params=COPIES, ids=['worker', 'tgms_worker'])
+def mt(request):
+    return request.param
+
+
+def render(mt, source, parse_mode='Markdown', **values):
+    return mt.compile_template(source, parse_mode, debug_code=False).render(values)
+
+
+def test_placeholder_outside_entity_is_escaped(mt):
+    assert render(mt, 'Hello {title}!', title='Fan_Club *VIP*') == 'Hello Fan\\_Club \\*VIP\\*!'
+
+
+def test_placeholder_inside_entity_is_verbatim_without_closing_marker(mt):
+    # Escapes are shown literally inside a legacy Markdown entity
+    assert render(mt, 'Hello *{title}*', title='Fan_Club *VIP*') == 'Hello *Fan_Club VIP*'
+    assert render(mt, 'Hello _{title}_', title='Fan_Club *VIP*') == 'Hello _FanClub *VIP*_'
+    assert render(mt, 'Code `{title}`', title='a`b_c') == 'Code `ab_c`'
+    assert render(mt, '[{title}](https://t.me/x)', title='[a] b_c') == '[[a b_c](https://t.me/x)'
+
+
+def test_entity_tracking_resets_after_the_entity_closes(mt):
+    source = '*{title}* has {member_count:,} members in {title}'
+    assert render(mt, source, title='a_b', member_count=1200) == '*a_b* has 1,200 members in a\\_b'
+
+
+def test_markdown_v2_and_html_always_escape(mt):
+    assert render(mt, 'Hello *{title}*', 'MarkdownV2', title='a_b.') == 'Hello *a\\_b\\.*'
+    assert render(mt, '<b>{title}</b>', 'HTML', title='a<b>') == '<b>a&lt;b&gt;</b>'
@@ -0,0 +1,37 @@
+"""Send pacing of the TGMS broadcast engine (tgms_worker/broadcast_engine.py, shared_limiter.py)."""
+import asyncio
+import time
+
+from conftest import load_with_siblings
+
+engine = load_with_siblings('tgms_worker', 'broadcast_engine', 'tgms_broadcast_engine')
+shared_limiter = load_with_siblings('tgms_worker', 'shared_limiter', 'tgms_shared_limiter')
+rate_controller = load_with_siblings('tgms_worker', 'rate_controller', 'tgms_rate_controller')
+
+
+def test_bucket_holds_at_least_one_token():
+    assert shared_limiter.bucket_capacity(0.5) == 1.0
+    assert shared_limiter.bucket_capacity(3) == 1.0
+    assert shared_limiter.bucket_capacity(30) == 7.5
+
+
+def test_memory_bucket_grants_a_single_token_below_four_per_second():
+    bucket = shared_limiter.MemoryTokenBucket()
+    assert bucket.take('bot', 1, 2.0) == 0.0
+    wait = bucket.take('bot', 1, 2.0)
+    assert 0 < wait <= 0.5
+
+
+def test_limiter_sends_below_four_per_second_with_a_shared_bucket():
+    controller = rate_controller.AIMDController('test', min_rate=1, initial_rate=3)
+    limiter = engine.RateLimiter(30, bucket=shared_limiter.MemoryTokenBucket(), bucket_name='bot',
+                                 controller=controller)
+
+    async def send(count):
+        for _ in range(count):
+            await limiter.acquire()
+
+    started = time.monotonic()
+    asyncio.run(asyncio.wait_for(send(3), timeout=5))
+    # First slot immediately, then 1/3 s apart
+    assert time.monotonic() - started < 2
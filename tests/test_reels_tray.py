@@ -0,0 +1,27 @@
+"""Lean broadcasts extraction from reels_tray bodies (worker/reels_tray.py)."""
+import pytest
+
+from conftest import load_module
+
+reels_tray = load_module('worker/reels_tray.py', 'worker_reels_tray')
+
+
+def test_extracts_only_the_broadcasts_array():
+    body = (b'{"tray": [{"user": {"username": "x", "bio": "\\"broadcasts\\": [1]"}}], '
+            b'"broadcasts" : [{"id": 1, "broadcast_status": "active"}], "status": "ok"}')
+    assert reels_tray.extract_broadcasts(body) == [{"id": 1, "broadcast_status": "active"}]
+
+
+def test_empty_or_null_broadcasts_mean_nobody_live():
+    assert reels_tray.extract_broadcasts(b'{"tray": [], "broadcasts": [], "status": "ok"}') == []
+    assert reels_tray.extract_broadcasts(b'{"tray": [], "broadcasts": null, "status": "ok"}') == []
+
+
+@pytest.mark.parametrize('body', [
+    b'{"tray": [], "status": "ok"}',
+    b'{"tray": [], "broadcasts": [{"id": 1, ',
+    b'<html>Please wait a few minutes</html>',
+])
+def test_unusable_bodies_raise_tray_format_error(body):
+    with pytest.raises(reels_tray.TrayFormatError):
+        reels_tray.extract_broadcasts(body)
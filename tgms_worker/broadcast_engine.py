@@ -0,0 +1,419 @@
+"""
+Async broadcast engine for TGMS
+Fans a message out to many groups with bounded concurrency, an evenly paced
+global send rate that adapts to Telegram's feedback (rate_controller.py),
+per-chat spacing and 429 back-off. Per-group results are
+streamed to the database in batches. Photos are fetched by Telegram once and
+then re-sent by file_id (see media_cache.py); groups that refuse photos get
+the caption as text instead. Messages are templates compiled once per
+broadcast and rendered per group (message_template.py).
+"""
+import os
+import json
+import time
+import asyncio
+import secrets
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+
+from circuit_breaker import get_breaker, CircuitOpenError
+from telegram_metrics import telegram_metrics
+from telegram_api import TELEGRAM_API_URL
+from media_cache import MediaCache, extract_file_id, is_file_id_error, is_photo_forbidden
+from shared_limiter import get_token_bucket
+from rate_controller import INITIAL_RATE, get_rate_controller
+from message_template import CAPTION_LIMIT, TEXT_LIMIT, compile_template
+
+logger = logging.getLogger(__name__)
+
+# Starting send rate; the bot's AIMD controller moves it within TGMS_RATE_MIN..TGMS_RATE_MAX
+BROADCAST_RATE = INITIAL_RATE
+BROADCAST_CONCURRENCY = int(os.environ.get('TGMS_BROADCAST_CONCURRENCY', '20'))
+# Groups accept ~20 msgs/min from a bot
+PER_CHAT_INTERVAL = float(os.environ.get('TGMS_PER_CHAT_INTERVAL', '3'))
+# Per-group bookkeeping is flushed every N results or T ms (DatabaseManager.write_buffer)
+RESULT_BATCH_SIZE = int(os.environ.get('TGMS_RESULT_BATCH_SIZE', '200'))
+RESULT_FLUSH_MS = int(os.environ.get('TGMS_RESULT_FLUSH_MS', '1000'))
+# Minimum seconds between live progress updates
+PROGRESS_INTERVAL = 5.0
+MAX_ATTEMPTS = 3
+MAX_CONSECUTIVE_FAILURES = 3
+# Refused photos before a group is marked text-only
+PHOTO_ERROR_LIMIT = 2
+# Shared rate tokens are leased this many seconds' worth at a time
+LEASE_SECONDS = 0.2
+# URL sends tried one at a time to capture a file_id before fanning out
+PRIME_ATTEMPTS = 3
+
+
+def generate_debug_code() -> str:
+    """Generate unique debug code"""
+    return f"DBG:{secrets.token_hex(3).upper()}"
+
+
+class RateLimiter:
+    """
+    Hands out evenly spaced send slots at `rate` per second, or at the
+    controller's current rate when it is lower. Idle time does not accumulate
+    burst credit, so the achieved rate never exceeds the target.
+    With a shared bucket (shared_limiter.py) every slot also needs a token from
+    it, which caps the combined rate of all worker processes.
+    """
+
+    def __init__(self, rate: float, bucket=None, bucket_name: str = None, controller=None):
+        self.rate = rate
+        self.bucket = bucket
+        self.bucket_name = bucket_name
+        self.controller = controller
+        self._leased = 0
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._lease_lock = asyncio.Lock()
+
+    @property
+    def current_rate(self) -> float:
+        if self.controller is None:
+            return self.rate
+        return min(self.rate, self.controller.rate)
+
+    async def acquire(self):
+        while True:
+            async with self._lock:
+                slot = max(time.monotonic(), self._next_slot, self._paused_until)
+                self._next_slot = slot + 1.0 / self.current_rate
+            delay = slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A 429 may have paused sending while we waited for our slot
+            if time.monotonic() >= self._paused_until:
+                break
+        if self.bucket is not None:
+            await self._take_shared()
+
+    async def _take_shared(self):
+        async with self._lease_lock:
+            while self._leased <= 0:
+                rate = self.current_rate
+                lease_size = max(1, int(rate * LEASE_SECONDS))
+                try:
+                    wait = await asyncio.to_thread(self.bucket.take, self.bucket_name, lease_size, rate)
+                except Exception as e:
+                    # Shared store unavailable: local pacing still applies
+                    logger.warning(f"Shared rate limiter unavailable, pacing locally: {e}")
+                    wait = 0.0
+                if wait <= 0:
+                    self._leased += lease_size
+                else:
+                    await asyncio.sleep(wait)
+            self._leased -= 1
+
+    def pause(self, seconds: float):
+        """Stop handing out slots for `seconds` (Telegram flood wait), in every process"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        if self.bucket is not None:
+            self._leased = 0
+            asyncio.get_running_loop().create_task(self._penalize(seconds))
+
+    async def _penalize(self, seconds: float):
+        try:
+            await asyncio.to_thread(self.bucket.penalize, self.bucket_name, seconds, self.current_rate)
+        except Exception as e:
+            logger.warning(f"Could not share flood wait with other workers: {e}")
+
+
+class BroadcastEngine:
+    """Concurrent, rate-aware sender for one broadcast at a time"""
+
+    def __init__(self, bot_token: str, db_manager, rate: float = None,
+                 concurrency: int = None, api_url: str = None):
+        self.db = db_manager
+        self.concurrency = concurrency or BROADCAST_CONCURRENCY
+        self.base_url = f"{(api_url or TELEGRAM_API_URL).rstrip('/')}/bot{bot_token}"
+        self.bot_label = bot_token.split(':')[0]
+        # Adaptive send rate for this bot, shared with TelegramAPI; `rate` caps it for this engine
+        self.controller = get_rate_controller(self.bot_label)
+        self.rate = rate or self.controller.max_rate
+        # Same breaker as TelegramAPI for this bot
+        self.breaker = get_breaker(f"telegram:{self.bot_label}")
+        self.media_cache = MediaCache(db_manager, self.bot_label)
+        # Global send budget for this bot, shared with other TGMS processes (TGMS_RATE_LIMITER)
+        self.bucket = get_token_bucket(db_manager)
+
+    @property
+    def current_rate(self) -> float:
+        """Rate broadcasts are paced at right now"""
+        return min(self.rate, self.controller.rate)
+
+    @staticmethod
+    def compile_templates(photo_url: str = None, caption: str = None, text: str = None,
+                          parse_mode: str = "Markdown"):
+        """
+        Compile and validate the broadcast's templates once (message_template.py).
+        Returns (photo_template, text_template); the text template is the
+        message itself, or the caption sent as text to text-only groups.
+        Raises TemplateError for unknown placeholders, broken markup or
+        messages that could exceed Telegram's limits.
+        """
+        if not photo_url:
+            return None, compile_template(text, parse_mode, TEXT_LIMIT)
+        return (compile_template(caption, parse_mode, CAPTION_LIMIT),
+                compile_template(text or caption, parse_mode, TEXT_LIMIT))
+
+    @staticmethod
+    def _build_request(group: Dict[str, Any], debug_code: str, photo: Optional[str], template):
+        """Method and payload for one group, rendered from its pre-fetched columns"""
+        rendered = template.render({
+            "title": group.get("title"),
+            "member_count": group.get("member_count"),
+            "group_id": group["group_id"],
+            "debug_code": debug_code,
+        })
+        if photo:
+            return "sendPhoto", {
+                "chat_id": group["group_id"],
+                "photo": photo,
+                "caption": rendered,
+                "parse_mode": template.parse_mode,
+            }
+        return "sendMessage", {
+            "chat_id": group["group_id"],
+            "text": rendered,
+            "parse_mode": template.parse_mode,
+        }
+
+    async def _call(self, http: aiohttp.ClientSession, method: str, payload: Dict[str, Any]):
+        """One Bot API call; returns (http_status or None, body dict)"""
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            async with http.post(f"{self.base_url}/{method}", json=payload) as response:
+                status = response.status
+                try:
+                    body = await response.json(content_type=None)
+                except (ValueError, aiohttp.ContentTypeError):
+                    body = None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure(e)
+            telegram_metrics.observe(self.bot_label, method, time.perf_counter() - started)
+            return None, {"ok": False, "error": str(e) or type(e).__name__}
+        latency = time.perf_counter() - started
+
+        if status >= 500:
+            self.breaker.record_failure(f"{method}: HTTP {status}")
+        else:
+            # 429s are paced out by the limiter here, not a sign that Telegram is down
+            self.breaker.record_success()
+
+        body = body or {"ok": False, "error": f"HTTP {status}"}
+        if status == 429:
+            self.controller.on_throttle((body.get("parameters") or {}).get("retry_after"))
+        elif status < 500:
+            self.controller.on_success(latency)
+        telegram_metrics.observe(
+            self.bot_label,
+            method,
+            latency,
+            status=status,
+            error_code=body.get("error_code", status) if status >= 400 else None,
+            bytes_sent=len(json.dumps(payload)),
+        )
+        return status, body
+
+    async def broadcast(self, groups: List[Dict[str, Any]], photo_url: str = None,
+                        caption: str = None, text: str = None, run_id: int = None,
+                        on_progress: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+        """
+        Send to every group that allows broadcasts. Groups may carry a
+        pre-assigned debug_code, text_only to get the caption (or text)
+        without the photo, and title/member_count for the message template's
+        placeholders (compiled once here, rendered per group); with run_id, results checkpoint broadcast_targets.
+        on_progress (blocking, run in a thread) is called after result flushes,
+        at most every PROGRESS_INTERVAL seconds.
+
+        Returns:
+            Dict with success count, failed groups and throughput figures
+        """
+        targets = [g for g in groups if g.get("final_message_allowed", True)]
+        results = {
+            "total": len(groups),
+            "success": 0,
+            "failed": [],
+            "sent_to": [],
+            "skipped": len(groups) - len(targets),
+            "rate_limited": 0,
+            "requests": 0,
+            "deactivated": [],
+        }
+        if not targets:
+            results.update(duration_seconds=0.0, messages_per_second=0.0, target_rate=self.current_rate)
+            return results
+
+        photo_template, text_template = self.compile_templates(photo_url, caption, text)
+        groups_by_id = {group["group_id"]: group for group in targets}
+        queue = asyncio.Queue()
+        for group in targets:
+            queue.put_nowait((group["group_id"], 1, group.get("debug_code") or generate_debug_code(),
+                              bool(group.get("text_only"))))
+
+        # Photo reference used for sends: the cached file_id once known, else the URL.
+        # Without a file_id a single worker primes it before the rest fan out.
+        media = {"photo": photo_url, "url_sends": 0}
+        primed = asyncio.Event()
+        if photo_url:
+            file_id = await asyncio.to_thread(self.media_cache.get, photo_url)
+            if file_id:
+                media["photo"] = file_id
+                primed.set()
+        else:
+            primed.set()
+
+        limiter = RateLimiter(self.rate, self.bucket, f"telegram:{self.bot_label}", self.controller)
+        chat_ready_at: Dict[int, float] = {}
+        buffer = self.db.write_buffer(run_id, RESULT_BATCH_SIZE, RESULT_FLUSH_MS, MAX_CONSECUTIVE_FAILURES,
+                                      PHOTO_ERROR_LIMIT)
+        flush_needed = asyncio.Event()
+        last_progress = [0.0]
+        abort: List[CircuitOpenError] = []
+
+        def fail(group_id, error):
+            logger.error(f"✗ Failed to send to group {group_id}: {error}")
+            results["failed"].append({"group_id": group_id, "error": error})
+            buffer.record_failure(group_id, error)
+
+        async def send_worker(http, primer: bool):
+            if not primer:
+                await primed.wait()
+            while True:
+                group_id, attempt, debug_code, text_only = await queue.get()
+                try:
+                    if abort:
+                        continue
+                    wait = chat_ready_at.get(group_id, 0.0) - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    await limiter.acquire()
+
+                    photo = None if text_only else media["photo"]
+                    method, payload = self._build_request(
+                        groups_by_id[group_id], debug_code, photo, photo_template if photo else text_template
+                    )
+                    results["requests"] += 1
+                    status, body = await self._call(http, method, payload)
+                    chat_ready_at[group_id] = time.monotonic() + PER_CHAT_INTERVAL
+
+                    if photo and photo == photo_url:
+                        media["url_sends"] += 1
+                        file_id, file_unique_id = extract_file_id(body.get("result")) if body.get("ok") else (None, None)
+                        if file_id and media["photo"] == photo_url:
+                            media["photo"] = file_id
+                            await asyncio.to_thread(self.media_cache.remember, photo_url, file_id, file_unique_id)
+                        if file_id or media["url_sends"] >= PRIME_ATTEMPTS:
+                            # Fan out (with the URL if Telegram never returned a file_id)
+                            primed.set()
+
+                    if body.get("ok"):
+                        message_id = (body.get("result") or {}).get("message_id")
+                        buffer.log_sent_message(group_id, message_id, debug_code)
+                        results["success"] += 1
+                        results["sent_to"].append(group_id)
+                        logger.debug(f"✓ Sent to group {group_id} ({debug_code})")
+                    elif status == 429:
+                        retry_after = ((body.get("parameters") or {}).get("retry_after")) or 1
+                        results["rate_limited"] += 1
+                        limiter.pause(retry_after)
+                        chat_ready_at[group_id] = time.monotonic() + retry_after
+                        logger.warning(f"Rate limited on group {group_id}; pausing {retry_after}s")
+                        if attempt < MAX_ATTEMPTS:
+                            queue.put_nowait((group_id, attempt + 1, debug_code, text_only))
+                        else:
+                            fail(group_id, body.get("description") or "Too Many Requests")
+                    elif photo and status in (400, 403) and is_photo_forbidden(body.get("description")):
+                        # The group takes text but not photos: count it and send the caption as text
+                        buffer.record_photo_error(group_id)
+                        queue.put_nowait((group_id, attempt, debug_code, True))
+                    elif status == 400 and photo and photo != photo_url and is_file_id_error(body.get("description")):
+                        # Stale file_id: fall back to the URL (the next URL send re-primes) and retry
+                        if media["photo"] == photo:
+                            media["photo"] = photo_url
+                            await asyncio.to_thread(self.media_cache.invalidate, photo_url, body.get("description"))
+                        if attempt < MAX_ATTEMPTS:
+                            queue.put_nowait((group_id, attempt + 1, debug_code, text_only))
+                        else:
+                            fail(group_id, body.get("description"))
+                    elif (status is None or status >= 500) and attempt < MAX_ATTEMPTS:
+                        # Transient; try again later without holding up the rest
+                        queue.put_nowait((group_id, attempt + 1, debug_code, text_only))
+                    else:
+                        fail(group_id, body.get("description") or body.get("error") or "Unknown error")
+
+                    if buffer.due():
+                        flush_needed.set()
+                except CircuitOpenError as e:
+                    # Telegram is down, not this group; stop the broadcast and let the job be deferred
+                    if not abort:
+                        abort.append(e)
+                except Exception as e:
+                    fail(group_id, str(e))
+                finally:
+                    queue.task_done()
+
+        async def flush():
+            if not len(buffer):
+                return
+            pending = len(buffer)
+            try:
+                deactivated = await asyncio.to_thread(buffer.flush)
+                for group_id in deactivated:
+                    logger.warning(f"Deactivated group {group_id} after {MAX_CONSECUTIVE_FAILURES} failures")
+                results["deactivated"].extend(deactivated)
+                if on_progress and time.monotonic() - last_progress[0] >= PROGRESS_INTERVAL:
+                    last_progress[0] = time.monotonic()
+                    await asyncio.to_thread(on_progress)
+            except Exception as e:
+                # Rows stay buffered for the next flush; if none succeeds the targets stay claimed and are retried
+                logger.error(f"Failed to record {pending} broadcast results: {e}", exc_info=True)
+
+        async def result_writer():
+            while True:
+                try:
+                    await asyncio.wait_for(flush_needed.wait(), timeout=RESULT_FLUSH_MS / 1000.0)
+                except asyncio.TimeoutError:
+                    pass
+                flush_needed.clear()
+                await flush()
+
+        logger.info(
+            f"Broadcasting to {len(targets)} groups at {self.current_rate:.1f} msgs/sec "
+            f"(adaptive, max {self.rate:g}, concurrency {self.concurrency})"
+        )
+        started = time.monotonic()
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as http:
+            writer = asyncio.create_task(result_writer())
+            workers = [asyncio.create_task(send_worker(http, primer=(i == 0)))
+                       for i in range(min(self.concurrency, len(targets)))]
+            try:
+                await queue.join()
+            finally:
+                for task in workers + [writer]:
+                    task.cancel()
+                await asyncio.gather(*workers, writer, return_exceptions=True)
+                await flush()
+
+        duration = time.monotonic() - started
+        results["duration_seconds"] = round(duration, 2)
+        results["messages_per_second"] = round(results["requests"] / duration, 2) if duration else 0.0
+        results["target_rate"] = self.rate
+        results["final_rate"] = round(self.current_rate, 2)
+        logger.info(
+            f"Broadcast complete: {results['success']}/{len(targets)} sent in {duration:.1f}s "
+            f"({results['messages_per_second']} msgs/sec, max {self.rate:g}, now {self.current_rate:.1f}, "
+            f"{results['rate_limited']} rate-limited)"
+        )
+
+        if abort:
+            raise abort[0]
+        return results
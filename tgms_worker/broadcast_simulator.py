@@ -0,0 +1,162 @@
+"""
+Broadcast projection model for TGMS
+Dry run: simulates a broadcast to the real target set under the engine's rate
+limits and each group's historical failure rate, without sending anything.
+Live: turns a running broadcast's counters into progress and an ETA using the
+same throughput model.
+"""
+import heapq
+import random
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from broadcast_engine import BROADCAST_RATE, BROADCAST_CONCURRENCY, PER_CHAT_INTERVAL, MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY = 0.35  # seconds per Bot API call when no telegram_call_stats are available
+# Share of failures that are transient (network/5xx/429) and retried by the engine
+TRANSIENT_FAILURE_SHARE = 0.3
+# Observed throughput replaces the model once this many targets are done
+MIN_OBSERVED_TARGETS = 50
+
+
+def failure_probability(sent: int, failed: int, consecutive_failures: int, base_rate: float,
+                        max_failures: int = 3) -> float:
+    """
+    Per-group failure estimate: past outcomes smoothed towards the fleet-wide
+    rate, raised for groups already on a failure streak.
+    """
+    history = (failed + base_rate) / (sent + failed + 1)
+    streak = min(1.0, consecutive_failures / max_failures) if consecutive_failures else 0.0
+    return max(history, streak)
+
+
+def model_rate(rate: float, concurrency: int, latency: float) -> float:
+    """Steady-state sends/sec: the rate limit or what concurrency allows at this latency"""
+    return min(rate, concurrency / max(latency, 0.001))
+
+
+def simulate(failure_probs: List[float], rate: float = None, concurrency: int = None,
+             latency: float = DEFAULT_LATENCY, per_chat_interval: float = PER_CHAT_INTERVAL,
+             max_attempts: int = MAX_ATTEMPTS, seed: int = 0) -> Dict[str, Any]:
+    """
+    Discrete-event simulation of one broadcast: evenly spaced rate slots,
+    `concurrency` workers each busy for `latency` per call, transient failures
+    retried after the per-chat interval.
+    """
+    rate = rate or BROADCAST_RATE
+    concurrency = concurrency or BROADCAST_CONCURRENCY
+    rng = random.Random(seed)
+
+    workers = [0.0] * max(1, min(concurrency, len(failure_probs) or 1))
+    next_slot = 0.0
+    ready_at: Dict[int, float] = {}
+    send_times: List[float] = []
+    failures = 0
+    retries = 0
+    queue = deque((i, 1) for i in range(len(failure_probs)))
+
+    while queue:
+        index, attempt = queue.popleft()
+        free_at = heapq.heappop(workers)
+        start = max(free_at, next_slot, ready_at.get(index, 0.0))
+        next_slot = start + 1.0 / rate
+        send_times.append(start)
+        end = start + latency
+        heapq.heappush(workers, end)
+
+        if rng.random() < failure_probs[index]:
+            if attempt < max_attempts and rng.random() < TRANSIENT_FAILURE_SHARE:
+                retries += 1
+                ready_at[index] = end + per_chat_interval
+                queue.append((index, attempt + 1))
+            else:
+                failures += 1
+
+    # Peak outbound rate: most sends started within any one-second window
+    peak = 0
+    window_start = 0
+    for i, sent_at in enumerate(send_times):
+        while sent_at - send_times[window_start] >= 1.0:
+            window_start += 1
+        peak = max(peak, i - window_start + 1)
+
+    duration = max(workers) if send_times else 0.0
+    return {
+        "targets": len(failure_probs),
+        "requests": len(send_times),
+        "retries": retries,
+        "simulated_failures": failures,
+        "projected_duration_seconds": round(duration, 1),
+        "peak_outbound_rate": peak,
+        "average_rate": round(len(send_times) / duration, 2) if duration else 0.0,
+    }
+
+
+def project_broadcast(db_manager, bot_id: str, photo: bool = False, rate: float = None,
+                      concurrency: int = None, seed: int = 0) -> Dict[str, Any]:
+    """
+    Dry run: resolve the audience exactly as create_broadcast_run would and
+    simulate sending to it.
+    """
+    rate = rate or BROADCAST_RATE
+    concurrency = concurrency or BROADCAST_CONCURRENCY
+    audience = db_manager.get_broadcast_audience_history()
+    method = "sendPhoto" if photo else "sendMessage"
+    latency = db_manager.get_recent_call_latency(bot_id, method) or DEFAULT_LATENCY
+
+    total_sent = sum(row["sent"] for row in audience)
+    total_failed = sum(row["failed"] for row in audience)
+    base_rate = total_failed / (total_sent + total_failed) if (total_sent + total_failed) else 0.02
+    probs = [
+        failure_probability(row["sent"], row["failed"], row["consecutive_failures"], base_rate)
+        for row in audience
+    ]
+
+    projection = simulate(probs, rate=rate, concurrency=concurrency, latency=latency, seed=seed)
+    projection.update(
+        mode="dry_run",
+        expected_failures=round(sum(probs), 1),
+        expected_deliveries=round(len(probs) - sum(probs), 1),
+        configured_rate=rate,
+        concurrency=concurrency,
+        latency_seconds=round(latency, 3),
+        fleet_failure_rate=round(base_rate, 4),
+        projected_finish_at=(
+            datetime.now(timezone.utc) + timedelta(seconds=projection["projected_duration_seconds"])
+        ).isoformat(),
+    )
+    logger.info(
+        f"Dry run: {projection['targets']} targets, ~{projection['projected_duration_seconds']}s, "
+        f"~{projection['expected_failures']} failures, peak {projection['peak_outbound_rate']} msgs/sec"
+    )
+    return projection
+
+
+def live_progress(total: int, sent: int, failed: int, open_targets: int, elapsed: float,
+                  rate: float = None, concurrency: int = None,
+                  latency: float = DEFAULT_LATENCY) -> Dict[str, Any]:
+    """Progress and ETA of a running broadcast"""
+    rate = rate or BROADCAST_RATE
+    concurrency = concurrency or BROADCAST_CONCURRENCY
+    done = sent + failed
+    observed = done / elapsed if elapsed > 0 else 0.0
+    throughput = observed if done >= MIN_OBSERVED_TARGETS and observed > 0 else model_rate(rate, concurrency, latency)
+    eta: Optional[float] = round(open_targets / throughput, 1) if throughput else None
+    return {
+        "mode": "live",
+        "total": total,
+        "sent": sent,
+        "failed": failed,
+        "remaining": open_targets,
+        "percent": round(100.0 * done / total, 1) if total else 100.0,
+        "elapsed_seconds": round(elapsed, 1),
+        "observed_rate": round(observed, 2),
+        "eta_seconds": eta,
+        "projected_finish_at": (
+            (datetime.now(timezone.utc) + timedelta(seconds=eta)).isoformat() if eta is not None else None
+        ),
+    }
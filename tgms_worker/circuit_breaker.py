@@ -0,0 +1,144 @@
+"""
+Circuit breakers for TGMS outbound calls
+Fail fast while Telegram is down instead of waiting out every timeout
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+ERROR_RATE_THRESHOLD = float(os.environ.get('CIRCUIT_ERROR_RATE', '0.5'))
+RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', '30'))
+HEALTH_WRITE_INTERVAL = 30  # seconds between bot_health writes
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# bot_health.status vocabulary: healthy, degraded, down
+HEALTH_STATUS = {CLOSED: 'healthy', HALF_OPEN: 'degraded', OPEN: 'down'}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open; retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive failures, or when the
+    error rate over the last `window_size` calls exceeds `error_rate_threshold`.
+    Open -> half-open after `reset_timeout`; one probe call decides whether to
+    close again or re-open.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD,
+                 error_rate_threshold: float = ERROR_RATE_THRESHOLD, window_size: int = 20,
+                 min_calls: int = 10, reset_timeout: float = RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+        self._window = deque(maxlen=window_size)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def raise_if_open(self):
+        """Fail fast without claiming the half-open probe slot."""
+        with self._lock:
+            if self.state == OPEN and self.retry_after > 0:
+                raise CircuitOpenError(self.name, self.retry_after)
+
+    def before_call(self):
+        """Call before every request; raises CircuitOpenError if the call must not go out."""
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_after > 0:
+                    raise CircuitOpenError(self.name, self.retry_after)
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+                logger.info(f"Circuit '{self.name}' half-open, probing")
+
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._window.append(True)
+            self.consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                logger.info(f"Circuit '{self.name}' closed after successful probe")
+                self._window.clear()
+            self.state = CLOSED
+            self._probe_in_flight = False
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._window.append(False)
+            self.consecutive_failures += 1
+            self.last_error = str(error)[:200] if error else None
+
+            failures = self._window.count(False)
+            error_rate = failures / len(self._window)
+            if (self.state == HALF_OPEN
+                    or self.consecutive_failures >= self.failure_threshold
+                    or (len(self._window) >= self.min_calls and error_rate >= self.error_rate_threshold)):
+                if self.state != OPEN:
+                    logger.warning(
+                        f"Circuit '{self.name}' OPEN for {self.reset_timeout:.0f}s "
+                        f"({self.consecutive_failures} consecutive failures, error rate {error_rate:.0%}): {error}"
+                    )
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+_breakers = {}
+_last_health_write = 0.0
+
+
+def get_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Get or create the process-wide breaker for a dependency."""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name, **kwargs)
+    return _breakers[name]
+
+
+def write_breaker_health(db_manager, force: bool = False):
+    """Push every breaker's state into bot_health (throttled)."""
+    global _last_health_write
+    now = time.monotonic()
+    if not _breakers or (not force and now - _last_health_write < HEALTH_WRITE_INTERVAL):
+        return
+    _last_health_write = now
+
+    for breaker in list(_breakers.values()):
+        activity = f"circuit={breaker.state}"
+        if breaker.last_error and breaker.state != CLOSED:
+            activity += f"; last_error={breaker.last_error}"
+        try:
+            db_manager.update_bot_health(breaker.name, HEALTH_STATUS[breaker.state], activity)
+        except Exception as e:
+            logger.warning(f"Could not write circuit breaker health for {breaker.name}: {e}")
@@ -2,7 +2,11 @@
 Database adapter for TGMS - Supabase PostgreSQL
 Replaces SQLite-based DatabaseManager with PostgreSQL
 """
+import os
+import json
+import time
 import logging
+import threading
 from contextlib import contextmanager
 from typing import List, Dict, Any, Optional
 from sqlalchemy import create_engine, text
@@ -11,6 +15,197 @@ from sqlalchemy.pool import QueuePool
 
 logger = logging.getLogger(__name__)
 
+# Groups a broadcast goes to; shared by target creation and dry-run projection.
+# The first line matches the partial index idx_managed_groups_audience (add_group_health.sql).
+BROADCAST_AUDIENCE_FILTER = """
+    is_active AND final_message_allowed
+    AND (NOT is_disabled OR disabled_until <= NOW())
+    AND health_score >= CAST(:min_health_score AS REAL)
+"""
+# Groups scoring below this are left out of broadcasts until their score recovers
+MIN_HEALTH_SCORE = float(os.environ.get('TGMS_MIN_HEALTH_SCORE', '0.2'))
+# Delivery history (broadcast_targets) considered by health scores
+HEALTH_WINDOW_DAYS = 30
+
+
+def _values(rows: List[tuple], columns: List[tuple], prefix: str):
+    """
+    Build a typed VALUES list and its bind parameters for a multi-row statement.
+
+    Args:
+        rows: tuples of column values
+        columns: (name, SQL type) per column
+        prefix: bind parameter prefix, unique within the statement
+
+    Returns:
+        (sql, params) e.g. ("(CAST(:p_0_0 AS BIGINT), ...), (...)", {...})
+    """
+    params = {}
+    tuples = []
+    for i, row in enumerate(rows):
+        placeholders = []
+        for j, ((name, sql_type), value) in enumerate(zip(columns, row)):
+            key = f"{prefix}_{i}_{j}"
+            params[key] = value
+            placeholders.append(f"CAST(:{key} AS {sql_type})")
+        tuples.append(f"({', '.join(placeholders)})")
+    return ", ".join(tuples), params
+
+
+class BroadcastWriteBuffer:
+    """
+    Accumulates per-group broadcast bookkeeping (sent_messages rows, failure
+    counter resets/increments, deactivations, photo errors and broadcast_targets
+    states) and writes it with one multi-row statement per kind, in a single
+    transaction.
+
+    Crash safety: a target's final state is committed in the same transaction as
+    its sent_messages row and counters, so after a crash either all of a batch is
+    recorded or none of it is, and unrecorded targets are still 'sending' and get
+    reclaimed. A failed flush keeps its rows for the next attempt.
+    """
+
+    def __init__(self, db: 'DatabaseManager', run_id: Optional[int] = None, max_rows: int = 200,
+                 max_delay_ms: int = 1000, max_failures: int = 3, photo_error_limit: int = 2):
+        self.db = db
+        self.run_id = run_id
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_failures = max_failures
+        self.photo_error_limit = photo_error_limit
+        self._sent: List[tuple] = []      # (chat_id, telegram_message_id, debug_code)
+        self._failed: List[tuple] = []    # (group_id, error)
+        self._photo_errors: List[int] = []  # group_id per refused photo
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sent) + len(self._failed) + len(self._photo_errors)
+
+    def log_sent_message(self, chat_id: int, telegram_message_id: Optional[int], debug_code: str):
+        """Buffer a delivered message (also resets the group's failure count)"""
+        with self._lock:
+            self._sent.append((chat_id, telegram_message_id, debug_code))
+            self._oldest = self._oldest or time.monotonic()
+
+    def record_failure(self, group_id: int, error: str):
+        """Buffer a failed delivery (increments the failure count, may deactivate)"""
+        with self._lock:
+            self._failed.append((group_id, str(error)[:500]))
+            self._oldest = self._oldest or time.monotonic()
+
+    def record_photo_error(self, group_id: int):
+        """Buffer a refused photo (the group turns text-only after photo_error_limit)"""
+        with self._lock:
+            self._photo_errors.append(group_id)
+            self._oldest = self._oldest or time.monotonic()
+
+    def due(self) -> bool:
+        """True once max_rows are buffered or the oldest row is max_delay_ms old"""
+        return len(self) >= self.max_rows or (
+            self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay
+        )
+
+    def flush(self) -> List[int]:
+        """
+        Write everything buffered in one transaction.
+
+        Returns:
+            Group IDs deactivated by this flush
+        """
+        with self._lock:
+            sent, failed, photo_errors = self._sent, self._failed, self._photo_errors
+            self._sent, self._failed, self._photo_errors, self._oldest = [], [], [], None
+        if not sent and not failed and not photo_errors:
+            return []
+
+        try:
+            with self.db.get_connection() as conn:
+                deactivated = self._write(conn, sent, failed, photo_errors)
+                conn.commit()
+        except Exception:
+            # Keep the rows (ahead of anything buffered meanwhile) for the next flush
+            with self._lock:
+                self._sent[:0] = sent
+                self._failed[:0] = failed
+                self._photo_errors[:0] = photo_errors
+                self._oldest = self._oldest or time.monotonic()
+            raise
+        return deactivated
+
+    def _write(self, conn, sent: List[tuple], failed: List[tuple], photo_errors: List[int]) -> List[int]:
+        deactivated = []
+        if sent:
+            values, params = _values(sent, [("chat_id", "BIGINT"), ("telegram_message_id", "BIGINT"),
+                                            ("debug_code", "VARCHAR(50)")], "s")
+            conn.execute(text(f"""
+                INSERT INTO sent_messages (chat_id, telegram_message_id, debug_code)
+                VALUES {values}
+                ON CONFLICT (debug_code) DO NOTHING
+            """), params)
+
+            values, params = _values(sorted({(row[0],) for row in sent}), [("group_id", "BIGINT")], "r")
+            conn.execute(text(f"""
+                UPDATE managed_groups m
+                SET consecutive_failures = 0, updated_at = NOW()
+                FROM (VALUES {values}) AS v(group_id)
+                WHERE m.group_id = v.group_id
+                  AND COALESCE(m.consecutive_failures, 0) <> 0
+            """), params)
+
+        if failed:
+            failures_per_group = {}
+            for group_id, _ in failed:
+                failures_per_group[group_id] = failures_per_group.get(group_id, 0) + 1
+            values, params = _values(sorted(failures_per_group.items()),
+                                     [("group_id", "BIGINT"), ("failures", "INTEGER")], "f")
+            params["max_failures"] = self.max_failures
+            result = conn.execute(text(f"""
+                UPDATE managed_groups m
+                SET consecutive_failures = COALESCE(m.consecutive_failures, 0) + v.failures,
+                    is_active = CASE
+                        WHEN COALESCE(m.consecutive_failures, 0) + v.failures >= :max_failures THEN false
+                        ELSE m.is_active
+                    END,
+                    updated_at = NOW()
+                FROM (VALUES {values}) AS v(group_id, failures)
+                WHERE m.group_id = v.group_id
+                RETURNING m.group_id, m.is_active
+            """), params)
+            deactivated = [row.group_id for row in result.fetchall() if not row.is_active]
+
+        if photo_errors:
+            errors_per_group = {}
+            for group_id in photo_errors:
+                errors_per_group[group_id] = errors_per_group.get(group_id, 0) + 1
+            values, params = _values(sorted(errors_per_group.items()),
+                                     [("group_id", "BIGINT"), ("errors", "INTEGER")], "p")
+            params["photo_error_limit"] = self.photo_error_limit
+            conn.execute(text(f"""
+                UPDATE managed_groups m
+                SET photo_error_count = m.photo_error_count + v.errors,
+                    is_text_only = m.is_text_only OR m.photo_error_count + v.errors >= :photo_error_limit,
+                    updated_at = NOW()
+                FROM (VALUES {values}) AS v(group_id, errors)
+                WHERE m.group_id = v.group_id
+            """), params)
+
+        states = [(chat_id, 'sent', message_id, None) for chat_id, message_id, _ in sent]
+        states += [(group_id, 'failed', None, error) for group_id, error in failed]
+        # A flush holding only photo errors has no target states to write
+        if self.run_id is not None and states:
+            values, params = _values(states, [("group_id", "BIGINT"), ("state", "VARCHAR(10)"),
+                                              ("telegram_message_id", "BIGINT"), ("error", "TEXT")], "t")
+            params["run_id"] = self.run_id
+            conn.execute(text(f"""
+                UPDATE broadcast_targets t
+                SET state = v.state, telegram_message_id = v.telegram_message_id,
+                    error = v.error, updated_at = NOW()
+                FROM (VALUES {values}) AS v(group_id, state, telegram_message_id, error)
+                WHERE t.run_id = :run_id AND t.group_id = v.group_id
+            """), params)
+        return deactivated
+
 
 class DatabaseManager:
     """PostgreSQL Database Manager for TGMS"""
@@ -57,6 +252,10 @@ class DatabaseManager:
         finally:
             session.close()
     
+    def close(self):
+        """Dispose of the connection pool"""
+        self.engine.dispose()
+    
     @contextmanager
     def get_connection(self):
         """Context manager for raw connections (for SQLite compatibility)"""
@@ -192,3 +391,635 @@ class DatabaseManager:
             )
             conn.commit()
             logger.info(f"Registered/updated managed group {group_id} ({title})")
+
+    # --- Broadcasts ---
+
+    def log_sent_message(self, chat_id: int, telegram_message_id: Optional[int], debug_code: str):
+        """Log a single broadcast message (see BroadcastWriteBuffer for batches)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO sent_messages (chat_id, telegram_message_id, debug_code)
+                    VALUES (:chat_id, :telegram_message_id, :debug_code)
+                    ON CONFLICT (debug_code) DO NOTHING
+                """),
+                {"chat_id": chat_id, "telegram_message_id": telegram_message_id, "debug_code": debug_code}
+            )
+            conn.commit()
+
+    def write_buffer(self, run_id: Optional[int] = None, max_rows: int = 200, max_delay_ms: int = 1000,
+                     max_failures: int = 3, photo_error_limit: int = 2) -> 'BroadcastWriteBuffer':
+        """Create a write buffer for one broadcast's bookkeeping"""
+        return BroadcastWriteBuffer(self, run_id, max_rows, max_delay_ms, max_failures, photo_error_limit)
+
+    def create_broadcast_run(
+        self,
+        job_id: Optional[int],
+        payload: Dict[str, Any],
+        shard_count: int = 1,
+        shard_mode: str = 'hash',
+        shard_size: Optional[int] = None,
+        shard_job_bot_token: Optional[str] = None,
+        min_health_score: float = MIN_HEALTH_SCORE,
+    ) -> Dict[str, Any]:
+        """
+        Get or create the broadcast run for a job. A new run snapshots the
+        audience (BROADCAST_AUDIENCE_FILTER, resolved in one query) as pending
+        targets, each with its own debug code, health score and text-only flag.
+        Calling again for the same job returns the existing run.
+
+        Args:
+            shard_count: shards to split targets into by group_id hash (shard_mode='hash')
+            shard_mode: 'hash' or 'chunk' (consecutive group_ids, shard_size per shard)
+            shard_job_bot_token: when set and the run has several shards, one
+                tgms_broadcast_shard job per shard other than 0 is enqueued in the
+                same transaction (shard 0 belongs to the creating job)
+            min_health_score: groups scoring lower are left out
+        """
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("""
+                    INSERT INTO broadcast_runs (job_id, payload)
+                    VALUES (:job_id, CAST(:payload AS JSONB))
+                    ON CONFLICT (job_id) DO NOTHING
+                    RETURNING run_id
+                """),
+                {"job_id": job_id, "payload": json.dumps(payload)}
+            ).fetchone()
+
+            if row is None:
+                # Job retried after a restart: resume the existing run
+                row = conn.execute(
+                    text("SELECT * FROM broadcast_runs WHERE job_id = :job_id"),
+                    {"job_id": job_id}
+                ).fetchone()
+                conn.commit()
+                logger.info(f"Resuming broadcast run {row.run_id} for job {job_id}")
+                return dict(row._mapping)
+
+            run_id = row.run_id
+            if shard_mode == 'chunk' and shard_size:
+                shard_expr = "(ROW_NUMBER() OVER (ORDER BY group_id) - 1) / :shard_size"
+            else:
+                # hashtext() is a signed int4; shift it to non-negative before MOD
+                shard_expr = "MOD(hashtext(group_id::TEXT)::BIGINT + 2147483648, :shard_count)"
+            total = conn.execute(
+                text(f"""
+                    INSERT INTO broadcast_targets (run_id, group_id, shard, debug_code, text_only, health_score)
+                    SELECT :run_id, group_id, {shard_expr},
+                           'DBG:' || UPPER(SUBSTR(MD5(RANDOM()::TEXT || group_id::TEXT), 1, 6)),
+                           is_text_only, health_score
+                    FROM managed_groups
+                    WHERE {BROADCAST_AUDIENCE_FILTER}
+                """),
+                {"run_id": run_id, "shard_count": max(1, shard_count), "shard_size": shard_size,
+                 "min_health_score": min_health_score}
+            ).rowcount
+            result = conn.execute(
+                text("""
+                    UPDATE broadcast_runs
+                    SET total_targets = :total,
+                        shard_count = GREATEST(1, (SELECT COALESCE(MAX(shard), 0) + 1
+                                                   FROM broadcast_targets WHERE run_id = :run_id)),
+                        updated_at = NOW()
+                    WHERE run_id = :run_id
+                    RETURNING *
+                """),
+                {"run_id": run_id, "total": total}
+            ).fetchone()
+            run = dict(result._mapping)
+
+            if shard_job_bot_token and run["shard_count"] > 1:
+                conn.execute(
+                    text("""
+                        INSERT INTO jobs (job_type, bot_token, payload, status, created_at, updated_at)
+                        SELECT 'tgms_broadcast_shard', :bot_token,
+                               jsonb_build_object('run_id', :run_id, 'shard', shard), 'pending', NOW(), NOW()
+                        FROM generate_series(1, :shard_count - 1) AS shard
+                    """),
+                    {"bot_token": shard_job_bot_token, "run_id": run_id, "shard_count": run["shard_count"]}
+                )
+            conn.commit()
+            logger.info(
+                f"Created broadcast run {run_id} for job {job_id} with {total} targets "
+                f"in {run['shard_count']} shard(s)"
+            )
+            return run
+
+    def get_broadcast_run(self, run_id: int) -> Optional[Dict[str, Any]]:
+        """Get a broadcast run by ID"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("SELECT * FROM broadcast_runs WHERE run_id = :run_id"),
+                {"run_id": run_id}
+            ).fetchone()
+            return dict(row._mapping) if row else None
+
+    def claim_broadcast_targets(
+        self,
+        run_id: int,
+        worker_id: str,
+        limit: int,
+        stale_after: int,
+        max_claims: int = 3,
+        shard: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Claim up to `limit` unfinished targets for this worker, healthiest
+        first. Pending targets and 'sending' claims older than `stale_after`
+        seconds (crashed worker) are eligible; rows locked by other workers are
+        skipped. With shard, only that shard's targets are claimed. Rows carry
+        the group's current title and member_count for message templates.
+        """
+        with self.get_connection() as conn:
+            result = conn.execute(
+                text("""
+                    WITH claimable AS (
+                        SELECT run_id, group_id
+                        FROM broadcast_targets
+                        WHERE run_id = :run_id
+                          AND (CAST(:shard AS INTEGER) IS NULL OR shard = :shard)
+                          AND (state = 'pending'
+                               OR (state = 'sending'
+                                   AND attempts < :max_claims
+                                   AND claimed_at < NOW() - make_interval(secs => :stale_after)))
+                        ORDER BY health_score DESC, group_id
+                        LIMIT :limit
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE broadcast_targets t
+                    SET state = 'sending', claimed_by = :worker_id, claimed_at = NOW(),
+                        attempts = t.attempts + 1, updated_at = NOW()
+                    FROM claimable c
+                    LEFT JOIN managed_groups g ON g.group_id = c.group_id
+                    WHERE t.run_id = c.run_id AND t.group_id = c.group_id
+                    RETURNING t.group_id, t.debug_code, t.attempts, t.text_only, g.title, g.member_count
+                """),
+                {
+                    "run_id": run_id,
+                    "worker_id": worker_id,
+                    "limit": limit,
+                    "stale_after": stale_after,
+                    "max_claims": max_claims,
+                    "shard": shard,
+                }
+            )
+            rows = [dict(row._mapping) for row in result.fetchall()]
+            conn.commit()
+            return rows
+
+    def release_broadcast_claims(self, run_id: int, worker_id: str) -> int:
+        """Return this worker's unsent claims to pending (e.g. Telegram went down)"""
+        with self.get_connection() as conn:
+            result = conn.execute(
+                text("""
+                    UPDATE broadcast_targets
+                    SET state = 'pending', claimed_by = NULL, claimed_at = NULL,
+                        attempts = GREATEST(attempts - 1, 0), updated_at = NOW()
+                    WHERE run_id = :run_id AND claimed_by = :worker_id AND state = 'sending'
+                """),
+                {"run_id": run_id, "worker_id": worker_id}
+            )
+            conn.commit()
+            return result.rowcount
+
+    def finish_broadcast_run(
+        self,
+        run_id: int,
+        stale_after: int,
+        max_claims: int = 3,
+        shard: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Refresh a run's counters and mark it completed once no target is open.
+        Targets whose claim went stale `max_claims` times are given up as failed.
+
+        Exactly one caller sees just_completed=True (the status flip is guarded),
+        and that caller writes the aggregated results summary. shard_open counts
+        open targets in `shard` (the whole run when shard is None).
+        """
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    UPDATE broadcast_targets
+                    SET state = 'failed', error = 'Abandoned after ' || attempts || ' claims', updated_at = NOW()
+                    WHERE run_id = :run_id
+                      AND state = 'sending'
+                      AND attempts >= :max_claims
+                      AND claimed_at < NOW() - make_interval(secs => :stale_after)
+                """),
+                {"run_id": run_id, "stale_after": stale_after, "max_claims": max_claims}
+            )
+            counts = conn.execute(
+                text("""
+                    SELECT COUNT(*) FILTER (WHERE state = 'sent') AS sent,
+                           COUNT(*) FILTER (WHERE state = 'failed') AS failed,
+                           COUNT(*) FILTER (WHERE state IN ('pending', 'sending')) AS open,
+                           COUNT(*) FILTER (WHERE state IN ('pending', 'sending')
+                                            AND (CAST(:shard AS INTEGER) IS NULL OR shard = :shard)) AS shard_open
+                    FROM broadcast_targets
+                    WHERE run_id = :run_id
+                """),
+                {"run_id": run_id, "shard": shard}
+            ).fetchone()
+            conn.execute(
+                text("""
+                    UPDATE broadcast_runs
+                    SET sent_count = :sent, failed_count = :failed, updated_at = NOW()
+                    WHERE run_id = :run_id
+                """),
+                {"run_id": run_id, "sent": counts.sent, "failed": counts.failed}
+            )
+
+            just_completed = False
+            if counts.open == 0:
+                # Only one concurrent finisher gets past status = 'running'
+                completed = conn.execute(
+                    text("""
+                        UPDATE broadcast_runs
+                        SET status = 'completed',
+                            completed_at = NOW(),
+                            results = jsonb_build_object(
+                                'total', total_targets,
+                                'success', :sent,
+                                'failed', :failed,
+                                'shards', shard_count,
+                                'duration_seconds', ROUND(EXTRACT(EPOCH FROM (NOW() - created_at))::NUMERIC, 2),
+                                'messages_per_second', ROUND(
+                                    ((:sent + :failed) / GREATEST(EXTRACT(EPOCH FROM (NOW() - created_at)), 0.001))::NUMERIC, 2)
+                            ),
+                            updated_at = NOW()
+                        WHERE run_id = :run_id AND status = 'running'
+                        RETURNING run_id
+                    """),
+                    {"run_id": run_id, "sent": counts.sent, "failed": counts.failed}
+                ).fetchone()
+                just_completed = completed is not None
+
+            row = conn.execute(
+                text("SELECT * FROM broadcast_runs WHERE run_id = :run_id"),
+                {"run_id": run_id}
+            ).fetchone()
+            conn.commit()
+            return dict(row._mapping, open_targets=counts.open, shard_open=counts.shard_open,
+                        just_completed=just_completed)
+
+    def get_broadcast_audience_history(self, days: int = HEALTH_WINDOW_DAYS,
+                                       min_health_score: float = MIN_HEALTH_SCORE) -> List[Dict[str, Any]]:
+        """
+        Current broadcast audience with each group's recent delivery history
+        (sent/failed targets over the last `days`) and failure streak.
+        """
+        with self.get_connection() as conn:
+            result = conn.execute(
+                text(f"""
+                    SELECT mg.group_id,
+                           mg.is_text_only,
+                           COALESCE(mg.consecutive_failures, 0) AS consecutive_failures,
+                           COALESCE(h.sent, 0) AS sent,
+                           COALESCE(h.failed, 0) AS failed
+                    FROM managed_groups mg
+                    LEFT JOIN (
+                        SELECT group_id,
+                               COUNT(*) FILTER (WHERE state = 'sent') AS sent,
+                               COUNT(*) FILTER (WHERE state = 'failed') AS failed
+                        FROM broadcast_targets
+                        WHERE updated_at > NOW() - make_interval(days => :days)
+                        GROUP BY group_id
+                    ) h ON h.group_id = mg.group_id
+                    WHERE {BROADCAST_AUDIENCE_FILTER}
+                    ORDER BY mg.health_score DESC, mg.group_id
+                """),
+                {"days": days, "min_health_score": min_health_score}
+            )
+            return [dict(row._mapping) for row in result.fetchall()]
+
+    def recompute_group_health(self, days: int = HEALTH_WINDOW_DAYS, max_failures: int = 3,
+                               photo_error_limit: int = 2) -> Dict[str, int]:
+        """
+        Bulk fix-up of audience health in one statement: recompute every
+        group's health_score from its delivery history, lift expired
+        disabled_until, and mark groups with repeated photo errors text-only.
+        Only rows whose values change are written.
+
+        Score: Laplace-smoothed sent/(sent+failed) over the last `days`, scaled
+        down by up to half for the current failure streak. A group with no
+        history scores 0.5.
+        """
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("""
+                    WITH history AS (
+                        SELECT group_id,
+                               COUNT(*) FILTER (WHERE state = 'sent') AS sent,
+                               COUNT(*) FILTER (WHERE state = 'failed') AS failed
+                        FROM broadcast_targets
+                        WHERE updated_at > NOW() - make_interval(days => :days)
+                        GROUP BY group_id
+                    ),
+                    scored AS (
+                        SELECT mg.group_id,
+                               ROUND(((COALESCE(h.sent, 0) + 1.0) / (COALESCE(h.sent, 0) + COALESCE(h.failed, 0) + 2.0)
+                                      * (1.0 - 0.5 * LEAST(COALESCE(mg.consecutive_failures, 0), :max_failures)
+                                             / :max_failures))::NUMERIC, 3)::REAL AS score,
+                               -- A manual disable (no disabled_until) never lapses
+                               mg.is_disabled AND COALESCE(mg.disabled_until <= NOW(), false) AS reenable,
+                               NOT mg.is_text_only AND mg.photo_error_count >= :photo_error_limit AS to_text
+                        FROM managed_groups mg
+                        LEFT JOIN history h ON h.group_id = mg.group_id
+                    ),
+                    updated AS (
+                        UPDATE managed_groups m
+                        SET health_score = s.score,
+                            is_disabled = m.is_disabled AND NOT s.reenable,
+                            disabled_until = CASE WHEN s.reenable THEN NULL ELSE m.disabled_until END,
+                            is_text_only = m.is_text_only OR s.to_text,
+                            health_updated_at = NOW()
+                        FROM scored s
+                        WHERE m.group_id = s.group_id
+                          AND (m.health_score IS DISTINCT FROM s.score OR s.reenable OR s.to_text)
+                        RETURNING m.group_id, s.reenable, s.to_text, m.is_active AND m.health_score < :min_score AS excluded
+                    )
+                    SELECT COUNT(*) AS updated,
+                           COUNT(*) FILTER (WHERE reenable) AS reenabled,
+                           COUNT(*) FILTER (WHERE to_text) AS text_only,
+                           COUNT(*) FILTER (WHERE excluded) AS below_threshold
+                    FROM updated
+                """),
+                {"days": days, "max_failures": max_failures, "photo_error_limit": photo_error_limit,
+                 "min_score": MIN_HEALTH_SCORE}
+            ).fetchone()
+            conn.commit()
+            return dict(row._mapping)
+
+    def get_recent_call_latency(self, bot_id: str, method: str, hours: int = 24) -> Optional[float]:
+        """Call-weighted average latency (seconds) of a Bot API method from telegram_call_stats"""
+        try:
+            with self.get_connection() as conn:
+                value = conn.execute(
+                    text("""
+                        SELECT SUM(latency_avg_ms * calls) / NULLIF(SUM(calls), 0)
+                        FROM telegram_call_stats
+                        WHERE bot_id = :bot_id AND method = :method
+                          AND window_end > NOW() - make_interval(hours => :hours)
+                    """),
+                    {"bot_id": bot_id, "method": method, "hours": hours}
+                ).scalar()
+        except Exception as e:
+            logger.warning(f"Could not read call latency for {method}: {e}")
+            return None
+        return float(value) / 1000.0 if value else None
+
+    def save_broadcast_dry_run(self, job_id: Optional[int], payload: Dict[str, Any],
+                               projection: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a dry-run projection as a broadcast_runs row with status 'dry_run'"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("""
+                    INSERT INTO broadcast_runs (job_id, payload, status, total_targets, results, completed_at)
+                    VALUES (:job_id, CAST(:payload AS JSONB), 'dry_run', :total, CAST(:results AS JSONB), NOW())
+                    ON CONFLICT (job_id) DO UPDATE SET
+                        results = EXCLUDED.results,
+                        total_targets = EXCLUDED.total_targets,
+                        updated_at = NOW()
+                    RETURNING *
+                """),
+                {
+                    "job_id": job_id,
+                    "payload": json.dumps(payload),
+                    "total": projection["targets"],
+                    "results": json.dumps(projection),
+                }
+            ).fetchone()
+            conn.commit()
+            return dict(row._mapping)
+
+    def get_broadcast_counts(self, run_id: int) -> Optional[Dict[str, Any]]:
+        """Live target counts of a run plus seconds since it was created"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("""
+                    SELECT r.total_targets AS total,
+                           EXTRACT(EPOCH FROM (NOW() - r.created_at)) AS elapsed,
+                           COUNT(*) FILTER (WHERE t.state = 'sent') AS sent,
+                           COUNT(*) FILTER (WHERE t.state = 'failed') AS failed,
+                           COUNT(*) FILTER (WHERE t.state IN ('pending', 'sending')) AS open
+                    FROM broadcast_runs r
+                    LEFT JOIN broadcast_targets t ON t.run_id = r.run_id
+                    WHERE r.run_id = :run_id
+                    GROUP BY r.run_id
+                """),
+                {"run_id": run_id}
+            ).fetchone()
+            return dict(row._mapping) if row else None
+
+    def set_broadcast_progress(self, run_id: int, progress: Dict[str, Any]):
+        """Publish live progress/ETA for a running broadcast"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    UPDATE broadcast_runs
+                    SET progress = CAST(:progress AS JSONB), updated_at = NOW()
+                    WHERE run_id = :run_id
+                """),
+                {"run_id": run_id, "progress": json.dumps(progress)}
+            )
+            conn.commit()
+
+    def enqueue_job(self, job_type: str, bot_token: str, payload: Dict[str, Any], delay_seconds: int = 0):
+        """Insert a pending job, optionally hidden for delay_seconds (jobs.run_after)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO jobs (job_type, bot_token, payload, status, run_after, created_at, updated_at)
+                    VALUES (:job_type, :bot_token, CAST(:payload AS JSONB), 'pending',
+                            NOW() + make_interval(secs => :delay), NOW(), NOW())
+                """),
+                {
+                    "job_type": job_type,
+                    "bot_token": bot_token,
+                    "payload": json.dumps(payload),
+                    "delay": delay_seconds,
+                }
+            )
+            conn.commit()
+
+    # --- Shared rate limiting ---
+
+    def take_rate_tokens(self, name: str, n: float, rate: float, capacity: float) -> float:
+        """
+        Atomically refill and take n tokens from a shared bucket (rate_limit_buckets).
+
+        Returns:
+            0 if the tokens were taken, else seconds until n tokens will be available
+        """
+        with self.get_connection() as conn:
+            for _ in range(2):
+                row = conn.execute(
+                    text("""
+                        WITH b AS (
+                            SELECT name,
+                                   LEAST(:capacity, tokens + EXTRACT(EPOCH FROM (clock_timestamp() - updated_at)) * :rate)
+                                       AS available
+                            FROM rate_limit_buckets
+                            WHERE name = :name
+                            FOR UPDATE
+                        )
+                        UPDATE rate_limit_buckets r
+                        SET tokens = b.available - CASE WHEN b.available >= :n THEN :n ELSE 0 END,
+                            updated_at = clock_timestamp()
+                        FROM b
+                        WHERE r.name = b.name
+                        RETURNING b.available
+                    """),
+                    {"name": name, "n": n, "rate": rate, "capacity": capacity}
+                ).fetchone()
+                if row is not None:
+                    conn.commit()
+                    available = float(row[0])
+                    return 0.0 if available >= n else (n - available) / rate
+                conn.execute(
+                    text("""
+                        INSERT INTO rate_limit_buckets (name, tokens, updated_at)
+                        VALUES (:name, :capacity, clock_timestamp())
+                        ON CONFLICT (name) DO NOTHING
+                    """),
+                    {"name": name, "capacity": capacity}
+                )
+                conn.commit()
+        return 0.0
+
+    def penalize_rate_bucket(self, name: str, seconds: float, rate: float, capacity: float):
+        """Hold a shared bucket empty for `seconds` (Telegram flood wait seen by any worker)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    UPDATE rate_limit_buckets
+                    SET tokens = LEAST(
+                            LEAST(:capacity, tokens + EXTRACT(EPOCH FROM (clock_timestamp() - updated_at)) * :rate),
+                            -(:seconds * :rate)
+                        ),
+                        updated_at = clock_timestamp()
+                    WHERE name = :name
+                """),
+                {"name": name, "seconds": seconds, "rate": rate, "capacity": capacity}
+            )
+            conn.commit()
+
+    # --- Media file_id cache ---
+
+    def get_media_file_id(self, bot_id: str, source_url: str) -> Optional[str]:
+        """Cached Telegram file_id for a media URL, if this bot has sent it before"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                text("""
+                    UPDATE media_file_ids SET last_used_at = NOW()
+                    WHERE bot_id = :bot_id AND source_url = :source_url
+                    RETURNING file_id
+                """),
+                {"bot_id": bot_id, "source_url": source_url}
+            ).fetchone()
+            conn.commit()
+            return row[0] if row else None
+
+    def upsert_media_file_id(
+        self,
+        bot_id: str,
+        source_url: str,
+        file_id: str,
+        file_unique_id: Optional[str] = None,
+        media_type: str = 'photo',
+    ):
+        """Store the file_id Telegram returned for a media URL"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO media_file_ids (bot_id, source_url, media_type, file_id, file_unique_id)
+                    VALUES (:bot_id, :source_url, :media_type, :file_id, :file_unique_id)
+                    ON CONFLICT (bot_id, source_url) DO UPDATE SET
+                        media_type = EXCLUDED.media_type,
+                        file_id = EXCLUDED.file_id,
+                        file_unique_id = EXCLUDED.file_unique_id,
+                        created_at = NOW(),
+                        last_used_at = NOW()
+                """),
+                {
+                    "bot_id": bot_id,
+                    "source_url": source_url,
+                    "media_type": media_type,
+                    "file_id": file_id,
+                    "file_unique_id": file_unique_id,
+                }
+            )
+            conn.commit()
+
+    def delete_media_file_id(self, bot_id: str, source_url: str):
+        """Forget a file_id Telegram rejected; the next send re-fetches the URL"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("DELETE FROM media_file_ids WHERE bot_id = :bot_id AND source_url = :source_url"),
+                {"bot_id": bot_id, "source_url": source_url}
+            )
+            conn.commit()
+
+    # --- Health ---
+
+    def update_bot_health(self, bot_name: str, status: str, last_activity: str = None):
+        """Upsert a bot_health row (status: healthy, degraded, down)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO bot_health (bot_name, status, last_activity, updated_at)
+                    VALUES (:bot_name, :status, :last_activity, NOW())
+                    ON CONFLICT (bot_name) DO UPDATE SET
+                        status = EXCLUDED.status,
+                        last_activity = EXCLUDED.last_activity,
+                        updated_at = NOW()
+                """),
+                {"bot_name": bot_name[:50], "status": status, "last_activity": last_activity}
+            )
+            conn.commit()
+
+    def insert_telegram_call_stats(self, rows: List[Dict[str, Any]]):
+        """Insert Telegram call summary rows (see telegram_metrics.py)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO telegram_call_stats (
+                        source, bot_id, method, window_start, window_end, calls, errors, retries,
+                        bytes_sent, latency_avg_ms, latency_p50_ms, latency_p95_ms, latency_p99_ms,
+                        latency_max_ms, latency_buckets, status_codes, error_codes, retry_counts
+                    ) VALUES (
+                        :source, :bot_id, :method, :window_start, :window_end, :calls, :errors, :retries,
+                        :bytes_sent, :latency_avg_ms, :latency_p50_ms, :latency_p95_ms, :latency_p99_ms,
+                        :latency_max_ms, CAST(:latency_buckets AS JSONB), CAST(:status_codes AS JSONB),
+                        CAST(:error_codes AS JSONB), CAST(:retry_counts AS JSONB)
+                    )
+                """),
+                [
+                    dict(row,
+                         latency_buckets=json.dumps(row['latency_buckets']),
+                         status_codes=json.dumps(row['status_codes']),
+                         error_codes=json.dumps(row['error_codes']),
+                         retry_counts=json.dumps(row['retry_counts']))
+                    for row in rows
+                ]
+            )
+            conn.commit()
+
+    def insert_send_rate_stats(self, rows: List[Dict[str, Any]]):
+        """Insert send rate controller summary rows (see rate_controller.py)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO send_rate_stats (
+                        source, bot_id, window_start, window_end, samples, rate_avg, rate_min, rate_max,
+                        rate_last, max_rate, ceiling_share, increases, backoffs_429, backoffs_latency
+                    ) VALUES (
+                        :source, :bot_id, :window_start, :window_end, :samples, :rate_avg, :rate_min, :rate_max,
+                        :rate_last, :max_rate, :ceiling_share, :increases, :backoffs_429, :backoffs_latency
+                    )
+                """),
+                rows
+            )
+            conn.commit()
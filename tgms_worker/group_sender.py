@@ -2,122 +2,167 @@
 Group message sender with rate limiting
 Handles broadcasting to managed groups
 """
-import time
-import secrets
+import os
+import socket
+import asyncio
 import logging
-from typing import List, Dict, Any
-from telegram_api import TelegramAPI
+from typing import Dict, Any, Optional
 from database import DatabaseManager
+from broadcast_engine import BroadcastEngine
+from circuit_breaker import CircuitOpenError
+from broadcast_simulator import project_broadcast, live_progress
 
 logger = logging.getLogger(__name__)
 
+# Targets claimed per round trip; smaller chunks spread a run across more workers
+CLAIM_CHUNK_SIZE = int(os.environ.get('TGMS_BROADCAST_CHUNK', '500'))
+# A 'sending' claim older than this belongs to a crashed worker and is reclaimed
+CLAIM_TIMEOUT = int(os.environ.get('TGMS_CLAIM_TIMEOUT', '300'))
+MAX_CLAIMS = 3
+# Split each broadcast into this many shard jobs so several TGMS workers send in parallel
+BROADCAST_SHARDS = int(os.environ.get('TGMS_BROADCAST_SHARDS', '1'))
+# hash: shard = hash(group_id) % TGMS_BROADCAST_SHARDS; chunk: TGMS_SHARD_SIZE consecutive groups per shard
+SHARD_MODE = os.environ.get('TGMS_SHARD_MODE', 'hash').lower()
+SHARD_SIZE = int(os.environ.get('TGMS_SHARD_SIZE', '1000'))
+
 
 class GroupMessageSender:
     """Sends messages to managed groups with rate limiting"""
     
     def __init__(self, bot_token: str, db_manager: DatabaseManager):
-        self.api = TelegramAPI(bot_token)
+        self.bot_token = bot_token
         self.db = db_manager
-        self.rate_limit = 5  # messages per second
-        self.last_send_time = 0
-        self.max_consecutive_failures = 3
-    
-    def _generate_debug_code(self) -> str:
-        """Generate unique debug code"""
-        return f"DBG:{secrets.token_hex(3).upper()}"
-    
-    def _rate_limit_delay(self):
-        """Apply rate limiting"""
-        now = time.time()
-        time_since_last = now - self.last_send_time
-        min_interval = 1.0 / self.rate_limit
-        
-        if time_since_last < min_interval:
-            time.sleep(min_interval - time_since_last)
-        
-        self.last_send_time = time.time()
+        self.engine = BroadcastEngine(bot_token, db_manager)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"[:100]
     
-    def send_to_groups(self, photo_url: str = None, caption: str = None, text: str = None):
+    async def send_to_groups(self, photo_url: str = None, caption: str = None, text: str = None,
+                             job_id: Optional[int] = None, shards: Optional[int] = None,
+                             shard_mode: Optional[str] = None) -> Dict[str, Any]:
         """
         Send message to all active managed groups
         
+        Creates (or, when the job is retried, resumes) the job's broadcast run
+        and drains it. A sharded run enqueues one tgms_broadcast_shard job per
+        extra shard and this job drains shard 0.
+        
         Args:
             photo_url: URL of photo to send
             caption: Caption for photo
             text: Text message (if no photo)
+            job_id: Job that owns the broadcast run
+            shards: Shard count for hash mode (default TGMS_BROADCAST_SHARDS)
+            shard_mode: 'hash' or 'chunk' (default TGMS_SHARD_MODE)
         
         Returns:
-            Dict with success count and failed groups
-        """
-        groups = self.db.get_active_managed_groups()
-        results = {
-            "total": len(groups),
-            "success": 0,
-            "failed": [],
-            "sent_to": []
-        }
+            Dict with this worker's send results plus the run's overall progress
         
-        logger.info(f"Sending message to {len(groups)} groups")
+        Raises:
+            TemplateError: the message template is invalid (checked before any target is created)
+        """
+        self.engine.compile_templates(photo_url, caption, text)
+        payload = {"photo_url": photo_url, "caption": caption, "text": text}
+        run = self.db.create_broadcast_run(
+            job_id,
+            payload,
+            shard_count=shards or BROADCAST_SHARDS,
+            shard_mode=shard_mode or SHARD_MODE,
+            shard_size=SHARD_SIZE,
+            shard_job_bot_token=self.bot_token,
+        )
+        shard = 0 if run["shard_count"] > 1 else None
+        return await self.drain_run(run["run_id"], shard=shard)
+    
+    async def dry_run(self, photo_url: str = None, caption: str = None, text: str = None,
+                      job_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Project a broadcast without sending: same audience, rate limits and
+        per-group failure history. Stored as a 'dry_run' broadcast run.
+        The message template is validated as for a real send.
+        """
+        self.engine.compile_templates(photo_url, caption, text)
+        payload = {"photo_url": photo_url, "caption": caption, "text": text, "dry_run": True}
+        projection = await asyncio.to_thread(
+            project_broadcast, self.db, self.engine.bot_label, bool(photo_url), self.engine.current_rate,
+            self.engine.concurrency
+        )
+        run = self.db.save_broadcast_dry_run(job_id, payload, projection)
+        return dict(projection, run_id=run["run_id"])
+    
+    def publish_progress(self, run_id: int):
+        """Write live progress/ETA for a run (called from the engine's flush loop)"""
+        try:
+            counts = self.db.get_broadcast_counts(run_id)
+            if counts:
+                progress = live_progress(
+                    counts["total"], counts["sent"], counts["failed"], counts["open"], float(counts["elapsed"]),
+                    rate=self.engine.current_rate, concurrency=self.engine.concurrency,
+                )
+                self.db.set_broadcast_progress(run_id, progress)
+        except Exception as e:
+            logger.warning(f"Could not publish progress for run {run_id}: {e}")
+    
+    async def drain_run(self, run_id: int, shard: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Claim and send chunks of a run's targets (one shard's, or any) until
+        none are left to claim. Any number of workers can drain the same run
+        in parallel; the one that finishes it writes the aggregated results.
+        """
+        run = self.db.get_broadcast_run(run_id)
+        if not run:
+            raise ValueError(f"Broadcast run {run_id} not found")
+        payload = run["payload"]
         
-        for group in groups:
-            group_id = group["group_id"]
-            
-            # Check if final message allowed
-            if not group.get("final_message_allowed", True):
-                logger.debug(f"Skipping group {group_id} - final_message_allowed=False")
-                continue
+        totals = {"run_id": run_id, "shard": shard, "success": 0, "failed": [], "requests": 0,
+                  "rate_limited": 0, "duration_seconds": 0.0}
+        while True:
+            targets = self.db.claim_broadcast_targets(
+                run_id, self.worker_id, CLAIM_CHUNK_SIZE, CLAIM_TIMEOUT, MAX_CLAIMS, shard
+            )
+            if not targets:
+                break
+            logger.info(f"Run {run_id}: claimed {len(targets)} targets" + (f" from shard {shard}" if shard is not None else ""))
             
-            # Apply rate limiting
-            self._rate_limit_delay()
-            
-            # Generate debug code
-            debug_code = self._generate_debug_code()
-            
-            # Add debug code to message
-            if caption:
-                caption_with_debug = f"{caption}\n\n{debug_code}"
-            elif text:
-                text = f"{text}\n\n{debug_code}"
-            
-            # Send message
             try:
-                if photo_url:
-                    response = self.api.send_photo(
-                        chat_id=group_id,
-                        photo=photo_url,
-                        caption=caption_with_debug if caption else debug_code,
-                        parse_mode="Markdown"
-                    )
-                else:
-                    response = self.api.send_message(
-                        chat_id=group_id,
-                        text=text,
-                        parse_mode="Markdown"
-                    )
-                
-                if response.get("ok"):
-                    message_id = response.get("result", {}).get("message_id")
-                    self.db.log_sent_message(group_id, message_id, debug_code)
-                    self.db.reset_failure_count(group_id)
-                    results["success"] += 1
-                    results["sent_to"].append(group_id)
-                    logger.info(f"✓ Sent to group {group_id} ({debug_code})")
-                else:
-                    raise Exception(response.get("error", "Unknown error"))
-                    
-            except Exception as e:
-                logger.error(f"✗ Failed to send to group {group_id}: {e}")
-                failure_count = self.db.increment_failure_count(group_id)
-                
-                # Deactivate after max failures
-                if failure_count >= self.max_consecutive_failures:
-                    self.db.deactivate_group(group_id, f"3 consecutive failures: {e}")
-                    logger.warning(f"Deactivated group {group_id} after {failure_count} failures")
-                
-                results["failed"].append({"group_id": group_id, "error": str(e)})
+                results = await self.engine.broadcast(
+                    targets,
+                    photo_url=payload.get("photo_url"),
+                    caption=payload.get("caption"),
+                    text=payload.get("text"),
+                    run_id=run_id,
+                    on_progress=lambda: self.publish_progress(run_id),
+                )
+            except CircuitOpenError:
+                released = self.db.release_broadcast_claims(run_id, self.worker_id)
+                logger.warning(f"Run {run_id}: Telegram unavailable, released {released} claimed targets")
+                raise
             
-            # Add spacing between groups
-            time.sleep(3)
+            for key in ("success", "requests", "rate_limited", "duration_seconds"):
+                totals[key] += results[key]
+            totals["failed"].extend(results["failed"])
+        
+        run = self.db.finish_broadcast_run(run_id, CLAIM_TIMEOUT, MAX_CLAIMS, shard)
+        await asyncio.to_thread(self.publish_progress, run_id)
+        duration = totals["duration_seconds"]
+        totals.update(
+            total=run["total_targets"],
+            sent_count=run["sent_count"],
+            failed_count=run["failed_count"],
+            open_targets=run["open_targets"],
+            completed=run["status"] == "completed",
+            duration_seconds=round(duration, 2),
+            messages_per_second=round(totals["requests"] / duration, 2) if duration else 0.0,
+        )
+        
+        totals["results"] = run.get("results")
         
-        logger.info(f"Broadcast complete: {results['success']}/{results['total']} successful")
-        return results
+        if run["shard_open"]:
+            # This shard's remaining targets are claimed elsewhere; check back once those claims could go stale
+            self.db.enqueue_job("tgms_drain_broadcast", self.bot_token, {"run_id": run_id, "shard": shard}, CLAIM_TIMEOUT)
+            logger.info(f"Run {run_id}: {run['shard_open']} targets still in flight elsewhere; drain re-queued")
+        elif run["just_completed"]:
+            logger.info(f"Run {run_id} completed: {run['results']}")
+            # Fold this run's outcomes into audience health before the next broadcast
+            self.db.enqueue_job("tgms_recompute_group_health", self.bot_token, {"run_id": run_id})
+        elif not totals["completed"]:
+            logger.info(f"Run {run_id}: shard {shard} done, {run['open_targets']} targets left in other shards")
+        return totals
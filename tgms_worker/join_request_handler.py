@@ -5,6 +5,7 @@ Auto-approves join requests for managed groups
 import logging
 from telegram_api import TelegramAPI
 from database import DatabaseManager
+from circuit_breaker import CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +59,9 @@ class JoinRequestHandler:
                 self.db.update_join_request_status_by_user_chat(user_id, chat_id, 'failed')
                 return False
         
+        except CircuitOpenError:
+            # Leave the request pending; the job is deferred and retried later
+            raise
         except Exception as e:
             logger.error(f"Error processing join request: {e}", exc_info=True)
             # Mark as failed if DB insert already happened
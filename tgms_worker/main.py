@@ -15,6 +15,8 @@ from database import DatabaseManager
 from telegram_api import TelegramAPI
 from group_sender import GroupMessageSender
 from join_request_handler import JoinRequestHandler
+from circuit_breaker import CircuitOpenError, write_breaker_health
+from telegram_metrics import telegram_metrics
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -24,6 +26,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 POLLING_INTERVAL = 2  # seconds
+MAX_DEFER_SECONDS = 300  # cap for backoff of jobs deferred by an open circuit
 
 
 async def process_tgms_job(job, db_manager, telegram_api, group_sender, join_handler):
@@ -33,6 +36,9 @@ async def process_tgms_job(job, db_manager, telegram_api, group_sender, join_han
     Job types:
     - process_join_request: Auto-approve join requests
     - send_to_groups: Broadcast message to managed groups
+    - drain_broadcast: Help send the remaining targets of a broadcast run
+    - broadcast_shard: Send one shard of a sharded broadcast run
+    - recompute_group_health: Bulk refresh of group health scores/flags
     - update_member_counts: Update member counts for all groups
     - kick_inactive_members: Kick inactive members from groups
     """
@@ -127,20 +133,57 @@ async def process_tgms_job(job, db_manager, telegram_api, group_sender, join_han
             logger.info(f"Registered managed group {chat_id} ({title})")
             return True
 
+        elif job_type == 'send_to_groups' and payload.get('dry_run'):
+            # Projection only: nothing is sent
+            projection = await group_sender.dry_run(
+                photo_url=payload.get('photo_url'),
+                caption=payload.get('caption'),
+                text=payload.get('text'),
+                job_id=job_id,
+            )
+            logger.info(f"Dry run stored as broadcast run {projection['run_id']}")
+            return True
+        
         elif job_type == 'send_to_groups':
-            # Broadcast message to all managed groups
-            photo_url = payload.get('photo_url')
-            caption = payload.get('caption')
-            text = payload.get('text')
-            
-            results = group_sender.send_to_groups(
-                photo_url=photo_url,
-                caption=caption,
-                text=text
+            # Broadcast message to all managed groups (resumes the job's run if retried)
+            results = await group_sender.send_to_groups(
+                photo_url=payload.get('photo_url'),
+                caption=payload.get('caption'),
+                text=payload.get('text'),
+                job_id=job_id,
+                shards=payload.get('shards'),
+                shard_mode=payload.get('shard_mode'),
             )
             
-            logger.info(f"Broadcast results: {results['success']}/{results['total']} successful")
-            return results['success'] > 0
+            logger.info(
+                f"Broadcast run {results['run_id']}: {results['sent_count']}/{results['total']} sent so far; "
+                f"this worker sent {results['success']} in {results['duration_seconds']}s "
+                f"({results['messages_per_second']} msgs/sec)"
+            )
+            # Every target reached a final state or is owned by another worker; retrying would send nothing
+            return True
+        
+        elif job_type in ('drain_broadcast', 'broadcast_shard'):
+            # Help drain (or resume) an existing broadcast run, optionally one shard of it
+            run_id = payload.get('run_id')
+            if not run_id:
+                logger.error(f"{job_type} job missing run_id")
+                return False
+            results = await group_sender.drain_run(run_id, shard=payload.get('shard'))
+            logger.info(
+                f"Drained broadcast run {run_id} (shard {payload.get('shard')}): "
+                f"this worker sent {results['success']} in {results['duration_seconds']}s"
+            )
+            return True
+        
+        elif job_type == 'recompute_group_health':
+            # Queued after every completed broadcast; can also be enqueued by hand
+            counts = db_manager.recompute_group_health()
+            logger.info(
+                f"Group health recomputed: {counts['updated']} updated, {counts['reenabled']} re-enabled, "
+                f"{counts['text_only']} switched to text-only, {counts['below_threshold']} below threshold"
+            )
+            return True
         
         elif job_type == 'update_member_counts':
             # Update member counts for all active groups
@@ -156,6 +199,9 @@ async def process_tgms_job(job, db_manager, telegram_api, group_sender, join_han
             logger.warning(f"Unknown TGMS job_type: {job_type}")
             return False
     
+    except CircuitOpenError:
+        # Let the main loop defer the job without consuming a retry
+        raise
     except Exception as e:
         logger.error(f"Error processing TGMS job {job_id}: {e}", exc_info=True)
         return False
@@ -173,10 +219,31 @@ async def update_member_counts(db_manager: DatabaseManager, telegram_api: Telegr
             db_manager.update_member_count(group_id, count)
             logger.info(f"Group {group_id}: {count} members")
             await asyncio.sleep(1)  # Rate limiting
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error(f"Failed to update member count for group {group_id}: {e}")
 
 
+def defer_job(session, job, error: CircuitOpenError):
+    """
+    Put a job back in the queue without consuming a retry, hidden until the
+    circuit is expected to close. Repeated deferrals back off exponentially.
+    """
+    deferrals = job.get('deferrals') or 0
+    delay = min(MAX_DEFER_SECONDS, max(error.retry_after, POLLING_INTERVAL) * (2 ** deferrals))
+    session.execute(text("""
+        UPDATE jobs
+        SET status = 'pending',
+            deferrals = COALESCE(deferrals, 0) + 1,
+            run_after = NOW() + make_interval(secs => :delay),
+            updated_at = :now
+        WHERE job_id = :job_id
+    """), {'delay': delay, 'now': datetime.now(timezone.utc), 'job_id': job['job_id']})
+    session.commit()
+    logger.warning(f"Job {job['job_id']} deferred {delay:.0f}s: {error}")
+
+
 async def worker_main_loop(session_factory, db_manager, telegram_api, group_sender, join_handler, run_once=False):
     """
     Main loop for TGMS worker
@@ -195,6 +262,7 @@ async def worker_main_loop(session_factory, db_manager, telegram_api, group_send
                 SELECT * FROM jobs
                 WHERE status = 'pending'
                   AND bot_token = :bot_token
+                  AND (run_after IS NULL OR run_after <= NOW())
                 ORDER BY created_at
                 LIMIT 1
                 FOR UPDATE SKIP LOCKED
@@ -217,13 +285,18 @@ async def worker_main_loop(session_factory, db_manager, telegram_api, group_send
             
             # Process the job
             if job_to_process:
-                success = await process_tgms_job(
-                    job_to_process,
-                    db_manager,
-                    telegram_api,
-                    group_sender,
-                    join_handler
-                )
+                try:
+                    success = await process_tgms_job(
+                        job_to_process,
+                        db_manager,
+                        telegram_api,
+                        group_sender,
+                        join_handler
+                    )
+                except CircuitOpenError as e:
+                    defer_job(session, job_to_process, e)
+                    write_breaker_health(db_manager, force=True)
+                    continue
                 
                 # Update job status
                 retries = job_to_process.get('retries', 0)
@@ -249,6 +322,9 @@ async def worker_main_loop(session_factory, db_manager, telegram_api, group_send
                 session.commit()
                 logger.info(f"Job {job_to_process['job_id']} finished with status: {final_status}")
                 
+                write_breaker_health(db_manager)
+                telegram_metrics.flush(db_manager, force=run_once)
+
                 if run_once:
                     break
             else:
@@ -260,6 +336,7 @@ async def worker_main_loop(session_factory, db_manager, telegram_api, group_send
                     await asyncio.sleep(1)
                     continue
                 
+                telegram_metrics.flush(db_manager)
                 await asyncio.sleep(POLLING_INTERVAL)
         
         except Exception as e:
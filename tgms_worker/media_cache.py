@@ -0,0 +1,94 @@
+"""
+Telegram file_id cache for broadcast media
+Maps a source URL to the file_id Telegram returned when it first fetched the
+URL for this bot, so later sends reference the stored file instead of making
+Telegram download the image again. file_ids are only valid for the bot that
+received them, hence one cache per bot.
+"""
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Telegram descriptions that mean a stored file_id can no longer be used
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference",
+    "file_id",
+    "wrong type of the web page content",
+)
+
+# Telegram descriptions that mean the group does not accept photos from the bot
+PHOTO_FORBIDDEN_ERRORS = (
+    "not enough rights to send photos",
+    "chat_send_photos_forbidden",
+    "chat_send_media_forbidden",
+)
+
+
+def extract_file_id(result: Dict[str, Any], media_type: str = "photo"):
+    """(file_id, file_unique_id) of the largest size in a sendPhoto/sendX result"""
+    media = (result or {}).get(media_type)
+    if isinstance(media, list):
+        media = media[-1] if media else None
+    if not media:
+        return None, None
+    return media.get("file_id"), media.get("file_unique_id")
+
+
+def is_file_id_error(description: str) -> bool:
+    """True if a 400 description points at a stale or foreign file_id"""
+    description = (description or "").lower()
+    return any(marker in description for marker in FILE_ID_ERRORS)
+
+
+def is_photo_forbidden(description: str) -> bool:
+    """True if a 400/403 description says the chat refuses photos (text still allowed)"""
+    description = (description or "").lower()
+    return any(marker in description for marker in PHOTO_FORBIDDEN_ERRORS)
+
+
+class MediaCache:
+    """source URL -> file_id for one bot; in-process dict backed by media_file_ids"""
+
+    def __init__(self, db_manager, bot_id: str):
+        self.db = db_manager
+        self.bot_id = bot_id
+        self._file_ids: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, source_url: str) -> Optional[str]:
+        with self._lock:
+            if source_url in self._file_ids:
+                return self._file_ids[source_url]
+        try:
+            file_id = self.db.get_media_file_id(self.bot_id, source_url)
+        except Exception as e:
+            logger.warning(f"Could not read cached file_id for {source_url}: {e}")
+            return None
+        if file_id:
+            with self._lock:
+                self._file_ids[source_url] = file_id
+        return file_id
+
+    def remember(self, source_url: str, file_id: str, file_unique_id: str = None, media_type: str = "photo"):
+        with self._lock:
+            if self._file_ids.get(source_url) == file_id:
+                return
+            self._file_ids[source_url] = file_id
+        try:
+            self.db.upsert_media_file_id(self.bot_id, source_url, file_id, file_unique_id, media_type)
+            logger.info(f"Cached file_id for {source_url}")
+        except Exception as e:
+            logger.warning(f"Could not store file_id for {source_url}: {e}")
+
+    def invalidate(self, source_url: str, reason: str = None):
+        with self._lock:
+            self._file_ids.pop(source_url, None)
+        try:
+            self.db.delete_media_file_id(self.bot_id, source_url)
+            logger.warning(f"Invalidated cached file_id for {source_url}: {reason}")
+        except Exception as e:
+            logger.warning(f"Could not invalidate file_id for {source_url}: {e}")
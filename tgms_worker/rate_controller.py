@@ -0,0 +1,121 @@
+"""
+Adaptive send rate for TGMS (AIMD)
+One controller per bot token, fed by every Bot API response: the rate grows
+additively while responses are clean and is cut multiplicatively on 429s or
+latency spikes, always within [TGMS_RATE_MIN, TGMS_RATE_MAX]. Broadcasts pace
+on it; decisions are exported through telegram_metrics (send_rate_stats).
+"""
+import os
+import time
+import logging
+import threading
+
+from telegram_metrics import telegram_metrics
+
+logger = logging.getLogger(__name__)
+
+# Starting rate for a bot; TGMS_BROADCAST_RATE kept its meaning as the default send rate
+INITIAL_RATE = float(os.environ.get('TGMS_BROADCAST_RATE', '25'))
+RATE_MIN = float(os.environ.get('TGMS_RATE_MIN', '1'))
+# Telegram allows ~30 msgs/sec per bot across chats
+RATE_MAX = float(os.environ.get('TGMS_RATE_MAX', '30'))
+# msgs/sec added after each second's worth of clean responses
+RATE_INCREASE = float(os.environ.get('TGMS_RATE_INCREASE', '1'))
+# Multiplier applied on a 429
+RATE_BACKOFF = float(os.environ.get('TGMS_RATE_BACKOFF', '0.5'))
+# Multiplier applied on a latency spike (gentler: Telegram is slowing down, not refusing)
+LATENCY_BACKOFF = float(os.environ.get('TGMS_LATENCY_BACKOFF', '0.8'))
+# A response is a spike above this absolute latency, or this many times the running average
+LATENCY_SPIKE_MS = float(os.environ.get('TGMS_LATENCY_SPIKE_MS', '2000'))
+LATENCY_SPIKE_FACTOR = 4.0
+# Responses to requests already in flight don't cut the rate again within this window
+BACKOFF_COOLDOWN = 1.0
+LATENCY_EWMA_ALPHA = 0.1
+
+INCREASE = 'increase'
+HOLD = 'hold'
+BACKOFF_429 = 'backoff_429'
+BACKOFF_LATENCY = 'backoff_latency'
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease send rate for one bot.
+    Thread-safe; the sync TelegramAPI and the async engine share one instance.
+    """
+
+    def __init__(self, name: str, min_rate: float = RATE_MIN, max_rate: float = RATE_MAX,
+                 initial_rate: float = INITIAL_RATE, increase: float = RATE_INCREASE,
+                 backoff: float = RATE_BACKOFF, latency_backoff: float = LATENCY_BACKOFF,
+                 latency_spike_ms: float = LATENCY_SPIKE_MS, cooldown: float = BACKOFF_COOLDOWN):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.latency_spike_ms = latency_spike_ms
+        self.cooldown = cooldown
+
+        self.rate = min(max(initial_rate, self.min_rate), self.max_rate)
+        self.latency_avg_ms = None
+        self._clean = 0
+        self._last_backoff = 0.0
+        self._lock = threading.Lock()
+
+    def on_success(self, latency_s: float):
+        """A non-429 response from Telegram (any 2xx/4xx)"""
+        latency_ms = latency_s * 1000.0
+        with self._lock:
+            spike = latency_ms >= self.latency_spike_ms or (
+                self.latency_avg_ms is not None and latency_ms >= LATENCY_SPIKE_FACTOR * self.latency_avg_ms
+            )
+            if self.latency_avg_ms is None:
+                self.latency_avg_ms = latency_ms
+            else:
+                self.latency_avg_ms += LATENCY_EWMA_ALPHA * (latency_ms - self.latency_avg_ms)
+
+            if spike:
+                decision = self._decrease(self.latency_backoff, BACKOFF_LATENCY)
+            else:
+                self._clean += 1
+                decision = HOLD
+                # One step per second's worth of clean responses at the current rate
+                if self._clean >= self.rate and self.rate < self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + self.increase)
+                    self._clean = 0
+                    decision = INCREASE
+            rate = self.rate
+        telegram_metrics.observe_rate(self.name, rate, self.max_rate, decision)
+
+    def on_throttle(self, retry_after: float = None):
+        """A 429 from Telegram"""
+        with self._lock:
+            decision = self._decrease(self.backoff, BACKOFF_429)
+            rate = self.rate
+        if decision != HOLD:
+            logger.warning(
+                f"Send rate for bot {self.name} cut to {rate:.1f} msgs/sec (429, retry_after {retry_after})"
+            )
+        telegram_metrics.observe_rate(self.name, rate, self.max_rate, decision)
+
+    def _decrease(self, factor: float, reason: str) -> str:
+        self._clean = 0
+        now = time.monotonic()
+        if now - self._last_backoff < self.cooldown:
+            return HOLD
+        self._last_backoff = now
+        self.rate = max(self.min_rate, self.rate * factor)
+        return reason
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_rate_controller(bot_id: str, **kwargs) -> AIMDController:
+    """Get or create the process-wide send rate controller for a bot."""
+    with _controllers_lock:
+        if bot_id not in _controllers:
+            _controllers[bot_id] = AIMDController(bot_id, **kwargs)
+        return _controllers[bot_id]
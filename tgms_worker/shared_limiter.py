@@ -0,0 +1,83 @@
+"""
+Token buckets shared across TGMS worker processes
+The broadcast engine paces each process locally; when several processes work
+on broadcasts at once they also draw from one bucket per bot, so the combined
+send rate stays within Telegram's global limit. Tokens are leased in small
+blocks to keep the shared store off the per-message path.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# memory: one process only (tests, single worker); postgres: rate_limit_buckets table
+RATE_LIMITER_BACKEND = os.environ.get('TGMS_RATE_LIMITER', 'memory').lower()
+# Burst the shared bucket allows, in seconds of traffic (see broadcast_engine.LEASE_SECONDS);
+# bucket_capacity() keeps room for a one-token lease at low rates
+BUCKET_BURST_SECONDS = 0.25
+
+
+def bucket_capacity(rate: float) -> float:
+    """Tokens a bucket holds at `rate`; never below one lease of a single token, even under 4 msg/s"""
+    return max(1.0, rate * BUCKET_BURST_SECONDS)
+
+
+class MemoryTokenBucket:
+    """In-process stand-in for the shared bucket"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # name -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def _refill(self, name: str, rate: float, now: float) -> float:
+        capacity = bucket_capacity(rate)
+        tokens, updated_at = self._buckets.get(name, (capacity, now))
+        return min(capacity, tokens + (now - updated_at) * rate)
+
+    def take(self, name: str, n: float, rate: float) -> float:
+        """Take n tokens; returns 0 on success, else seconds until they are available"""
+        with self._lock:
+            now = time.monotonic()
+            tokens = self._refill(name, rate, now)
+            if tokens >= n:
+                self._buckets[name] = (tokens - n, now)
+                return 0.0
+            self._buckets[name] = (tokens, now)
+            return (n - tokens) / rate
+
+    def penalize(self, name: str, seconds: float, rate: float):
+        """Empty the bucket for `seconds` (Telegram flood wait applies to every process)"""
+        with self._lock:
+            now = time.monotonic()
+            # Not cumulative: every process reports the same flood wait
+            tokens = min(self._refill(name, rate, now), -seconds * rate)
+            self._buckets[name] = (tokens, now)
+
+
+class PostgresTokenBucket:
+    """Bucket state in rate_limit_buckets; every take is one atomic UPDATE"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+
+    def take(self, name: str, n: float, rate: float) -> float:
+        return self.db.take_rate_tokens(name, n, rate, bucket_capacity(rate))
+
+    def penalize(self, name: str, seconds: float, rate: float):
+        self.db.penalize_rate_bucket(name, seconds, rate, bucket_capacity(rate))
+
+
+_memory_bucket = MemoryTokenBucket()
+
+
+def get_token_bucket(db_manager=None, backend: str = None):
+    """Shared bucket for the configured backend (TGMS_RATE_LIMITER)"""
+    backend = (backend or RATE_LIMITER_BACKEND)
+    if backend == 'postgres' and db_manager is not None:
+        return PostgresTokenBucket(db_manager)
+    if backend != 'memory':
+        logger.warning(f"Unknown or unavailable rate limiter backend '{backend}', using memory")
+    return _memory_bucket
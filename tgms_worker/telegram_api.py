@@ -1,33 +1,111 @@
 """
 Simplified Telegram API handler for TGMS worker
 """
+import os
 import requests
 import logging
 import time
 
+from circuit_breaker import get_breaker
+from telegram_metrics import telegram_metrics
+from rate_controller import get_rate_controller
+
 logger = logging.getLogger(__name__)
 
+# Point at a mock server (see mock_telegram_api.py) for benchmarks and offline runs
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# Short flood waits (429 retry_after) are retried in place; longer ones are returned to the caller
+MAX_RETRIES = 2
+MAX_RETRY_AFTER = 5  # seconds
+
+
+def _json_or_none(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def _retry_after(body) -> int:
+    """retry_after from a 429 body (defaults to 1s)"""
+    return ((body or {}).get('parameters') or {}).get('retry_after', 1)
+
 
 class TelegramAPI:
     """Simple Telegram Bot API wrapper"""
     
-    def __init__(self, bot_token: str):
+    def __init__(self, bot_token: str, api_url: str = None):
         self.bot_token = bot_token
-        self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.api_url = (api_url or TELEGRAM_API_URL).rstrip('/')
+        self.base_url = f"{self.api_url}/bot{bot_token}"
         self.session = requests.Session()
+        self.bot_label = bot_token.split(':')[0]
+        # One breaker per bot, shared by every TelegramAPI instance in the process
+        self.breaker = get_breaker(f"telegram:{self.bot_label}")
+        # Send rate controller shared with the broadcast engine; every response feeds it
+        self.rate_controller = get_rate_controller(self.bot_label)
         self.bot_id = None
         self.refresh_bot_identity()
 
     def _request(self, method: str, **kwargs):
-        """Make API request with error handling"""
+        """
+        Make API request with error handling.
+        Short 429 flood waits are retried in place; latency/status metrics are recorded.
+        Raises CircuitOpenError (instead of returning an error dict) while the breaker is open.
+        """
         url = f"{self.base_url}/{method}"
+        retries = 0
+        started = time.perf_counter()
+        while True:
+            self.breaker.before_call()
+            try:
+                response = self.session.post(url, json=kwargs, timeout=30)
+            except requests.RequestException as e:
+                self.breaker.record_failure(e)
+                telegram_metrics.observe(self.bot_label, method, time.perf_counter() - started, retries=retries)
+                logger.error(f"API request failed: {method} - {e}")
+                return {"ok": False, "error": str(e)}
+
+            if response.status_code >= 500:
+                self.breaker.record_failure(f"{method}: HTTP {response.status_code}")
+            else:
+                # 4xx means Telegram is up and rejected this particular call. A 429 is paced
+                # out by retry_after and the rate controller, not a sign that Telegram is down
+                self.breaker.record_success()
+
+            body = _json_or_none(response)
+            if response.status_code == 429:
+                self.rate_controller.on_throttle(_retry_after(body))
+            elif response.status_code < 500:
+                self.rate_controller.on_success(response.elapsed.total_seconds())
+            if (response.status_code == 429 and retries < MAX_RETRIES
+                    and _retry_after(body) <= MAX_RETRY_AFTER):
+                retries += 1
+                logger.warning(f"{method} rate limited, retrying in {_retry_after(body)}s (attempt {retries})")
+                time.sleep(_retry_after(body))
+                continue
+            break
+
+        telegram_metrics.observe(
+            self.bot_label,
+            method,
+            time.perf_counter() - started,
+            status=response.status_code,
+            error_code=(body or {}).get('error_code', response.status_code) if response.status_code >= 400 else None,
+            bytes_sent=len(response.request.body or b''),
+            retries=retries,
+        )
+
         try:
-            response = self.session.post(url, json=kwargs, timeout=30)
             response.raise_for_status()
-            return response.json()
+            return body if body is not None else response.json()
         except Exception as e:
             logger.error(f"API request failed: {method} - {e}")
-            return {"ok": False, "error": str(e)}
+            result = {"ok": False, "error": str(e)}
+            if body:
+                # Keep Telegram's error details (error_code, parameters.retry_after) for callers
+                result.update({k: body[k] for k in ('error_code', 'description', 'parameters') if k in body})
+            return result
 
     def get_me(self):
         """Fetch basic bot information."""
@@ -0,0 +1,214 @@
+"""
+Telegram Bot API call instrumentation for the TGMS worker
+Per-method, per-bot latency histograms, status/error_code counters, bytes and retries
+"""
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS_MS = (25, 50, 100, 200, 350, 500, 750, 1000, 2000, 5000, 10000, 30000)
+# Log every call slower than this (0 disables the slow-call log)
+SLOW_CALL_MS = float(os.environ.get('TELEGRAM_SLOW_CALL_MS', '0'))
+# How often a summary row per (bot, method) is written to telegram_call_stats
+SUMMARY_INTERVAL = int(os.environ.get('TELEGRAM_METRICS_INTERVAL', '60'))
+
+
+class MethodStats:
+    """Counters and a latency histogram for one (bot, method) pair."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.latency_sum_ms = 0.0
+        self.latency_max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.status_codes = Counter()
+        self.error_codes = Counter()
+        self.retry_counts = Counter()  # retries-per-call histogram
+
+    def observe(self, latency_ms, status, error_code, bytes_sent, retries):
+        self.calls += 1
+        if status is None or status >= 400:
+            self.errors += 1
+        self.retries += retries
+        self.bytes_sent += bytes_sent
+        self.latency_sum_ms += latency_ms
+        self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+        self.buckets[self._bucket(latency_ms)] += 1
+        self.status_codes[str(status) if status is not None else 'network_error'] += 1
+        if error_code is not None:
+            self.error_codes[str(error_code)] += 1
+        self.retry_counts[str(retries)] += 1
+
+    @staticmethod
+    def _bucket(latency_ms):
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                return i
+        return len(LATENCY_BUCKETS_MS)
+
+    def percentile(self, q: float) -> float:
+        """Histogram estimate: upper bound of the bucket holding the q-th call."""
+        if not self.calls:
+            return 0.0
+        rank = q * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.latency_max_ms
+        return self.latency_max_ms
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'latency_avg_ms': round(self.latency_sum_ms / self.calls, 1) if self.calls else 0.0,
+            'latency_p50_ms': self.percentile(0.50),
+            'latency_p95_ms': self.percentile(0.95),
+            'latency_p99_ms': self.percentile(0.99),
+            'latency_max_ms': round(self.latency_max_ms, 1),
+            'latency_buckets': dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ['inf'], self.buckets)),
+            'status_codes': dict(self.status_codes),
+            'error_codes': dict(self.error_codes),
+            'retry_counts': dict(self.retry_counts),
+        }
+
+
+class RateStats:
+    """Send rate controller decisions for one bot (see rate_controller.py)."""
+
+    def __init__(self):
+        self.samples = 0
+        self.rate_sum = 0.0
+        self.rate_min = None
+        self.rate_max = 0.0
+        self.rate_last = 0.0
+        self.max_rate = 0.0
+        self.at_ceiling = 0
+        self.decisions = Counter()
+
+    def observe(self, rate, max_rate, decision):
+        self.samples += 1
+        self.rate_sum += rate
+        self.rate_min = rate if self.rate_min is None else min(self.rate_min, rate)
+        self.rate_max = max(self.rate_max, rate)
+        self.rate_last = rate
+        self.max_rate = max_rate
+        if rate >= max_rate:
+            self.at_ceiling += 1
+        self.decisions[decision] += 1
+
+    def to_dict(self):
+        return {
+            'samples': self.samples,
+            'rate_avg': round(self.rate_sum / self.samples, 2) if self.samples else 0.0,
+            'rate_min': round(self.rate_min or 0.0, 2),
+            'rate_max': round(self.rate_max, 2),
+            'rate_last': round(self.rate_last, 2),
+            'max_rate': self.max_rate,
+            'ceiling_share': round(self.at_ceiling / self.samples, 3) if self.samples else 0.0,
+            'increases': self.decisions['increase'],
+            'backoffs_429': self.decisions['backoff_429'],
+            'backoffs_latency': self.decisions['backoff_latency'],
+        }
+
+
+class TelegramMetrics:
+    """Per-method, per-bot Bot API call statistics for the current reporting window."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.window_start = datetime.now(timezone.utc)
+        self._stats = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def observe(self, bot_id: str, method: str, latency_s: float, status: int = None,
+                error_code: int = None, bytes_sent: int = 0, retries: int = 0):
+        latency_ms = latency_s * 1000.0
+        with self._lock:
+            stats = self._stats.get((bot_id, method))
+            if stats is None:
+                stats = self._stats[(bot_id, method)] = MethodStats()
+            stats.observe(latency_ms, status, error_code, bytes_sent, retries)
+
+        if SLOW_CALL_MS and latency_ms >= SLOW_CALL_MS:
+            logger.warning(
+                f"Slow Telegram call: {method} took {latency_ms:.0f} ms "
+                f"(bot {bot_id}, status {status}, error_code {error_code}, retries {retries})"
+            )
+
+    def observe_rate(self, bot_id: str, rate: float, max_rate: float, decision: str):
+        """One send rate controller decision (increase, hold, backoff_429, backoff_latency)."""
+        with self._lock:
+            stats = self._rates.get(bot_id)
+            if stats is None:
+                stats = self._rates[bot_id] = RateStats()
+            stats.observe(rate, max_rate, decision)
+
+    def snapshot(self):
+        """Current window as {bot_id: {method: stats}}."""
+        with self._lock:
+            result = {}
+            for (bot_id, method), stats in self._stats.items():
+                result.setdefault(bot_id, {})[method] = stats.to_dict()
+            for bot_id, stats in self._rates.items():
+                result.setdefault(bot_id, {})['send_rate'] = stats.to_dict()
+            return result
+
+    def drain(self):
+        """Return (call rows, send rate rows) for the current window and start a new one."""
+        with self._lock:
+            window_start, window_end = self.window_start, datetime.now(timezone.utc)
+            stats, self._stats = self._stats, {}
+            rates, self._rates = self._rates, {}
+            self.window_start = window_end
+        call_rows = [
+            dict(stat.to_dict(), bot_id=bot_id, method=method, source=self.source,
+                 window_start=window_start, window_end=window_end)
+            for (bot_id, method), stat in stats.items()
+        ]
+        rate_rows = [
+            dict(stat.to_dict(), bot_id=bot_id, source=self.source,
+                 window_start=window_start, window_end=window_end)
+            for bot_id, stat in rates.items()
+        ]
+        return call_rows, rate_rows
+
+    def flush(self, db_manager, force: bool = False):
+        """
+        Write one telegram_call_stats row per (bot, method), and one send_rate_stats
+        row per bot, every SUMMARY_INTERVAL seconds.
+        """
+        if not force and time.monotonic() - self._last_flush < SUMMARY_INTERVAL:
+            return
+        self._last_flush = time.monotonic()
+        rows, rate_rows = self.drain()
+
+        if rows:
+            try:
+                db_manager.insert_telegram_call_stats(rows)
+                logger.info(f"Wrote {len(rows)} Telegram call summary row(s)")
+            except Exception as e:
+                logger.warning(f"Could not write Telegram call stats: {e}")
+        if rate_rows:
+            try:
+                db_manager.insert_send_rate_stats(rate_rows)
+            except Exception as e:
+                logger.warning(f"Could not write send rate stats: {e}")
+
+
+# Shared registry for the TGMS worker process
+telegram_metrics = TelegramMetrics(source='tgms')
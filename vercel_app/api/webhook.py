@@ -2,6 +2,7 @@
 import os
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import httpx
@@ -16,6 +17,12 @@ logger = logging.getLogger(__name__)
 # --- Flask App Initialization ---
 app = Flask(__name__)
 
+# --- Telegram acknowledgements ---
+# Reused across invocations of a warm function so acks don't pay a fresh TLS handshake
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+telegram_client = httpx.Client(timeout=2.0)
+ack_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tg-ack')
+
 # --- Database Connection ---
 DATABASE_URL = os.environ.get('DATABASE_URL', '').strip()  # Strip whitespace
 engine = None
@@ -97,35 +104,26 @@ def _handle_main_update(update_data: dict):
     update_id = update_data.get('update_id')
     logger.info(f"Received main bot webhook with update_id: {update_id}")
 
-    # Send immediate responses for better UX
+    # Immediate acknowledgements for better UX, kept off the critical path:
+    # - answerCallbackQuery rides back in the webhook response body (no extra round trip)
+    # - sendChatAction runs in a worker thread while the job is inserted
+    webhook_reply = None
+    chat_action = None
     try:
         bot_token = os.environ.get('BOT_TOKEN')
 
         if 'callback_query' in update_data:
             callback_query_id = update_data['callback_query'].get('id')
             if callback_query_id:
-                httpx.post(
-                    f"https://api.telegram.org/bot{bot_token}/answerCallbackQuery",
-                    json={"callback_query_id": callback_query_id},
-                    timeout=2.0,
-                )
-
+                webhook_reply = {"method": "answerCallbackQuery", "callback_query_id": callback_query_id}
             chat_id = update_data['callback_query'].get('message', {}).get('chat', {}).get('id')
-            if chat_id:
-                httpx.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendChatAction",
-                    json={"chat_id": chat_id, "action": "typing"},
-                    timeout=2.0,
-                )
-
         elif 'message' in update_data:
             chat_id = update_data['message'].get('chat', {}).get('id')
-            if chat_id:
-                httpx.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendChatAction",
-                    json={"chat_id": chat_id, "action": "typing"},
-                    timeout=2.0,
-                )
+        else:
+            chat_id = None
+
+        if chat_id:
+            chat_action = ack_executor.submit(_send_chat_action, bot_token, chat_id)
     except Exception as e:
         logger.warning(f"Could not send immediate response: {e}")
 
@@ -161,13 +159,42 @@ def _handle_main_update(update_data: dict):
                     raise
 
         logger.info(f"Successfully queued main bot job for update_id: {update_id}")
+        _wait_for_ack(chat_action)
+        if webhook_reply:
+            # Telegram executes a method call returned in the webhook response body
+            return jsonify(webhook_reply), 200
         return jsonify({"status": "ok", "message": "Webhook received and queued"}), 200
 
     except Exception as e:
         logger.error(f"Database error while inserting main bot job {update_id}: {e}", exc_info=True)
+        _wait_for_ack(chat_action)
         return jsonify({"status": "error", "message": "Failed to queue job"}), 500
 
 
+def _send_chat_action(bot_token: str, chat_id):
+    """Show the 'typing…' indicator while the worker picks up the job."""
+    try:
+        telegram_client.post(
+            f"{TELEGRAM_API_URL}/bot{bot_token}/sendChatAction",
+            json={"chat_id": chat_id, "action": "typing"},
+        )
+    except Exception as e:
+        logger.warning(f"Could not send chat action to {chat_id}: {e}")
+
+
+def _wait_for_ack(future, timeout: float = 2.0):
+    """
+    Serverless functions are frozen once the response is returned, so let the
+    background acknowledgement finish (it has been running alongside the insert).
+    """
+    if future is None:
+        return
+    try:
+        future.result(timeout=timeout)
+    except Exception as e:
+        logger.warning(f"Immediate acknowledgement did not complete: {e}")
+
+
 def _handle_tgms_update(update_data: dict):
     """Handle updates for the TGMS bot."""
     update_id = update_data.get('update_id')
@@ -424,6 +451,83 @@ def get_dashboard_metrics():
             except Exception as exc:
                 metrics["errors"].append(f"queue_items.image_engine: {exc}")
 
+            # --- Telegram API call stats (summary rows written by the workers) ---
+            try:
+                call_rows = connection.execute(text(
+                    """
+                    SELECT source, bot_id, method,
+                           SUM(calls) AS calls,
+                           SUM(errors) AS errors,
+                           SUM(retries) AS retries,
+                           SUM(bytes_sent) AS bytes_sent,
+                           SUM(latency_avg_ms * calls) / NULLIF(SUM(calls), 0) AS latency_avg_ms,
+                           MAX(latency_p95_ms) AS latency_p95_ms,
+                           MAX(latency_p99_ms) AS latency_p99_ms,
+                           MAX(latency_max_ms) AS latency_max_ms
+                    FROM telegram_call_stats
+                    WHERE window_end >= NOW() - INTERVAL '1 hour'
+                    GROUP BY source, bot_id, method
+                    ORDER BY SUM(calls) DESC
+                    """
+                )).fetchall()
+                metrics["telegram_calls_last_hour"] = [
+                    {
+                        "source": row._mapping["source"],
+                        "bot_id": row._mapping["bot_id"],
+                        "method": row._mapping["method"],
+                        "calls": int(row._mapping["calls"] or 0),
+                        "errors": int(row._mapping["errors"] or 0),
+                        "retries": int(row._mapping["retries"] or 0),
+                        "bytes_sent": int(row._mapping["bytes_sent"] or 0),
+                        "latency_avg_ms": float(row._mapping["latency_avg_ms"] or 0.0),
+                        "latency_p95_ms": float(row._mapping["latency_p95_ms"] or 0.0),
+                        "latency_p99_ms": float(row._mapping["latency_p99_ms"] or 0.0),
+                        "latency_max_ms": float(row._mapping["latency_max_ms"] or 0.0),
+                    }
+                    for row in call_rows
+                ]
+            except Exception as exc:
+                metrics["errors"].append(f"telegram_call_stats: {exc}")
+
+            # --- Adaptive send rate (AIMD controller summaries written by the workers) ---
+            try:
+                rate_rows = connection.execute(text(
+                    """
+                    SELECT source, bot_id,
+                           SUM(samples) AS samples,
+                           SUM(rate_avg * samples) / NULLIF(SUM(samples), 0) AS rate_avg,
+                           MIN(rate_min) AS rate_min,
+                           MAX(rate_max) AS rate_max,
+                           MAX(max_rate) AS max_rate,
+                           SUM(ceiling_share * samples) / NULLIF(SUM(samples), 0) AS ceiling_share,
+                           SUM(increases) AS increases,
+                           SUM(backoffs_429) AS backoffs_429,
+                           SUM(backoffs_latency) AS backoffs_latency
+                    FROM send_rate_stats
+                    WHERE window_end >= NOW() - INTERVAL '1 hour'
+                    GROUP BY source, bot_id
+                    ORDER BY source, bot_id
+                    """
+                )).fetchall()
+                metrics["send_rate_last_hour"] = [
+                    {
+                        "source": row._mapping["source"],
+                        "bot_id": row._mapping["bot_id"],
+                        "samples": int(row._mapping["samples"] or 0),
+                        "rate_avg": float(row._mapping["rate_avg"] or 0.0),
+                        "rate_min": float(row._mapping["rate_min"] or 0.0),
+                        "rate_max": float(row._mapping["rate_max"] or 0.0),
+                        "max_rate": float(row._mapping["max_rate"] or 0.0),
+                        "ceiling_share": float(row._mapping["ceiling_share"] or 0.0),
+                        "increases": int(row._mapping["increases"] or 0),
+                        "backoffs_429": int(row._mapping["backoffs_429"] or 0),
+                        "backoffs_latency": int(row._mapping["backoffs_latency"] or 0),
+                    }
+                    for row in rate_rows
+                ]
+            except Exception as exc:
+                metrics["errors"].append(f"send_rate_stats: {exc}")
+
             # --- Bot health ---
             try:
                 health_rows = connection.execute(text(
@@ -452,8 +556,10 @@ def get_dashboard_metrics():
 def enqueue_tgms_send():
     """
     Admin endpoint to enqueue a broadcast to managed groups.
-    Body JSON: { "text": "...", "photo_url": "...", "caption": "..." }
+    Body JSON: { "text": "...", "photo_url": "...", "caption": "...", "dry_run": false }
+    With "dry_run": true the worker only projects duration, failures and peak rate.
     Requires ADMIN_API_KEY environment variable and 'x-api-key' header.
+    Poll GET /api/tgms/broadcasts/<job_id> for the projection or live progress.
     """
     if not engine:
         return jsonify({"status": "error", "message": "DB not ready"}), 500
@@ -472,23 +578,67 @@ def enqueue_tgms_send():
                     insert_query = text("""
                         INSERT INTO jobs (job_type, bot_token, payload, status, created_at, updated_at)
                         VALUES (:job_type, :bot_token, :payload, 'pending', :created_at, :updated_at)
+                        RETURNING job_id
                     """)
-                    connection.execute(insert_query, {
+                    job_id = connection.execute(insert_query, {
                         'job_type': job_type,
                         'bot_token': os.environ.get('TGMS_BOT_TOKEN'),
                         'payload': json.dumps(payload),
                         'created_at': datetime.utcnow(),
                         'updated_at': datetime.utcnow()
-                    })
+                    }).scalar()
                     transaction.commit()
                 except Exception:
                     transaction.rollback()
                     raise
-        return jsonify({"status": "ok", "message": "Broadcast enqueued"}), 200
+        message = "Dry run enqueued" if payload.get('dry_run') else "Broadcast enqueued"
+        return jsonify({"status": "ok", "message": message, "job_id": job_id}), 200
     except Exception as e:
         logger.error(f"Failed to enqueue tgms send: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "Failed to enqueue"}), 500
 
+@app.route('/api/tgms/broadcasts/<int:job_id>', methods=['GET'])
+def get_tgms_broadcast(job_id: int):
+    """
+    Admin endpoint: status of a broadcast job.
+    Returns the dry-run projection (status 'dry_run', in results) or, for a real
+    broadcast, live progress/ETA published by the worker and the final results.
+    """
+    if not engine:
+        return jsonify({"status": "error", "message": "DB not ready"}), 500
+
+    admin_key = os.environ.get('ADMIN_API_KEY')
+    provided_key = request.headers.get('x-api-key')
+    if not admin_key or provided_key != admin_key:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        with engine.connect() as connection:
+            job = connection.execute(text("""
+                SELECT job_id, job_type, status, retries, created_at, updated_at
+                FROM jobs WHERE job_id = :job_id
+            """), {'job_id': job_id}).fetchone()
+            if not job:
+                return jsonify({"status": "error", "message": "Job not found"}), 404
+
+            run = connection.execute(text("""
+                SELECT run_id, status, shard_count, total_targets, sent_count, failed_count,
+                       progress, results, created_at, completed_at, updated_at
+                FROM broadcast_runs WHERE job_id = :job_id
+            """), {'job_id': job_id}).fetchone()
+    except Exception as e:
+        logger.error(f"Failed to load broadcast {job_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Failed to load broadcast"}), 500
+
+    def serialize(row):
+        return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in row._mapping.items()}
+
+    return jsonify({
+        "status": "ok",
+        "data": {"job": serialize(job), "run": serialize(run) if run else None},
+    }), 200
+
+
 @app.route('/', methods=['GET'])
 def index():
     """A simple health check endpoint for the root URL."""
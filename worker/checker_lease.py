@@ -0,0 +1,130 @@
+# worker/checker_lease.py
+#
+# Leader lease for the live checker (add_checker_lease.sql). Any number of checker
+# processes may run; only the lease holder polls Instagram and writes. A cycle's
+# claim runs in the same transaction as its writes: pg_try_advisory_xact_lock keeps
+# two cycles from overlapping, then the lease row is renewed (ours, or expired) and
+# its fencing number bumped. The row stays locked until commit, so a leader whose
+# lease was taken over gets no row back and writes nothing. Lease state lives in a
+# table rather than in a session-level advisory lock so it survives transaction-mode
+# poolers (Supabase) and a silently dropped connection expires with the TTL.
+# Standbys check the lease every STANDBY_CHECK_SECONDS and take over once it has
+# expired: within the TTL + STANDBY_CHECK_SECONDS of the leader's last cycle. The TTL
+# is sized from the pool's cycle (lease_ttl), so with two or more accounts a standby
+# takes over within one poll interval; a pool of one renews only once per interval,
+# so its lease has to outlast a full interval.
+
+import os
+import math
+import asyncio
+import logging
+from sqlalchemy import text
+
+from live_state import CHECKER_NAME
+from instagram_service import CALL_TIMEOUT
+from poll_schedule import MAX_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'instagram_live_checker'
+STANDBY_CHECK_SECONDS = 15
+
+
+def lease_ttl(cycle_seconds, poll_timeout=CALL_TIMEOUT):
+    """
+    Seconds the lease must outlast: the leader's longest gap between cycles
+    (the pool's cycle, see InstagramAccountPool.cycle_seconds) plus one poll
+    that runs into its timeout. IG_LEASE_TTL overrides it.
+    """
+    override = os.environ.get('IG_LEASE_TTL')
+    if override:
+        return int(override)
+    return int(math.ceil(cycle_seconds + poll_timeout))
+
+
+# A pool of one account cycles once per interval
+LEASE_TTL = lease_ttl(MAX_INTERVAL)
+
+# Times come from the database clock, so checkers on machines with skewed clocks agree
+CLAIM = text("""
+    INSERT INTO checker_leases AS l (name, holder, fence, acquired_at, renewed_at, expires_at)
+    VALUES (:name, :holder, 1, NOW(), NOW(), NOW() + make_interval(secs => :ttl))
+    ON CONFLICT (name) DO UPDATE
+    SET holder = EXCLUDED.holder,
+        fence = l.fence + 1,
+        acquired_at = CASE WHEN l.holder = EXCLUDED.holder THEN l.acquired_at ELSE EXCLUDED.acquired_at END,
+        renewed_at = EXCLUDED.renewed_at,
+        expires_at = EXCLUDED.expires_at
+    WHERE l.holder = EXCLUDED.holder OR l.expires_at < EXCLUDED.renewed_at
+    RETURNING fence
+""")
+
+
+class CheckerLease:
+    """Leader lease with a fencing number for one checker process."""
+
+    def __init__(self, name=LEASE_NAME, holder=None, ttl=LEASE_TTL):
+        self.name = name
+        self.holder = holder or f"{CHECKER_NAME}:{os.getpid()}"
+        self.ttl = ttl
+        self.fence = None  # fencing number of our last successful claim
+        self.leader = None  # last known holder, for logs
+
+    @property
+    def held(self):
+        return self.fence is not None
+
+    def claim(self, session):
+        """
+        Take or renew the lease inside the caller's transaction and return
+        the cycle's fencing number, or None when another process leads (the
+        caller should roll back). Commit the cycle's writes in the same
+        transaction.
+        """
+        locked = session.execute(text("SELECT pg_try_advisory_xact_lock(hashtext(:name))"),
+                                 {'name': self.name}).scalar()
+        row = session.execute(CLAIM, {
+            'name': self.name,
+            'holder': self.holder,
+            'ttl': self.ttl,
+        }).fetchone() if locked else None
+
+        if row is None:
+            if self.held:
+                logger.warning(f"Lost the {self.name} lease (fence {self.fence}); going standby")
+            self.fence = None
+            return None
+        if not self.held:
+            logger.info(f"Acquired the {self.name} lease as {self.holder} (fence {row.fence})")
+        self.fence = row.fence
+        self.leader = self.holder
+        return row.fence
+
+    def available(self, session):
+        """Whether this process may lead now: the lease is free, expired or ours."""
+        row = session.execute(text("""
+            SELECT holder, fence, expires_at, expires_at < NOW() AS expired
+            FROM checker_leases WHERE name = :name
+        """), {'name': self.name}).fetchone()
+        session.commit()
+        if row is None or row.expired or row.holder == self.holder:
+            return True
+        if row.holder != self.leader:
+            logger.info(f"Standing by: {row.holder} holds the {self.name} lease (fence {row.fence}, "
+                        f"expires {row.expires_at.isoformat()})")
+            self.leader = row.holder
+        return False
+
+    async def wait_until_available(self, session_factory):
+        """Poll the lease every STANDBY_CHECK_SECONDS until this process may lead."""
+        while True:
+            session = session_factory()
+            try:
+                if self.available(session):
+                    return
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Could not read the {self.name} lease: {e}")
+            finally:
+                session.close()
+            await asyncio.sleep(STANDBY_CHECK_SECONDS)
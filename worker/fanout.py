@@ -0,0 +1,403 @@
+# worker/fanout.py
+#
+# Concurrent, rate-limited fan-out of one message template to every active
+# chat_groups row for a broadcast_message job. Each group's outcome is recorded in
+# chat_broadcast_targets (add_chat_broadcasts.sql), so a retried or deferred job
+# only sends to groups still pending. Pacing comes from the bot's adaptive rate
+# controller (rate_controller.py); results are written in batches.
+#
+# send_all() and ResultBuffer are the shared core: live_notifications.py runs its
+# go-live fan-out through them with its own payloads and result writer.
+
+import os
+import json
+import time
+import asyncio
+import logging
+
+import httpx
+from sqlalchemy import text
+
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '20'))
+# Per-group results written per transaction, at least every RESULT_FLUSH_SECONDS
+RESULT_BATCH_SIZE = int(os.environ.get('BROADCAST_RESULT_BATCH_SIZE', '200'))
+RESULT_FLUSH_SECONDS = 1.0
+# Minimum seconds between progress updates on the job row
+PROGRESS_INTERVAL = 5.0
+MAX_ATTEMPTS = 3
+# Consecutive failures before a group is disabled for DISABLE_HOURS
+MAX_CONSECUTIVE_FAILURES = 3
+DISABLE_HOURS = 24
+
+# Groups a broadcast goes to; is_disabled only holds until disabled_until (if set)
+AUDIENCE_FILTER = "is_active AND NOT (is_disabled AND (disabled_until IS NULL OR disabled_until > NOW()))"
+
+# Bot API descriptions meaning the bot can never post in the chat again
+GONE_ERRORS = (
+    "chat not found",
+    "bot was kicked",
+    "bot is not a member",
+    "group chat was deactivated",
+    "group chat was upgraded",
+    "chat was deleted",
+)
+# Other rejections caused by the chat itself (as opposed to the message content)
+CHAT_ERRORS = (
+    "not enough rights",
+)
+
+# Failure faults recorded with each result: what a rejection says about the recipient
+FAULT_CHAT = 'chat'    # the chat refused the message (counts against its health)
+FAULT_GONE = 'gone'    # the recipient can never be reached again
+
+
+def _values(rows, columns, prefix):
+    """Typed VALUES list and bind parameters for a multi-row statement."""
+    params = {}
+    tuples = []
+    for i, row in enumerate(rows):
+        placeholders = []
+        for j, ((name, sql_type), value) in enumerate(zip(columns, row)):
+            key = f"{prefix}_{i}_{j}"
+            params[key] = value
+            placeholders.append(f"CAST(:{key} AS {sql_type})")
+        tuples.append(f"({', '.join(placeholders)})")
+    return ", ".join(tuples), params
+
+
+def classify_chat_error(status, description):
+    """
+    Fault of a rejected group send. Only errors about the chat itself count
+    toward chat_groups.consecutive_failures; content errors such as "can't
+    parse entities" fail the target without touching the group's health.
+    """
+    description = (description or '').lower()
+    if any(marker in description for marker in GONE_ERRORS):
+        return FAULT_GONE
+    if status == 403 or any(marker in description for marker in CHAT_ERRORS):
+        return FAULT_CHAT
+    return None
+
+
+def create_targets(session, job_id):
+    """
+    Snapshot the audience as pending targets for a job. Only the first call for
+    a job inserts; later calls (retries) keep the original audience.
+    """
+    inserted = session.execute(text(f"""
+        INSERT INTO chat_broadcast_targets (job_id, chat_id)
+        SELECT :job_id, chat_id
+        FROM chat_groups
+        WHERE {AUDIENCE_FILTER}
+          AND NOT EXISTS (SELECT 1 FROM chat_broadcast_targets WHERE job_id = :job_id)
+    """), {'job_id': job_id}).rowcount
+    session.commit()
+    return inserted
+
+
+def load_pending_targets(session, job_id):
+    """Pending targets with the group columns message templates can use."""
+    rows = session.execute(text("""
+        SELECT t.chat_id, t.attempts, g.title, g.member_count
+        FROM chat_broadcast_targets t
+        LEFT JOIN chat_groups g ON g.chat_id = t.chat_id
+        WHERE t.job_id = :job_id AND t.state = 'pending'
+        ORDER BY t.chat_id
+    """), {'job_id': job_id}).fetchall()
+    return [(row.chat_id, row.attempts, {'group_id': row.chat_id, 'title': row.title,
+                                         'member_count': row.member_count})
+            for row in rows]
+
+
+def target_counts(session, job_id):
+    row = session.execute(text("""
+        SELECT COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE state = 'sent') AS sent,
+               COUNT(*) FILTER (WHERE state = 'failed') AS failed,
+               COUNT(*) FILTER (WHERE state = 'pending') AS pending
+        FROM chat_broadcast_targets WHERE job_id = :job_id
+    """), {'job_id': job_id}).fetchone()
+    return dict(row._mapping)
+
+
+def write_job_result(session, job_id, result):
+    """Store progress or the final summary on the job row (jobs.result)."""
+    session.execute(text("""
+        UPDATE jobs SET result = CAST(:result AS JSONB), updated_at = NOW() WHERE job_id = :job_id
+    """), {'result': json.dumps(result, default=str), 'job_id': job_id})
+    session.commit()
+
+
+class ResultBuffer:
+    """
+    Per-recipient outcomes of a fan-out, written in batches by a subclass's
+    write(rows). Rows are (recipient, state, attempts, telegram_message_id, error, fault).
+    """
+
+    def __init__(self, max_rows=RESULT_BATCH_SIZE, max_delay=RESULT_FLUSH_SECONDS):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._rows = []
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, recipient, state, attempts, telegram_message_id=None, error=None, fault=None):
+        self._rows.append((recipient, state, attempts, telegram_message_id, str(error)[:500] if error else None, fault))
+        self._oldest = self._oldest or time.monotonic()
+
+    def due(self):
+        return len(self._rows) >= self.max_rows or (
+            self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay
+        )
+
+    def take(self):
+        rows, self._rows, self._oldest = self._rows, [], None
+        return rows
+
+    def put_back(self, rows):
+        """Re-buffer rows whose write failed, ahead of anything added meanwhile."""
+        self._rows[:0] = rows
+        self._oldest = self._oldest or time.monotonic()
+
+    def write(self, rows):
+        """Write taken rows in one transaction (blocking; run it in a thread)."""
+        raise NotImplementedError
+
+
+class ResultWriter(ResultBuffer):
+    """
+    Writes per-group outcomes with one multi-row statement per kind in a single
+    transaction: target states, failure counter resets and increments, cooldown
+    disables and deactivation of chats the bot has left. Failures without a
+    chat fault (content errors) leave chat_groups alone.
+    """
+
+    def __init__(self, session, job_id, **kwargs):
+        super().__init__(**kwargs)
+        self.session = session
+        self.job_id = job_id
+
+    def write(self, rows):
+        if not rows:
+            return
+        try:
+            values, params = _values(
+                [row[:5] for row in rows],
+                [('chat_id', 'TEXT'), ('state', 'VARCHAR(10)'), ('attempts', 'INTEGER'),
+                 ('telegram_message_id', 'BIGINT'), ('error', 'TEXT')],
+                't',
+            )
+            params['job_id'] = self.job_id
+            self.session.execute(text(f"""
+                UPDATE chat_broadcast_targets t
+                SET state = v.state, attempts = v.attempts, telegram_message_id = v.telegram_message_id,
+                    error = v.error, updated_at = NOW()
+                FROM (VALUES {values}) AS v(chat_id, state, attempts, telegram_message_id, error)
+                WHERE t.job_id = :job_id AND t.chat_id = v.chat_id
+            """), params)
+
+            sent = sorted({(row[0],) for row in rows if row[1] == 'sent'})
+            if sent:
+                values, params = _values(sent, [('chat_id', 'TEXT')], 's')
+                self.session.execute(text(f"""
+                    UPDATE chat_groups g
+                    SET consecutive_failures = 0
+                    FROM (VALUES {values}) AS v(chat_id)
+                    WHERE g.chat_id = v.chat_id AND g.consecutive_failures <> 0
+                """), params)
+
+            failed = sorted({(row[0], row[5] == FAULT_GONE) for row in rows
+                             if row[1] == 'failed' and row[5] in (FAULT_CHAT, FAULT_GONE)})
+            if failed:
+                values, params = _values(failed, [('chat_id', 'TEXT'), ('gone', 'BOOLEAN')], 'f')
+                params.update(max_failures=MAX_CONSECUTIVE_FAILURES, disable_hours=DISABLE_HOURS)
+                self.session.execute(text(f"""
+                    UPDATE chat_groups g
+                    SET consecutive_failures = g.consecutive_failures + 1,
+                        is_active = g.is_active AND NOT v.gone,
+                        is_disabled = g.is_disabled OR g.consecutive_failures + 1 >= :max_failures,
+                        disabled_until = CASE
+                            WHEN g.consecutive_failures + 1 >= :max_failures
+                            THEN NOW() + make_interval(hours => :disable_hours)
+                            ELSE g.disabled_until
+                        END
+                    FROM (VALUES {values}) AS v(chat_id, gone)
+                    WHERE g.chat_id = v.chat_id
+                """), params)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+
+async def send_all(helper, recipients, build_payload, writer, classify, concurrency, label, progress=None):
+    """
+    Send one sendMessage per recipient, `concurrency` in flight at the bot's
+    adaptive rate, recording each outcome in `writer` (a ResultBuffer).
+
+    Transient failures (429 beyond the helper's in-place retries, 5xx, network)
+    are retried up to MAX_ATTEMPTS per run and otherwise left pending for the
+    next job attempt; Bot API rejections are final, and `classify(status,
+    description)` records their fault (None, FAULT_CHAT or FAULT_GONE).
+    Raises CircuitOpenError (after saving what was recorded) when Telegram is down.
+
+    Args:
+        recipients: list of (recipient, attempts so far)
+        build_payload: callable(recipient) -> sendMessage payload; a ValueError
+            (e.g. TemplateError) fails that recipient without a request
+        label: what is being sent, for log messages
+        progress: optional blocking callable(counts dict), run in a thread after
+            result flushes, at most every PROGRESS_INTERVAL seconds
+
+    Returns:
+        Dict with this run's sent/failed/gone/left_pending counts, requests and rate
+    """
+    stats = {'sent': 0, 'failed': 0, 'gone': 0, 'left_pending': 0, 'requests': 0}
+    if not recipients:
+        return dict(stats, duration_seconds=0.0, messages_per_second=0.0)
+
+    queue = asyncio.Queue()
+    for recipient, attempts in recipients:
+        queue.put_nowait((recipient, attempts, 0))
+    flush_lock = asyncio.Lock()
+    last_progress = [0.0]
+    abort = []
+
+    async def flush():
+        async with flush_lock:
+            rows = writer.take()
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(writer.write, rows)
+            except Exception as e:
+                writer.put_back(rows)
+                logger.error(f"Failed to record {len(rows)} results of {label}: {e}")
+                return
+            if progress and time.monotonic() - last_progress[0] >= PROGRESS_INTERVAL:
+                last_progress[0] = time.monotonic()
+                await asyncio.to_thread(progress, dict(stats, remaining=queue.qsize()))
+
+    async def send_worker(client):
+        while True:
+            recipient, attempts, tries = await queue.get()
+            try:
+                if abort:
+                    continue
+                try:
+                    payload = build_payload(recipient)
+                except ValueError as e:
+                    writer.add(recipient, 'failed', attempts, error=str(e))
+                    stats['failed'] += 1
+                    continue
+
+                await helper.rate_controller.acquire()
+                stats['requests'] += 1
+                try:
+                    response = await helper.request(client, 'sendMessage', payload)
+                    status = response.status_code
+                    body = response.json() if response.content else {}
+                except httpx.RequestError as e:
+                    status, body = None, {'description': str(e) or type(e).__name__}
+                except ValueError:
+                    body = {}
+
+                if status == 200 and body.get('ok'):
+                    writer.add(recipient, 'sent', attempts + 1, (body.get('result') or {}).get('message_id'))
+                    stats['sent'] += 1
+                elif status is None or status == 429 or status >= 500:
+                    if tries + 1 < MAX_ATTEMPTS:
+                        queue.put_nowait((recipient, attempts + 1, tries + 1))
+                    else:
+                        # Still pending: the job is retried and resumes from here
+                        writer.add(recipient, 'pending', attempts + 1, error=body.get('description') or f"HTTP {status}")
+                        stats['left_pending'] += 1
+                else:
+                    fault = classify(status, body.get('description'))
+                    writer.add(recipient, 'failed', attempts + 1, error=body.get('description') or f"HTTP {status}",
+                               fault=fault)
+                    stats['failed'] += 1
+                    stats['gone'] += int(fault == FAULT_GONE)
+            except CircuitOpenError as e:
+                if not abort:
+                    abort.append(e)
+            except Exception as e:
+                logger.error(f"Sending {label} to {recipient} failed: {e}", exc_info=True)
+                writer.add(recipient, 'pending', attempts + 1, error=str(e))
+                stats['left_pending'] += 1
+            finally:
+                queue.task_done()
+                if writer.due():
+                    await flush()
+
+    async def periodic_flush():
+        while True:
+            await asyncio.sleep(writer.max_delay)
+            await flush()
+
+    logger.info(f"Sending {label} to {len(recipients)} recipients (concurrency {concurrency})")
+    started = time.monotonic()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+        flusher = asyncio.create_task(periodic_flush())
+        workers = [asyncio.create_task(send_worker(client)) for _ in range(min(concurrency, len(recipients)))]
+        try:
+            await queue.join()
+        finally:
+            for task in workers + [flusher]:
+                task.cancel()
+            await asyncio.gather(*workers, flusher, return_exceptions=True)
+            await flush()
+
+    duration = time.monotonic() - started
+    stats['duration_seconds'] = round(duration, 2)
+    stats['messages_per_second'] = round(stats['requests'] / duration, 2) if duration else 0.0
+    if abort:
+        raise abort[0]
+    return stats
+
+
+async def fan_out(session, helper, job_id, template, concurrency=None, progress=None):
+    """
+    Send the job's message to every pending target, rendering the compiled
+    `template` (message_template.py) from each group's columns. See send_all
+    for retries and errors.
+
+    Args:
+        progress: optional blocking callable(counts dict), run in a thread after
+            result flushes, at most every PROGRESS_INTERVAL seconds
+
+    Returns:
+        Dict with this run's sent/failed/left_pending/deactivated counts, requests and rate
+    """
+    targets = await asyncio.to_thread(load_pending_targets, session, job_id)
+    writer = ResultWriter(session, job_id)
+    fields = {}
+    recipients = []
+    for chat_id, attempts, values in targets:
+        if not chat_id.lstrip('-').isdigit():
+            writer.add(chat_id, 'failed', attempts, error=f"Invalid chat_id {chat_id!r}", fault=FAULT_GONE)
+            continue
+        fields[chat_id] = values
+        recipients.append((chat_id, attempts))
+
+    def build_payload(chat_id):
+        payload = {'chat_id': int(chat_id), 'text': template.render(fields[chat_id])}
+        if template.parse_mode:
+            payload['parse_mode'] = template.parse_mode
+        return payload
+
+    invalid = len(writer)
+    if invalid:
+        await asyncio.to_thread(writer.write, writer.take())
+    stats = await send_all(helper, recipients, build_payload, writer, classify_chat_error,
+                           concurrency or BROADCAST_CONCURRENCY, f"broadcast job {job_id}", progress)
+    stats['failed'] += invalid
+    stats['deactivated'] = stats.pop('gone') + invalid
+    return stats
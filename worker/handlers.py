@@ -2,6 +2,7 @@
 # Improved UI/UX version with better formatting, emojis, and user experience
 
 import os
+import re
 import logging
 import asyncio
 from datetime import datetime, timezone
@@ -9,8 +10,13 @@ from sqlalchemy.orm import Session
 
 from models import TelegramUser, ChatGroup
 from telegram_helper import TelegramHelper
+from circuit_breaker import CircuitOpenError
+from message_fingerprints import fingerprint_store, render_fingerprint
+from message_template import TemplateError, compile_template
 from instagram_checker import get_currently_live_users
 from translations import get_text, detect_language, LANGUAGE_NAMES
+import fanout
+import live_notifications
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +30,9 @@ REQUIRED_GROUP_ID = -1002891494486
 # Feature flag: Set to False to disable group membership requirement
 REQUIRE_GROUP_MEMBERSHIP = False
 
+# Instagram usernames: letters, digits, periods and underscores, at most 30
+IG_USERNAME_RE = re.compile(r'^[a-z0-9._]{1,30}$')
+
 
 def is_new_day_for_user(user: TelegramUser) -> bool:
     """Check if it's a new day for the user considering timezone."""
@@ -88,6 +97,29 @@ async def send_main_menu(user_id: int, prefix_message: str = "", username: str =
         raise
 
 
+async def edit_menu_message(helper: TelegramHelper, session: Session, callback_query: dict,
+                            text: str, buttons: dict, parse_mode: str = "Markdown") -> bool:
+    """
+    Edit the message a callback came from, skipping the Bot API call when the
+    rendered text and keyboard are identical to what is already shown.
+    Returns True if an edit was sent.
+    """
+    message = callback_query.get('message', {})
+    chat_id = message.get('chat', {}).get('id')
+    message_id = message.get('message_id')
+    fingerprint = render_fingerprint(text, buttons, parse_mode)
+
+    if chat_id and message_id and fingerprint_store.get(chat_id, message_id, session) == fingerprint:
+        # The webhook has already answered the callback query, so there is nothing else to send
+        logger.info(f"Skipping edit of message {message_id} in chat {chat_id}: content unchanged")
+        return False
+
+    result = await helper.edit_message_text(chat_id, message_id, text, parse_mode=parse_mode, reply_markup=buttons)
+    if result and (result.get('ok') or result.get('not_modified')):
+        fingerprint_store.remember(chat_id, message_id, fingerprint, session)
+    return bool(result and result.get('ok'))
+
+
 async def start_handler(session: Session, payload: dict):
     """Handles the /start command with improved welcome experience."""
     try:
@@ -229,9 +261,6 @@ async def my_account_handler(session: Session, payload: dict):
         callback_query = payload.get('callback_query', {})
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             logger.error("Could not determine sender_id from payload.")
@@ -282,7 +311,7 @@ async def my_account_handler(session: Session, payload: dict):
         }
         
         # Edit the existing message instead of sending a new one
-        await helper.edit_message_text(chat_id, message_id, account_text, parse_mode="Markdown", reply_markup=buttons)
+        await edit_menu_message(helper, session, callback_query, account_text, buttons)
         logger.info(f"Edited message with account details for user {user.id}")
 
     except Exception as e:
@@ -296,9 +325,6 @@ async def check_live_handler(session: Session, payload: dict):
         callback_query = payload.get('callback_query', {})
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             logger.error("Could not determine sender_id from payload.")
@@ -321,24 +347,23 @@ async def check_live_handler(session: Session, payload: dict):
             await send_user_feedback(sender_id, "❌ Please use /start first to register.")
             return
 
-        # Check points/subscription (only deduct on first page)
+        # Check points/subscription (only charge on first page). The point is deducted
+        # after the message is shown: a send that raises (e.g. CircuitOpenError, which
+        # defers the job) charges nothing, so the retried job never charges twice.
         is_unlimited = user.subscription_end and user.subscription_end > datetime.now(timezone.utc)
-        if not is_unlimited and page == 1:
-            if user.points > 0:
-                user.points -= 1
-                session.commit()
-            else:
-                no_points_msg = "⚠️ *No Points Left!*\n\n"
-                no_points_msg += "You've used all your points for today.\n\n"
-                no_points_msg += "🔄 *Points reset daily at midnight UTC*\n\n"
-                no_points_msg += "💡 *Get more points:*\n"
-                no_points_msg += "  • Wait for daily reset\n"
-                no_points_msg += "  • Refer friends (+10 each)\n"
-                no_points_msg += "  • Upgrade to unlimited\n"
-                
-                logger.info(f"User {user.id} has no points left.")
-                await send_user_feedback(sender_id, no_points_msg)
-                return
+        charge = not is_unlimited and page == 1
+        if charge and user.points <= 0:
+            no_points_msg = "⚠️ *No Points Left!*\n\n"
+            no_points_msg += "You've used all your points for today.\n\n"
+            no_points_msg += "🔄 *Points reset daily at midnight UTC*\n\n"
+            no_points_msg += "💡 *Get more points:*\n"
+            no_points_msg += "  • Wait for daily reset\n"
+            no_points_msg += "  • Refer friends (+10 each)\n"
+            no_points_msg += "  • Upgrade to unlimited\n"
+            
+            logger.info(f"User {user.id} has no points left.")
+            await send_user_feedback(sender_id, no_points_msg)
+            return
         
         # Get live users
         live_users = await get_currently_live_users(session)
@@ -380,7 +405,7 @@ async def check_live_handler(session: Session, payload: dict):
         if is_unlimited:
             live_message += f"💎 *Status:* Premium (Unlimited)\n"
         else:
-            live_message += f"💰 *Points Left:* {user.points}\n"
+            live_message += f"💰 *Points Left:* {user.points - 1 if charge else user.points}\n"
         
         live_message += f"⏰ *Updated:* {datetime.now(timezone.utc).strftime('%I:%M %p UTC')}"
         
@@ -402,7 +427,10 @@ async def check_live_handler(session: Session, payload: dict):
         buttons = {"inline_keyboard": button_rows}
         
         # Edit the existing message instead of sending a new one
-        await helper.edit_message_text(chat_id, message_id, live_message, parse_mode="Markdown", reply_markup=buttons)
+        shown = await edit_menu_message(helper, session, callback_query, live_message, buttons)
+        if charge and shown:
+            user.points -= 1
+            session.commit()
         logger.info(f"User {user.id} checked live users page {page}/{total_pages}. Total: {total_users} live. Points: {user.points}")
 
     except Exception as e:
@@ -417,9 +445,6 @@ async def referrals_handler(session: Session, payload: dict):
         callback_query = payload.get('callback_query', {})
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             logger.error("Could not determine sender_id from payload.")
@@ -466,7 +491,7 @@ async def referrals_handler(session: Session, payload: dict):
         }
         
         # Edit the existing message instead of sending a new one
-        await helper.edit_message_text(chat_id, message_id, referral_text, parse_mode="Markdown", reply_markup=buttons)
+        await edit_menu_message(helper, session, callback_query, referral_text, buttons)
 
     except Exception as e:
         logger.error(f"Error in referrals_handler: {e}", exc_info=True)
@@ -479,9 +504,6 @@ async def help_handler(session: Session, payload: dict):
         callback_query = payload.get('callback_query', {})
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             return
@@ -526,7 +548,7 @@ async def help_handler(session: Session, payload: dict):
         }
         
         # Edit the existing message instead of sending a new one
-        await helper.edit_message_text(chat_id, message_id, help_text, parse_mode="Markdown", reply_markup=buttons)
+        await edit_menu_message(helper, session, callback_query, help_text, buttons)
 
     except Exception as e:
         logger.error(f"Error in help_handler: {e}", exc_info=True)
@@ -540,9 +562,6 @@ async def back_handler(session: Session, payload: dict):
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
         username = from_user.get('first_name', 'there')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             return
@@ -579,7 +598,7 @@ async def back_handler(session: Session, payload: dict):
         }
         
         # Edit the existing message instead of sending a new one
-        await helper.edit_message_text(chat_id, message_id, menu_text, parse_mode="Markdown", reply_markup=buttons)
+        await edit_menu_message(helper, session, callback_query, menu_text, buttons)
 
     except Exception as e:
         logger.error(f"Error in back_handler: {e}", exc_info=True)
@@ -729,46 +748,205 @@ async def activate_handler(session: Session, payload: dict):
         raise
 
 
-async def broadcast_message_handler(session: Session, payload: dict):
+async def broadcast_message_handler(session: Session, payload: dict, job_id: int = None) -> bool:
     """
-    Handles a broadcast_message job, sending a message to all active groups.
+    Handles a broadcast_message job: concurrent, rate-limited fan-out to all
+    active groups (see fanout.py). Per-group results are persisted, so a retry
+    resumes with the groups still pending; progress and the final summary are
+    written to jobs.result.
+
+    Returns:
+        True once every group reached a final state, False to have the job retried
     """
+    message_text = payload.get('text')
+    if not message_text:
+        logger.error("Broadcast job is missing 'text' in payload.")
+        return True  # Retrying would not help
+    if job_id is None:
+        logger.error("Broadcast job needs a job_id to track per-group results.")
+        return False
+    try:
+        # Compiled and validated once; rendered per group with {title}, {member_count}, {group_id}
+        template = compile_template(message_text, payload.get('parse_mode', 'Markdown'), debug_code=False)
+    except TemplateError as e:
+        logger.error(f"Broadcast job {job_id} has an invalid message template: {e}")
+        return True  # Retrying would not help
+
     try:
-        message_text = payload.get('text')
-        if not message_text:
-            logger.error("Broadcast job is missing 'text' in payload.")
+        created = await asyncio.to_thread(fanout.create_targets, session, job_id)
+        if created:
+            logger.info(f"Broadcast job {job_id}: {created} target groups")
+
+        helper = TelegramHelper()
+        started_at = datetime.now(timezone.utc).isoformat()
+
+        def report_progress(run_counts, status='running'):
+            counts = fanout.target_counts(session, job_id)
+            fanout.write_job_result(session, job_id, dict(counts, status=status, started_at=started_at,
+                                                          rate=round(helper.rate_controller.rate, 1)))
+
+        try:
+            run = await fanout.fan_out(session, helper, job_id, template, progress=report_progress)
+        except CircuitOpenError:
+            # Recorded results are kept; the deferred job resumes with the pending groups
+            await asyncio.to_thread(report_progress, None, 'deferred')
+            raise
+
+        counts = await asyncio.to_thread(fanout.target_counts, session, job_id)
+        summary = dict(
+            counts,
+            status='completed' if counts['pending'] == 0 else 'incomplete',
+            started_at=started_at,
+            finished_at=datetime.now(timezone.utc).isoformat(),
+            this_run=run,
+        )
+        await asyncio.to_thread(fanout.write_job_result, session, job_id, summary)
+        logger.info(
+            f"Broadcast job {job_id}: {counts['sent']}/{counts['total']} sent, {counts['failed']} failed, "
+            f"{counts['pending']} pending ({run['messages_per_second']} msgs/sec this run)"
+        )
+        return counts['pending'] == 0
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Error in broadcast_message_handler: {e}", exc_info=True)
+        session.rollback()
+        return False
+
+
+async def watch_handler(session: Session, payload: dict):
+    """
+    Handles /watch [username]: adds an Instagram username to the sender's
+    watchlist, or lists the watchlist when no username is given.
+    """
+    try:
+        message = payload.get('message', {})
+        user_id = message.get('from', {}).get('id')
+        chat_id = message.get('chat', {}).get('id')
+        if not user_id or not chat_id:
             return
 
-        # Fetch all active groups
-        active_groups = session.query(ChatGroup).filter_by(is_active=True).all()
-        
-        if not active_groups:
-            logger.info("No active groups to broadcast to.")
+        helper = TelegramHelper()
+        args = message.get('text', '').split()[1:]
+        if not args:
+            watched = live_notifications.get_watchlist(session, user_id)
+            if not watched:
+                await helper.send_message(
+                    chat_id, "👀 Your watchlist is empty.\n\nUse /watch <username> to get a message when they go live."
+                )
+                return
+            lines = [f"{'🔴' if row['is_live'] else '⚪️'} @{row['username']}" for row in watched]
+            await helper.send_message(
+                chat_id,
+                f"👀 Watching {len(watched)}/{live_notifications.WATCHLIST_LIMIT}:\n\n" + "\n".join(lines)
+                + "\n\nUse /unwatch <username> to stop."
+            )
+            return
+
+        username = args[0].lstrip('@').lower()
+        if not IG_USERNAME_RE.match(username):
+            await helper.send_message(chat_id, f"❌ '{args[0]}' is not a valid Instagram username.")
+            return
+
+        outcome = live_notifications.watch(session, user_id, username)
+        session.commit()
+        if outcome == 'added':
+            reply = f"✅ You'll get a message when @{username} goes live."
+        elif outcome == 'exists':
+            reply = f"ℹ️ You're already watching @{username}."
+        else:
+            reply = (f"❌ Your watchlist is full ({live_notifications.WATCHLIST_LIMIT} usernames). "
+                     "Use /unwatch <username> to make room.")
+        logger.info(f"User {user_id} /watch {username}: {outcome}")
+        await helper.send_message(chat_id, reply)
+
+    except Exception as e:
+        logger.error(f"Error in watch_handler: {e}", exc_info=True)
+        session.rollback()
+        raise
+
+
+async def unwatch_handler(session: Session, payload: dict):
+    """Handles /unwatch <username>: removes it from the sender's watchlist."""
+    try:
+        message = payload.get('message', {})
+        user_id = message.get('from', {}).get('id')
+        chat_id = message.get('chat', {}).get('id')
+        if not user_id or not chat_id:
             return
 
         helper = TelegramHelper()
-        success_count = 0
-        fail_count = 0
-        
-        for group in active_groups:
-            try:
-                chat_id = int(group.chat_id)
-                await helper.send_message(chat_id, message_text, parse_mode="Markdown")
-                logger.info(f"Broadcasted message to group {chat_id}.")
-                success_count += 1
-                # Rate limiting
-                await asyncio.sleep(1)
-            except ValueError:
-                logger.warning(f"Could not convert chat_id '{group.chat_id}' to int. Skipping.")
-                fail_count += 1
-            except Exception as e:
-                logger.error(f"Failed to broadcast to group {group.chat_id}: {e}")
-                fail_count += 1
-
-        logger.info(f"Broadcast complete: {success_count} successful, {fail_count} failed")
+        args = message.get('text', '').split()[1:]
+        if not args:
+            await helper.send_message(chat_id, "Usage: /unwatch <username>")
+            return
+
+        username = args[0].lstrip('@').lower()
+        removed = live_notifications.unwatch(session, user_id, username)
+        session.commit()
+        logger.info(f"User {user_id} /unwatch {username}: {'removed' if removed else 'not watched'}")
+        await helper.send_message(
+            chat_id,
+            f"✅ Stopped watching @{username}." if removed else f"ℹ️ You're not watching @{username}."
+        )
 
     except Exception as e:
-        logger.error(f"Error in broadcast_message_handler: {e}", exc_info=True)
+        logger.error(f"Error in unwatch_handler: {e}", exc_info=True)
+        session.rollback()
+        raise
+
+
+async def notify_live_handler(session: Session, payload: dict, job_id: int = None) -> bool:
+    """
+    Handles a notify_live job (queued by the live checker when someone goes
+    live): messages everyone watching the username, once per broadcast (see
+    live_notifications.py). The summary is written to jobs.result.
+
+    Returns:
+        True once every watcher reached a final state, False to have the job retried
+    """
+    broadcast_id = payload.get('broadcast_id')
+    username = payload.get('username')
+    if not broadcast_id or not username:
+        logger.error(f"notify_live job {job_id} is missing broadcast_id or username.")
+        return True  # Retrying would not help
+
+    age = live_notifications.event_age(payload)
+    if age > live_notifications.MAX_AGE_SECONDS:
+        logger.warning(f"Skipping go-live notifications for @{username}: went live {age:.0f}s ago")
+        return True
+
+    try:
+        resolved = await asyncio.to_thread(live_notifications.resolve_watchers, session, broadcast_id, username)
+        if resolved:
+            logger.info(f"@{username} went live: {resolved} watcher(s) to notify")
+
+        helper = TelegramHelper()
+        message = live_notifications.notification_text(username, payload.get('title'))
+        run = await live_notifications.notify_watchers(session, helper, broadcast_id, message)
+
+        counts = await asyncio.to_thread(live_notifications.notification_counts, session, broadcast_id)
+        if job_id is not None:
+            await asyncio.to_thread(fanout.write_job_result, session, job_id, dict(
+                counts,
+                status='completed' if counts['pending'] == 0 else 'incomplete',
+                finished_at=datetime.now(timezone.utc).isoformat(),
+                this_run=run,
+            ))
+        if counts['total']:
+            logger.info(
+                f"Go-live notifications for @{username} ({broadcast_id}): {counts['sent']}/{counts['total']} sent, "
+                f"{counts['failed']} failed, {counts['pending']} pending ({run['messages_per_second']} msgs/sec)"
+            )
+        return counts['pending'] == 0
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Error in notify_live_handler: {e}", exc_info=True)
+        session.rollback()
+        return False
 
 
 async def settings_handler(session: Session, payload: dict):
@@ -777,9 +955,6 @@ async def settings_handler(session: Session, payload: dict):
         callback_query = payload.get('callback_query', {})
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
 
         if not sender_id:
             return
@@ -815,7 +990,7 @@ async def settings_handler(session: Session, payload: dict):
         
         buttons = {"inline_keyboard": lang_buttons}
         
-        await helper.edit_message_text(chat_id, message_id, settings_text, parse_mode="Markdown", reply_markup=buttons)
+        await edit_menu_message(helper, session, callback_query, settings_text, buttons)
         logger.info(f"Displayed settings for user {user.id}")
 
     except Exception as e:
@@ -877,9 +1052,6 @@ async def change_language_handler(session: Session, payload: dict):
         from_user = callback_query.get('from', {})
         sender_id = from_user.get('id')
         username = from_user.get('first_name', 'there')
-        message = callback_query.get('message', {})
-        chat_id = message.get('chat', {}).get('id')
-        message_id = message.get('message_id')
         callback_data = callback_query.get('data', '')
 
         if not sender_id or not callback_data.startswith('lang:'):
@@ -891,8 +1063,6 @@ async def change_language_handler(session: Session, payload: dict):
         if new_lang not in LANGUAGE_NAMES:
             logger.warning(f"Invalid language code: {new_lang}")
             return
-
-        helper = TelegramHelper()
         
         user = session.query(TelegramUser).filter_by(id=sender_id).first()
         if not user:
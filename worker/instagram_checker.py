@@ -3,12 +3,15 @@
 import os
 import logging
 import asyncio
-from datetime import datetime, timezone
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 
-from instagram_service import ensure_instagram_login
+from instagram_pool import get_account_pool
+from circuit_breaker import write_breaker_health
+from live_state import LiveStateTracker
+from checker_lease import CheckerLease, lease_ttl
+from live_notifications import notify_job_enqueuer
 from models import InstaLink
 
 logger = logging.getLogger(__name__)
@@ -24,88 +27,56 @@ def get_random_interval():
     return random.randint(MIN_INTERVAL, MAX_INTERVAL)
 
 
-async def update_live_status_in_db(session_factory):
+async def update_live_status_in_db(session_factory, tracker=None):
     """
     Periodically checks Instagram for live users and updates the database.
-    This runs as a background task in the worker.
+    This runs as a background task in the worker. Polling is spread over
+    the accounts in the pool (instagram_pool.py).
+    Only transitions are written (see live_state.py); subscribe to `tracker`
+    for went_live/ended events. Each go-live queues a notify_live job for the
+    user's watchers (live_notifications.py). Only the holder of the checker
+    lease (checker_lease.py) polls and writes; other instances stand by.
     """
     logger.info("Instagram live checker started.")
+    pool = await get_account_pool(session_factory)
+    # The lease outlasts one pool cycle, so a standby takes over about an interval / N after the leader stops
+    tracker = tracker or LiveStateTracker(lease=CheckerLease(ttl=lease_ttl(pool.cycle_seconds)))
+    tracker.subscribe(notify_job_enqueuer(session_factory))
     
     while True:
         try:
-            # Ensure we're logged in
-            ig_service = await ensure_instagram_login()
+            if tracker.lease and not tracker.lease.held:
+                # Standby: wait for the leader's lease to expire (or for our first claim)
+                await tracker.lease.wait_until_available(session_factory)
+            # Sleeps until the next account is due (staggered), polls it and merges
+            # the latest results of every account
+            live_users = await pool.poll_next()
+            if live_users is None:
+                # No account has a recent result; leave live statuses to the auto-expire job
+                logger.warning(f"No Instagram account available: {pool.health()}")
+                continue
             
             session = session_factory()
             try:
-                logger.info("Checking story tray for live broadcasts...")
-                
-                # Check who's live from the story tray (people you follow)
-                live_users = await ig_service.get_live_users()
-                live_usernames = {user['username'].lstrip('@') for user in live_users}
-                
-                # Update database
-                # 1. First, mark ALL users as offline
-                update_all_offline = text("""
-                    UPDATE insta_links
-                    SET is_live = FALSE,
-                        last_updated = :now
-                    WHERE is_live = TRUE
-                """)
-                session.execute(update_all_offline, {
-                    'now': datetime.now(timezone.utc)
-                })
-                
-                # 2. Then mark/insert users who are currently live
-                for user in live_users:
-                    username = user['username'].lstrip('@')
-                    
-                    # Check if user exists in database
-                    check_query = text("SELECT id FROM insta_links WHERE username = :username")
-                    existing = session.execute(check_query, {'username': username}).fetchone()
-                    
-                    if existing:
-                        # Update existing user
-                        update_query = text("""
-                            UPDATE insta_links
-                            SET is_live = TRUE,
-                                last_live_at = :now,
-                                total_lives = COALESCE(total_lives, 0) + CASE WHEN is_live = FALSE THEN 1 ELSE 0 END,
-                                last_updated = :now
-                            WHERE username = :username
-                        """)
-                        session.execute(update_query, {
-                            'username': username,
-                            'now': datetime.now(timezone.utc)
-                        })
-                        logger.info(f"✅ @{username} is LIVE! (Viewers: {user['viewer_count']})")
-                    else:
-                        # Insert new user
-                        insert_query = text("""
-                            INSERT INTO insta_links (username, is_live, last_live_at, total_lives, last_updated, link)
-                            VALUES (:username, TRUE, :now, 1, :now, :link)
-                        """)
-                        session.execute(insert_query, {
-                            'username': username,
-                            'now': datetime.now(timezone.utc),
-                            'link': f'https://instagram.com/{username}'
-                        })
-                        logger.info(f"✅ NEW USER @{username} is LIVE! (Viewers: {user['viewer_count']})")
-                
-                session.commit()
-                logger.info(f"Live status check complete. {len(live_users)} user(s) are live.")
-                
+                if pool.schedule.stale():
+                    # Re-learn when people go live (live_sessions) to place the poll budget
+                    pool.schedule.refresh(session)
+                # Update database: transitions only, plus the heartbeat
+                changes = tracker.apply(session, live_users)
+                if changes is None:
+                    logger.info("Another checker holds the lease; results discarded")
+                    continue
+                logger.info(
+                    f"Live status check complete. {len(live_users)} user(s) are live "
+                    f"({len(changes['went_live'])} went live, {len(changes['ended'])} ended)."
+                )
             except Exception as e:
                 logger.error(f"Error updating live status: {e}", exc_info=True)
                 session.rollback()
             finally:
+                write_breaker_health(session)
                 session.close()
             
-            # Wait before next check with random interval for stealth
-            next_interval = get_random_interval()
-            logger.info(f"Next check in {next_interval} seconds ({next_interval/60:.1f} minutes)")
-            await asyncio.sleep(next_interval)
-            
         except Exception as e:
             logger.error(f"Critical error in Instagram checker loop: {e}", exc_info=True)
             # On error, wait 3x longer before retrying (exponential backoff)
@@ -0,0 +1,231 @@
+# worker/instagram_pool.py
+#
+# Pool of Instagram accounts polling the story tray on staggered schedules. Each
+# account is its own InstagramService (session file, device fingerprint, request
+# pacing, circuit breaker) and polls at the intervals of the shared poll schedule
+# (poll_schedule.py); the first polls are offset so N accounts spread evenly over
+# one interval. After
+# every poll the latest results of all accounts are merged into one deduplicated
+# live set, so detection latency drops roughly to interval / N for users that
+# several accounts follow, and coverage grows with accounts that follow others.
+# Accounts that fail, fail to log in or have an open breaker sit out a cooldown, and
+# their last results leave the merged set until they poll successfully again.
+#
+# Accounts come from IG_ACCOUNTS, a JSON list:
+#   [{"username": "...", "password": "...", "session_file": "...", "device": {...}}, ...]
+# (session_file and device are optional). Without it, IG_USERNAME/IG_PASSWORD is a
+# pool of one with the usual instagram_session.json. With IG_SESSION_KEY set, sessions
+# live in the shared encrypted instagram_sessions table instead (session_store.py).
+
+import os
+import json
+import time
+import asyncio
+import logging
+
+from circuit_breaker import CircuitOpenError
+from instagram_service import (
+    InstagramService, DEFAULT_SESSION_FILE, DEVICE_PROFILES, IG_USERNAME, IG_PASSWORD,
+)
+from poll_schedule import AdaptiveSchedule, MIN_INTERVAL, MAX_INTERVAL
+from session_store import get_session_store
+
+logger = logging.getLogger(__name__)
+
+# Cooldown after a failed poll grows with consecutive failures, up to MAX_COOLDOWN
+FAILURE_COOLDOWN = 300
+MAX_COOLDOWN = 3600
+# Retry a failed login after this long
+LOGIN_COOLDOWN = 1800
+# An account's results drop out of the merged set once this old, or as soon as it cools down
+RESULT_TTL = 2 * MAX_INTERVAL
+
+
+def load_accounts():
+    """Account configs from IG_ACCOUNTS, else the single IG_USERNAME/IG_PASSWORD account."""
+    raw = os.environ.get('IG_ACCOUNTS')
+    if raw:
+        accounts = json.loads(raw)
+        if not isinstance(accounts, list) or not all(a.get('username') and a.get('password') for a in accounts):
+            raise ValueError("IG_ACCOUNTS must be a JSON list of objects with username and password")
+        return accounts
+    if IG_USERNAME and IG_PASSWORD:
+        return [{'username': IG_USERNAME, 'password': IG_PASSWORD}]
+    raise ValueError("Instagram credentials not configured. Set IG_ACCOUNTS or IG_USERNAME and IG_PASSWORD.")
+
+
+class PooledAccount:
+    """One account's service, schedule and health."""
+
+    def __init__(self, service, next_poll_at):
+        self.service = service
+        self.next_poll_at = next_poll_at
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.polls = 0
+        self.failures = 0
+        self.last_success_at = None
+        self.last_error = None
+        self.results = []
+        self.results_at = None  # when `results` were polled; None once they no longer count
+
+    def cool_down(self, seconds, error):
+        """
+        Sit out `seconds` and withdraw the last results from the merged set:
+        an account that is not polling gives no absence signal, so its old
+        positives would keep ended users live.
+        """
+        self.cooldown_until = time.monotonic() + seconds
+        self.last_error = str(error)
+        self.results = []
+        self.results_at = None
+
+    @property
+    def username(self):
+        return self.service.username
+
+    def available_at(self):
+        return max(self.next_poll_at, self.cooldown_until)
+
+    def health(self, now=None):
+        now = now or time.monotonic()
+        return {
+            'username': self.username,
+            'logged_in': self.service.is_logged_in,
+            'cooldown_seconds': max(0, round(self.cooldown_until - now)),
+            'next_poll_seconds': max(0, round(self.available_at() - now)),
+            'polls': self.polls,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'last_success_age': round(now - self.last_success_at) if self.last_success_at else None,
+            'last_error': self.last_error,
+            'live_seen': len(self.results),
+            'last_fetch': self.service.last_fetch,
+        }
+
+
+class InstagramAccountPool:
+    """Staggered multi-account live polling with a merged, deduplicated live set."""
+
+    def __init__(self, accounts=None, schedule=None, session_store=None):
+        accounts = accounts if accounts is not None else load_accounts()
+        # Per-account intervals; the checker refreshes it from live history
+        self.schedule = schedule or AdaptiveSchedule()
+        now = time.monotonic()
+        stagger = (MIN_INTERVAL + MAX_INTERVAL) / 2 / max(len(accounts), 1)
+        self.accounts = []
+        for i, config in enumerate(accounts):
+            service = InstagramService(
+                config['username'],
+                config['password'],
+                session_file=config.get('session_file') or (
+                    DEFAULT_SESSION_FILE if i == 0 else f"instagram_session_{config['username']}.json"
+                ),
+                device=config.get('device') or DEVICE_PROFILES[i % len(DEVICE_PROFILES)],
+                session_store=session_store,
+            )
+            self.accounts.append(PooledAccount(service, next_poll_at=now + i * stagger))
+        logger.info(f"Instagram pool: {len(self.accounts)} account(s), polls staggered by {stagger:.0f}s")
+
+    @property
+    def cycle_seconds(self):
+        """Longest gap between two polls of the pool: accounts are staggered over one interval."""
+        return MAX_INTERVAL / max(len(self.accounts), 1)
+
+    async def login_all(self):
+        """Log in every account; failures go into login cooldown and are retried later."""
+        for account in self.accounts:
+            await self._login(account)
+
+    async def _login(self, account):
+        if await account.service.login():
+            return True
+        account.cool_down(LOGIN_COOLDOWN, "login failed")
+        logger.warning(f"Instagram login failed for {account.username}; retrying in {LOGIN_COOLDOWN}s")
+        return False
+
+    async def poll_next(self):
+        """
+        Wait for the next account(s) to come due, poll them and return the
+        merged live set (list of get_live_users dicts, one per username), or
+        None while no account has a recent result.
+        """
+        wait = min(account.available_at() for account in self.accounts) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        now = time.monotonic()
+        due = [account for account in self.accounts if account.available_at() <= now]
+        await asyncio.gather(*(self._poll(account) for account in due))
+        return self.merged()
+
+    async def _poll(self, account):
+        account.next_poll_at = time.monotonic() + self.schedule.next_interval()
+        if not account.service.is_logged_in and not await self._login(account):
+            return
+        account.polls += 1
+        try:
+            failures_before = account.service.breaker.consecutive_failures
+            results = await account.service.get_live_users()
+        except CircuitOpenError as e:
+            # The account's breaker is open (blocked/rate-limited); sit out its reset timeout
+            account.cool_down(e.retry_after, e)
+            logger.warning(f"Instagram account {account.username} in cooldown for {e.retry_after:.0f}s")
+            return
+        if account.service.breaker.consecutive_failures > failures_before:
+            # get_live_users swallows errors and returns []; the breaker tells us it failed
+            self._record_failure(account, account.service.breaker.last_error or "poll failed")
+            return
+        account.results = results
+        account.last_success_at = account.results_at = time.monotonic()
+        account.consecutive_failures = 0
+        account.last_error = None
+
+    def _record_failure(self, account, error):
+        account.failures += 1
+        account.consecutive_failures += 1
+        cooldown = min(MAX_COOLDOWN, FAILURE_COOLDOWN * 2 ** (account.consecutive_failures - 1))
+        account.cool_down(cooldown, error)
+        logger.warning(
+            f"Instagram account {account.username} poll failed ({error}); cooling down {cooldown}s"
+        )
+
+    def merged(self):
+        """
+        Union of every account's recent results, one entry per username
+        (freshest poll wins). Accounts in cooldown contribute nothing. None
+        when no account has a recent result, so callers leave live statuses
+        alone instead of ending everyone.
+        """
+        now = time.monotonic()
+        fresh = sorted(
+            (a for a in self.accounts if a.results_at and now - a.results_at <= RESULT_TTL),
+            key=lambda a: a.results_at,
+        )
+        if not fresh:
+            return None
+        live = {}
+        for account in fresh:
+            for user in account.results:
+                live[user['username'].lstrip('@').lower()] = user
+        return list(live.values())
+
+    def health(self):
+        """Per-account health for logs and monitoring."""
+        now = time.monotonic()
+        return [account.health(now) for account in self.accounts]
+
+
+_pool = None
+
+
+async def get_account_pool(session_factory=None):
+    """
+    Get or create the process-wide pool, logging its accounts in on first use.
+    Sessions are shared through the database when session_factory is given and
+    IG_SESSION_KEY is set.
+    """
+    global _pool
+    if _pool is None:
+        _pool = InstagramAccountPool(session_store=get_session_store(session_factory))
+        await _pool.login_all()
+    return _pool
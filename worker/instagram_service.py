@@ -2,16 +2,74 @@
 
 import os
 import sys
+import json
+import time
+import hashlib
 import logging
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import List, Dict, Optional
 
+from circuit_breaker import get_breaker
+from session_store import SAVE_INTERVAL
+from reels_tray import (
+    REELS_TRAY, REELS_TRAY_PARSED, TIMELINE_FEED, REELS_TRAY_ENDPOINT, TrayFormatError, extract_broadcasts,
+    live_users_from_broadcasts,
+)
+
 logger = logging.getLogger(__name__)
 # Instagram credentials from environment
 IG_USERNAME = os.environ.get('IG_USERNAME')
 IG_PASSWORD = os.environ.get('IG_PASSWORD')
 
+# instagrapi is synchronous; every call runs on the service's own thread with these timeouts
+CALL_TIMEOUT = float(os.environ.get('IG_CALL_TIMEOUT', '60'))
+# Login can wait up to 5 minutes for a challenge code (challenge_handler.py)
+LOGIN_TIMEOUT = float(os.environ.get('IG_LOGIN_TIMEOUT', '600'))
+
+DEFAULT_SESSION_FILE = "instagram_session.json"
+# Realistic Android fingerprints; pool accounts (instagram_pool.py) each get a different one
+DEVICE_PROFILES = [
+    {   # Samsung Galaxy S10
+        "app_version": "269.0.0.18.75",
+        "android_version": 28,
+        "android_release": "9.0",
+        "dpi": "480dpi",
+        "resolution": "1080x2340",
+        "manufacturer": "Samsung",
+        "device": "SM-G973F",
+        "model": "Galaxy S10",
+        "cpu": "exynos9820",
+        "version_code": "314665256"
+    },
+    {   # Google Pixel 5
+        "app_version": "269.0.0.18.75",
+        "android_version": 30,
+        "android_release": "11",
+        "dpi": "440dpi",
+        "resolution": "1080x2340",
+        "manufacturer": "Google",
+        "device": "redfin",
+        "model": "Pixel 5",
+        "cpu": "redfin",
+        "version_code": "314665256"
+    },
+    {   # OnePlus 8
+        "app_version": "269.0.0.18.75",
+        "android_version": 29,
+        "android_release": "10",
+        "dpi": "420dpi",
+        "resolution": "1080x2400",
+        "manufacturer": "OnePlus",
+        "device": "OnePlus8",
+        "model": "IN2013",
+        "cpu": "qcom",
+        "version_code": "314665256"
+    },
+]
+
 
 class InstagramService:
     """
@@ -20,27 +78,65 @@ class InstagramService:
     
     Note: This requires persistent session state, so it should run
     in a long-lived worker process (Railway/VPS), NOT in Vercel.
+    
+    instagrapi blocks (request delays included), so each service runs its
+    client on a dedicated single thread: calls are serialized per account,
+    accounts proceed in parallel, and the event loop is never blocked. A call
+    that times out or is cancelled keeps running on that thread; later calls
+    queue behind it.
+    
+    With a session_store (session_store.py) the session is loaded from and
+    saved to the shared encrypted table only; session_file is neither read
+    nor imported, so a session is first stored by a fresh login.
     """
     
-    def __init__(self, username: str = None, password: str = None):
+    def __init__(self, username: str = None, password: str = None, session_file: str = None,
+                 device: Dict = None, delay_range: List[int] = None, session_store=None):
         self.username = username or IG_USERNAME
         self.password = password or IG_PASSWORD
         self.client = None
         self.is_logged_in = False
-        self.session_file = "instagram_session.json"
+        self.session_file = session_file or DEFAULT_SESSION_FILE
+        self.device = device or DEVICE_PROFILES[0]
+        # Random delay between instagrapi requests (stealth)
+        self.delay_range = delay_range or [3, 7]
+        self.session_store = session_store
+        self._session_version = 0
+        self._session_digest = None
+        self._session_saved_at = 0.0
+        # Source, timing and size of the last live check (reels_tray.py paths)
+        self.last_fetch = None
         
         if not self.username or not self.password:
             raise ValueError("Instagram credentials not configured. Set IG_USERNAME and IG_PASSWORD environment variables.")
+
+        # Instagram rate-limits/blocks are sticky; back off for minutes, not seconds
+        self.breaker = get_breaker(f"instagram:{self.username}", failure_threshold=3, reset_timeout=600)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"instagram-{self.username}")
+    
+    async def _run(self, func, *args, timeout: float = CALL_TIMEOUT, **kwargs):
+        """Run a blocking instagrapi call on this account's thread; raises asyncio.TimeoutError"""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout)
     
     async def login(self) -> bool:
         """
         Login to Instagram and maintain session.
         Returns True if successful, False otherwise.
         """
+        try:
+            return await self._run(self._login_sync, timeout=LOGIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Instagram login for {self.username} timed out after {LOGIN_TIMEOUT:.0f}s")
+            self.is_logged_in = False
+            return False
+    
+    def _login_sync(self) -> bool:
+        """Blocking login; runs on the service thread"""
         try:
             # Import instagrapi here to avoid issues if not installed
             from instagrapi import Client
-            from instagrapi.exceptions import ChallengeRequired, TwoFactorRequired
             
             self.client = Client()
             
@@ -48,51 +144,74 @@ class InstagramService:
             self.client.challenge_code_handler = self._challenge_code_handler
             
             # Stealth settings to avoid detection/bans
-            self.client.delay_range = [3, 7]  # Random 3-7 second delays between requests
+            self.client.delay_range = self.delay_range
             
-            # Set realistic device fingerprint (Samsung Galaxy S10)
+            # Set realistic device fingerprint
             try:
-                self.client.set_device({
-                    "app_version": "269.0.0.18.75",
-                    "android_version": 28,
-                    "android_release": "9.0",
-                    "dpi": "480dpi",
-                    "resolution": "1080x2340",
-                    "manufacturer": "Samsung",
-                    "device": "SM-G973F",
-                    "model": "Galaxy S10",
-                    "cpu": "exynos9820",
-                    "version_code": "314665256"
-                })
-                logger.info("Device fingerprint set to Samsung Galaxy S10")
+                self.client.set_device(self.device)
+                logger.info(f"Device fingerprint set to {self.device.get('manufacturer')} {self.device.get('model')}")
             except Exception as e:
                 logger.debug(f"Could not set device fingerprint: {e}")
             
-            # Try to load existing session
-            if os.path.exists(self.session_file):
+            # Try to load existing session: the shared store, else the local file
+            settings, source = self._load_session_settings()
+            if settings is not None:
                 try:
-                    logger.info("Attempting to load existing Instagram session...")
-                    self.client.load_settings(self.session_file)
+                    logger.info(f"Attempting to load existing Instagram session from {source}...")
+                    self.client.set_settings(settings)
                     
                     # Verify session is valid by getting user info
+                    loaded = False
                     try:
                         user_id = self.client.user_id
                         if user_id:
                             logger.info(f"Successfully loaded Instagram session. User ID: {user_id}")
-                            self.is_logged_in = True
-                            return True
+                            loaded = True
                     except:
                         # Try to get timeline as fallback
                         self.client.get_timeline_feed()
-                        logger.info("Successfully loaded Instagram session from file.")
+                        logger.info(f"Successfully loaded Instagram session from {source}.")
+                        loaded = True
+                    if loaded:
                         self.is_logged_in = True
                         return True
                         
                 except Exception as e:
-                    logger.warning(f"Could not load session file: {e}. Will perform fresh login.")
+                    logger.warning(f"Could not load session from {source}: {e}. Will perform fresh login.")
                     # Don't delete the file yet, might be usable
                     pass
             
+            if self.session_store:
+                # Only one process logs an account in; the others pick up its session
+                if not self.session_store.claim_refresh(self.username, LOGIN_TIMEOUT):
+                    logger.info(f"Another process is logging {self.username} in; waiting for its session")
+                    settings = self.session_store.wait_for_refresh(self.username, self._session_version,
+                                                                   LOGIN_TIMEOUT)
+                    if settings is None:
+                        logger.warning(f"No new session for {self.username} from the other process")
+                        return False
+                    self.client.set_settings(settings)
+                    self.is_logged_in = True
+                    return True
+                try:
+                    return self._fresh_login_sync()
+                finally:
+                    self.session_store.release_refresh(self.username)
+            return self._fresh_login_sync()
+            
+        except ImportError:
+            logger.error("instagrapi library not installed. Run: pip install instagrapi")
+            raise
+        except Exception as e:
+            logger.error(f"Instagram login failed: {e}", exc_info=True)
+            self.is_logged_in = False
+            return False
+    
+    def _fresh_login_sync(self) -> bool:
+        """Username/password login (with challenge handling); saves the new session"""
+        from instagrapi.exceptions import ChallengeRequired, TwoFactorRequired
+        
+        try:
             # Fresh login
             logger.info(f"Logging into Instagram as {self.username}...")
             
@@ -100,7 +219,7 @@ class InstagramService:
                 self.client.login(self.username, self.password)
                 
                 # Save session for future use
-                self.client.dump_settings(self.session_file)
+                self._save_session_sync(force=True)
                 logger.info("Instagram login successful and session saved.")
                 self.is_logged_in = True
                 return True
@@ -116,7 +235,7 @@ class InstagramService:
                     self.client.login(self.username, self.password)
                     
                     # Save session after successful challenge
-                    self.client.dump_settings(self.session_file)
+                    self._save_session_sync(force=True)
                     logger.info("Challenge completed successfully!")
                     self.is_logged_in = True
                     return True
@@ -137,14 +256,58 @@ class InstagramService:
                 logger.info("Please disable 2FA or use backup codes.")
                 return False
             
-        except ImportError:
-            logger.error("instagrapi library not installed. Run: pip install instagrapi")
-            raise
         except Exception as e:
             logger.error(f"Instagram login failed: {e}", exc_info=True)
             self.is_logged_in = False
             return False
     
+    def _load_session_settings(self):
+        """
+        Stored settings for this account and where they came from. With a
+        session store only the store is read: a local session_file (possibly
+        one checked into the repo) is never imported into it.
+        """
+        if self.session_store:
+            try:
+                settings, self._session_version = self.session_store.load(self.username)
+                if settings is not None:
+                    return settings, "the session store"
+            except Exception as e:
+                logger.warning(f"Could not read the session store for {self.username}: {e}")
+            return None, None
+        if os.path.exists(self.session_file):
+            try:
+                with open(self.session_file) as f:
+                    return json.load(f), self.session_file
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read session file {self.session_file}: {e}")
+        return None, None
+    
+    def _save_session_sync(self, force: bool = False):
+        """
+        Persist the client's settings (store, else session_file) if they
+        changed; runs on the service thread
+        """
+        settings = self.client.get_settings()
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+        self._session_saved_at = time.monotonic()
+        if digest == self._session_digest and not force:
+            return
+        if self.session_store:
+            self._session_version = self.session_store.save(self.username, settings)
+        else:
+            self.client.dump_settings(self.session_file)
+        self._session_digest = digest
+    
+    async def _persist_session(self):
+        """Save the session after a successful call, at most every SAVE_INTERVAL seconds"""
+        if time.monotonic() - self._session_saved_at < SAVE_INTERVAL:
+            return
+        try:
+            await self._run(self._save_session_sync)
+        except Exception as e:
+            logger.warning(f"Could not save the Instagram session for {self.username}: {e}")
+    
     def _challenge_code_handler(self, username, choice):
         """Handler for challenge verification codes"""
         logger.info(f"Challenge required for {username}. Choice: {choice}")
@@ -196,6 +359,14 @@ class InstagramService:
         Check which users are currently live by checking the story tray.
         This is the same as the live bar you see at the top of Instagram.
         
+        One tray-only request per check: the raw feed/reels_tray/ body is
+        searched for its broadcasts array (reels_tray.py). The instagrapi
+        parsed request and the (much larger) timeline feed are fallbacks
+        only when a response cannot be parsed (TrayFormatError). HTTP errors
+        (4xx, 429 throttling), timeouts and network failures fail the poll
+        at once, so a throttled account is not sent three requests. Each
+        result, and self.last_fetch, records the path that produced it.
+        
         Args:
             usernames: Optional list of usernames to filter (not used, kept for compatibility)
             
@@ -206,7 +377,8 @@ class InstagramService:
                     'username': '@username',
                     'broadcast_id': '12345',
                     'viewer_count': 150,
-                    'started_at': datetime_obj
+                    'started_at': datetime_obj,
+                    'source': 'reels_tray'
                 }
             ]
         """
@@ -214,73 +386,120 @@ class InstagramService:
             logger.error("Not logged into Instagram. Call login() first.")
             return []
         
-        live_users = []
+        # Raises CircuitOpenError while Instagram is failing, so callers can back off
+        self.breaker.before_call()
+        errors = []
         
         try:
-            # Get timeline feed which includes live broadcasts
             logger.info("Checking for live broadcasts...")
-            
-            # Method 1: Try to get reels/stories feed
-            try:
-                # Get the user's feed which includes stories/lives
-                feed = self.client.get_timeline_feed()
-                
-                # Check if feed has broadcast info
-                if hasattr(feed, 'broadcast') and feed.broadcast:
-                    broadcasts = feed.broadcast if isinstance(feed.broadcast, list) else [feed.broadcast]
-                    for broadcast in broadcasts:
-                        try:
-                            if hasattr(broadcast, 'broadcast_status') and broadcast.broadcast_status == 'active':
-                                username = broadcast.user.username if hasattr(broadcast, 'user') else 'unknown'
-                                live_users.append({
-                                    'username': f'@{username}',
-                                    'broadcast_id': str(broadcast.id),
-                                    'viewer_count': getattr(broadcast, 'viewer_count', 0),
-                                    'started_at': datetime.now(timezone.utc),
-                                    'title': getattr(broadcast, 'title', ''),
-                                    'user_id': broadcast.user.pk if hasattr(broadcast, 'user') else None
-                                })
-                                logger.info(f"✅ @{username} is LIVE with {getattr(broadcast, 'viewer_count', 0)} viewers")
-                        except Exception as e:
-                            logger.debug(f"Error processing broadcast: {e}")
-                            continue
-            except Exception as e:
-                logger.debug(f"Timeline feed method failed: {e}")
-            
-            # Method 2: Try direct API call for reels tray
-            if not live_users:
+            for source, fetch in ((REELS_TRAY, self._fetch_tray_raw), (REELS_TRAY_PARSED, self._fetch_tray_parsed),
+                                  (TIMELINE_FEED, self._fetch_timeline)):
                 try:
-                    # Use the private API endpoint directly
-                    result = self.client.private_request("feed/reels_tray/")
-                    
-                    if result and 'broadcasts' in result:
-                        for broadcast_data in result['broadcasts']:
-                            try:
-                                if broadcast_data.get('broadcast_status') == 'active':
-                                    user_data = broadcast_data.get('broadcast_owner', {})
-                                    username = user_data.get('username', 'unknown')
-                                    live_users.append({
-                                        'username': f'@{username}',
-                                        'broadcast_id': str(broadcast_data.get('id', '')),
-                                        'viewer_count': broadcast_data.get('viewer_count', 0),
-                                        'started_at': datetime.now(timezone.utc),
-                                        'title': broadcast_data.get('title', ''),
-                                        'user_id': user_data.get('pk')
-                                    })
-                                    logger.info(f"✅ @{username} is LIVE with {broadcast_data.get('viewer_count', 0)} viewers")
-                            except Exception as e:
-                                logger.debug(f"Error processing broadcast data: {e}")
-                                continue
-                except Exception as e:
-                    logger.debug(f"Direct API call failed: {e}")
+                    live_users = await self._run(fetch)
+                except TrayFormatError as e:
+                    errors.append(e)
+                    logger.warning(f"Live check via {source} returned an unexpected response: {e}")
+                    continue
+                
+                for user in live_users:
+                    logger.info(f"✅ {user['username']} is LIVE with {user['viewer_count']} viewers")
+                logger.info(f"Found {len(live_users)} live users (via {source})")
+                self.breaker.record_success()
+                await self._persist_session()
+                return live_users
             
-            logger.info(f"Found {len(live_users)} live users")
-            return live_users
+            # No path returned a usable response: treat as an outage/block, not "nobody live"
+            self.breaker.record_failure(errors[-1])
+            logger.warning(f"All live check paths failed for {self.username}: {errors[-1]}")
+            return []
             
         except Exception as e:
+            self.breaker.record_failure(e)
             logger.error(f"Error getting live users: {e}", exc_info=True)
             return []
     
+    def _record_fetch(self, source: str, started: float, body_bytes: int, wire_bytes: int, parse_started: float,
+                      broadcasts: int):
+        self.last_fetch = {
+            'source': source,
+            'seconds': round(time.perf_counter() - started, 3),
+            'parse_ms': round((time.perf_counter() - parse_started) * 1000, 2),
+            'body_bytes': body_bytes,
+            'wire_bytes': wire_bytes,
+            'broadcasts': broadcasts,
+        }
+    
+    def _fetch_tray_raw(self) -> List[Dict]:
+        """
+        GET feed/reels_tray/ on the client's authenticated HTTP session and
+        parse only its broadcasts array; runs on the service thread
+        """
+        from instagrapi import config
+        from instagrapi.utils import random_delay
+        
+        started = time.perf_counter()
+        if self.client.delay_range:
+            random_delay(delay_range=self.client.delay_range)
+        self.client.private.headers.update(self.client.base_headers)
+        response = self.client.private.get(
+            f"https://{config.API_DOMAIN}/api/v1/{REELS_TRAY_ENDPOINT}", timeout=CALL_TIMEOUT
+        )
+        response.raise_for_status()
+        content = response.content
+        parse_started = time.perf_counter()
+        broadcasts = extract_broadcasts(content)
+        live_users = live_users_from_broadcasts(broadcasts, REELS_TRAY)
+        self._record_fetch(REELS_TRAY, started, len(content),
+                           int(response.headers.get('Content-Length') or len(content)), parse_started,
+                           len(broadcasts))
+        return live_users
+    
+    def _fetch_tray_parsed(self) -> List[Dict]:
+        """feed/reels_tray/ through instagrapi (full JSON parse); runs on the service thread"""
+        from instagrapi.exceptions import ClientJSONDecodeError
+        
+        started = time.perf_counter()
+        try:
+            result = self.client.private_request(REELS_TRAY_ENDPOINT)
+        except ClientJSONDecodeError as e:
+            raise TrayFormatError(f"unreadable reels_tray response: {e}") from e
+        parse_started = time.perf_counter()
+        if not isinstance(result, dict) or 'broadcasts' not in result:
+            raise TrayFormatError("no broadcasts array in the reels_tray response")
+        broadcasts = result['broadcasts'] or []
+        live_users = live_users_from_broadcasts(broadcasts, REELS_TRAY_PARSED)
+        body = len(self.client.last_response.content) if self.client.last_response is not None else 0
+        self._record_fetch(REELS_TRAY_PARSED, started, body, body, parse_started, len(broadcasts))
+        return live_users
+    
+    def _fetch_timeline(self) -> List[Dict]:
+        """The home feed's broadcast field (heavy request); runs on the service thread"""
+        started = time.perf_counter()
+        feed = self.client.get_timeline_feed()
+        parse_started = time.perf_counter()
+        live_users = []
+        if hasattr(feed, 'broadcast') and feed.broadcast:
+            broadcasts = feed.broadcast if isinstance(feed.broadcast, list) else [feed.broadcast]
+            for broadcast in broadcasts:
+                try:
+                    if hasattr(broadcast, 'broadcast_status') and broadcast.broadcast_status == 'active':
+                        username = broadcast.user.username if hasattr(broadcast, 'user') else 'unknown'
+                        live_users.append({
+                            'username': f'@{username}',
+                            'broadcast_id': str(broadcast.id),
+                            'viewer_count': getattr(broadcast, 'viewer_count', 0),
+                            'started_at': datetime.now(timezone.utc),
+                            'title': getattr(broadcast, 'title', ''),
+                            'user_id': broadcast.user.pk if hasattr(broadcast, 'user') else None,
+                            'source': TIMELINE_FEED,
+                        })
+                except Exception as e:
+                    logger.debug(f"Error processing broadcast: {e}")
+                    continue
+        body = len(self.client.last_response.content) if self.client.last_response is not None else 0
+        self._record_fetch(TIMELINE_FEED, started, body, body, parse_started, len(live_users))
+        return live_users
+    
     async def check_user_live(self, username: str) -> Optional[Dict]:
         """
         Check if a single user is live.
@@ -312,7 +531,7 @@ class InstagramService:
             logger.info("Fetching live broadcasts from following feed...")
             
             # Use the reels_tray endpoint which includes live broadcasts
-            broadcasts = self.client.get_reels_tray_feed()
+            broadcasts = await self._run(self.client.get_reels_tray_feed)
             
             live_users = []
             if broadcasts and hasattr(broadcasts, 'broadcasts'):
@@ -0,0 +1,260 @@
+# worker/live_notifications.py
+#
+# Go-live notifications for user watchlists (add_watchlists.sql). The live checker
+# only enqueues one notify_live job per went-live event (a single INSERT), so it is
+# never held up by the fan-out. The job copies the broadcast's watchers from
+# watchlists into the live_notifications outbox with one INSERT ... SELECT, which is
+# idempotent per (broadcast_id, user_id): a retried, deferred or duplicate job only
+# sends to watchers still pending. Sends run concurrently at the bot's adaptive
+# rate (rate_controller.py, up to Telegram's ~30 msgs/sec) through fanout.send_all,
+# and outcomes are written in batches. Watchers who blocked the bot are dropped
+# from watchlists.
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from fanout import FAULT_GONE, ResultBuffer, send_all
+from message_template import escape
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CONCURRENCY = int(os.environ.get('LIVE_NOTIFY_CONCURRENCY', '20'))
+# Outcomes written per transaction (at least every fanout.RESULT_FLUSH_SECONDS)
+RESULT_BATCH_SIZE = 500
+# A notify_live job this much older than the go-live (e.g. deferred through an outage)
+# sends nothing: the broadcast is most likely over
+MAX_AGE_SECONDS = int(os.environ.get('LIVE_NOTIFY_MAX_AGE', '3600'))
+# Watched usernames per Telegram user
+WATCHLIST_LIMIT = int(os.environ.get('WATCHLIST_LIMIT', '50'))
+
+# Bot API descriptions meaning the user can never receive a message from the bot
+USER_GONE_ERRORS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+    "chat not found",
+    "bot can't initiate conversation",
+)
+
+
+def _classify(status, description):
+    description = (description or '').lower()
+    return FAULT_GONE if any(marker in description for marker in USER_GONE_ERRORS) else None
+
+
+def notification_key(event):
+    """Dedup key of a went-live event: the broadcast_id, else username and time."""
+    return str(event.get('broadcast_id') or f"{event['username']}@{event['at']}")
+
+
+def enqueue_notify_job(session, event, bot_token=None):
+    """Queue a notify_live job for a went_live event. The caller commits."""
+    session.execute(text("""
+        INSERT INTO jobs (job_type, bot_token, payload, status, created_at, updated_at)
+        VALUES ('notify_live', :bot_token, :payload, 'pending', NOW(), NOW())
+    """), {
+        'bot_token': bot_token or os.environ.get('BOT_TOKEN'),
+        'payload': json.dumps({
+            'broadcast_id': notification_key(event),
+            'username': event['username'],
+            'title': event.get('title'),
+            'at': event['at'],
+        }),
+    })
+
+
+def notify_job_enqueuer(session_factory, bot_token=None):
+    """
+    LiveStateTracker subscriber that queues a notify_live job for every
+    went_live event. Watchers are resolved by the job, not here.
+    """
+    bot_token = bot_token or os.environ.get('BOT_TOKEN')
+    if not bot_token:
+        logger.warning("BOT_TOKEN not set; go-live notification jobs will not be picked up by a worker")
+
+    def enqueue(event):
+        if event['event'] != 'went_live':
+            return
+        session = session_factory()
+        try:
+            enqueue_notify_job(session, event, bot_token)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    return enqueue
+
+
+def watch(session, user_id, username):
+    """
+    Add a username to a user's watchlist. Returns 'added', 'exists' or 'full'.
+    The caller commits.
+    """
+    row = session.execute(text("""
+        WITH current AS (
+            SELECT COUNT(*) AS watched, BOOL_OR(username = :username) AS already
+            FROM watchlists WHERE user_id = :user_id
+        )
+        INSERT INTO watchlists (user_id, username)
+        SELECT :user_id, :username FROM current
+        WHERE NOT COALESCE(already, FALSE) AND watched < :limit
+        ON CONFLICT DO NOTHING
+        RETURNING username
+    """), {'user_id': user_id, 'username': username, 'limit': WATCHLIST_LIMIT}).fetchone()
+    if row:
+        return 'added'
+    exists = session.execute(text("""
+        SELECT 1 FROM watchlists WHERE user_id = :user_id AND username = :username
+    """), {'user_id': user_id, 'username': username}).fetchone()
+    return 'exists' if exists else 'full'
+
+
+def unwatch(session, user_id, username):
+    """Remove a username from a user's watchlist; True if it was there. The caller commits."""
+    return session.execute(text("""
+        DELETE FROM watchlists WHERE user_id = :user_id AND username = :username
+    """), {'user_id': user_id, 'username': username}).rowcount > 0
+
+
+def get_watchlist(session, user_id):
+    """A user's watched usernames with their live status."""
+    rows = session.execute(text("""
+        SELECT w.username, COALESCE(l.is_live, FALSE) AS is_live
+        FROM watchlists w
+        LEFT JOIN insta_links l ON l.username = w.username
+        WHERE w.user_id = :user_id
+        ORDER BY w.username
+    """), {'user_id': user_id}).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def resolve_watchers(session, broadcast_id, username):
+    """
+    Copy the username's watchers into the outbox as pending notifications.
+    Watchers already there for this broadcast are skipped.
+    """
+    inserted = session.execute(text("""
+        INSERT INTO live_notifications (broadcast_id, user_id, username)
+        SELECT :broadcast_id, user_id, username
+        FROM watchlists
+        WHERE username = :username
+        ON CONFLICT (broadcast_id, user_id) DO NOTHING
+    """), {'broadcast_id': broadcast_id, 'username': username.lstrip('@').lower()}).rowcount
+    session.commit()
+    return inserted
+
+
+def load_pending(session, broadcast_id):
+    rows = session.execute(text("""
+        SELECT user_id, attempts
+        FROM live_notifications
+        WHERE broadcast_id = :broadcast_id AND state = 'pending'
+        ORDER BY user_id
+    """), {'broadcast_id': broadcast_id}).fetchall()
+    return [(row.user_id, row.attempts) for row in rows]
+
+
+def notification_counts(session, broadcast_id):
+    row = session.execute(text("""
+        SELECT COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE state = 'sent') AS sent,
+               COUNT(*) FILTER (WHERE state = 'failed') AS failed,
+               COUNT(*) FILTER (WHERE state = 'pending') AS pending
+        FROM live_notifications WHERE broadcast_id = :broadcast_id
+    """), {'broadcast_id': broadcast_id}).fetchone()
+    return dict(row._mapping)
+
+
+def notification_text(username, title=None, parse_mode='Markdown'):
+    """
+    The go-live message, with the username and title escaped for `parse_mode`.
+    Values stay outside bold/italic entities: legacy Markdown has no escapes
+    inside an entity, so `*@john\\_doe*` would show the backslash.
+    """
+    username = username.lstrip('@')
+    message = f"🔴 {escape('@' + username, parse_mode)} is *LIVE* on Instagram!\n"
+    if title:
+        message += f"\n📝 {escape(title, parse_mode)}\n"
+    message += f"\n👉 {escape('https://instagram.com/' + username, parse_mode)}"
+    return message
+
+
+class NotificationWriter(ResultBuffer):
+    """
+    Writes a batch of outcomes to the outbox in one transaction and drops the
+    watchlists of users the bot can no longer reach.
+    """
+
+    def __init__(self, session, broadcast_id, **kwargs):
+        super().__init__(**kwargs)
+        self.session = session
+        self.broadcast_id = broadcast_id
+
+    def write(self, rows):
+        if not rows:
+            return
+        try:
+            self.session.execute(text("""
+                UPDATE live_notifications n
+                SET state = v.state, attempts = v.attempts, error = v.error,
+                    sent_at = CASE WHEN v.state = 'sent' THEN NOW() ELSE n.sent_at END
+                FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:states AS TEXT[]),
+                            CAST(:attempts AS INTEGER[]), CAST(:errors AS TEXT[]))
+                     AS v(user_id, state, attempts, error)
+                WHERE n.broadcast_id = :broadcast_id AND n.user_id = v.user_id
+            """), {
+                'broadcast_id': self.broadcast_id,
+                'user_ids': [row[0] for row in rows],
+                'states': [row[1] for row in rows],
+                'attempts': [row[2] for row in rows],
+                'errors': [row[4] for row in rows],
+            })
+            gone = sorted({row[0] for row in rows if row[5] == FAULT_GONE})
+            if gone:
+                self.session.execute(text("""
+                    DELETE FROM watchlists WHERE user_id = ANY(CAST(:user_ids AS BIGINT[]))
+                """), {'user_ids': gone})
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+
+async def notify_watchers(session, helper, broadcast_id, message, parse_mode='Markdown', concurrency=None):
+    """
+    Send `message` to every pending watcher of the broadcast. See
+    fanout.send_all for retries and errors.
+
+    Returns:
+        Dict with this run's sent/failed/left_pending/unreachable counts,
+        requests and rate
+    """
+    pending = await asyncio.to_thread(load_pending, session, broadcast_id)
+
+    def build_payload(user_id):
+        payload = {'chat_id': user_id, 'text': message, 'disable_web_page_preview': True}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        return payload
+
+    writer = NotificationWriter(session, broadcast_id, max_rows=RESULT_BATCH_SIZE)
+    stats = await send_all(helper, pending, build_payload, writer, _classify,
+                           concurrency or NOTIFY_CONCURRENCY, f"live notification {broadcast_id}")
+    stats['unreachable'] = stats.pop('gone')
+    return stats
+
+
+def event_age(payload, now=None):
+    """Seconds since the go-live in a notify_live payload (0 if unknown)."""
+    try:
+        at = datetime.fromisoformat(payload['at'])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+    return ((now or datetime.now(timezone.utc)) - at).total_seconds()
@@ -0,0 +1,118 @@
+# worker/live_sessions.py
+#
+# Live broadcast history (add_live_sessions.sql). Every checker cycle upserts one
+# live_sessions row per live broadcast_id, appending the viewer count to the row's
+# sample series, and closes the sessions that are no longer live. The cycle's
+# broadcasts go in one multi-row statement.
+
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Samples kept per broadcast (~24h at the checker's 2-4 minute cycle); later checks only
+# update viewer_count/peak_viewers
+MAX_SAMPLES = 720
+
+RECORD_SAMPLES = text("""
+    WITH seen AS (
+        SELECT DISTINCT ON (broadcast_id) broadcast_id, username, title, viewers
+        FROM unnest(CAST(:broadcast_ids AS TEXT[]), CAST(:usernames AS TEXT[]),
+                    CAST(:titles AS TEXT[]), CAST(:viewers AS INTEGER[]))
+             AS s(broadcast_id, username, title, viewers)
+    ),
+    upserted AS (
+        INSERT INTO live_sessions AS l (broadcast_id, username, title, started_at, last_seen_at,
+                                        viewer_count, peak_viewers, sample_count,
+                                        sample_offsets, viewer_samples)
+        SELECT broadcast_id, username, NULLIF(title, ''), :now, :now,
+               viewers, viewers, 1, ARRAY[0], ARRAY[viewers]
+        FROM seen
+        ON CONFLICT (broadcast_id) DO UPDATE
+        SET last_seen_at = EXCLUDED.last_seen_at,
+            ended_at = NULL,
+            title = COALESCE(EXCLUDED.title, l.title),
+            viewer_count = EXCLUDED.viewer_count,
+            peak_viewers = GREATEST(l.peak_viewers, EXCLUDED.viewer_count),
+            sample_count = l.sample_count + 1,
+            sample_offsets = CASE WHEN cardinality(l.sample_offsets) < :max_samples
+                                  THEN l.sample_offsets
+                                       || CAST(EXTRACT(EPOCH FROM EXCLUDED.last_seen_at - l.started_at) AS INTEGER)
+                                  ELSE l.sample_offsets END,
+            viewer_samples = CASE WHEN cardinality(l.viewer_samples) < :max_samples
+                                  THEN l.viewer_samples || EXCLUDED.viewer_count
+                                  ELSE l.viewer_samples END
+        RETURNING (xmax = 0) AS opened
+    ),
+    closed AS (
+        UPDATE live_sessions
+        SET ended_at = last_seen_at
+        WHERE ended_at IS NULL
+          AND broadcast_id <> ALL(CAST(:broadcast_ids AS TEXT[]))
+        RETURNING broadcast_id
+    )
+    SELECT (SELECT COUNT(*) FILTER (WHERE opened) FROM upserted) AS opened,
+           (SELECT COUNT(*) FROM upserted) AS sampled,
+           (SELECT COUNT(*) FROM closed) AS closed
+""")
+
+
+def record_live_samples(session, live_users, now=None):
+    """
+    Append this cycle's viewer counts to live_sessions and close ended
+    broadcasts. Users without a broadcast_id are skipped. The caller commits.
+
+    Returns:
+        Dict with opened, sampled and closed session counts
+    """
+    broadcasts = [user for user in live_users if user.get('broadcast_id')]
+    row = session.execute(RECORD_SAMPLES, {
+        'broadcast_ids': [str(user['broadcast_id']) for user in broadcasts],
+        'usernames': [user['username'].lstrip('@') for user in broadcasts],
+        'titles': [user.get('title') or '' for user in broadcasts],
+        'viewers': [int(user.get('viewer_count') or 0) for user in broadcasts],
+        'now': now or datetime.now(timezone.utc),
+        'max_samples': MAX_SAMPLES,
+    }).fetchone()
+    return dict(row._mapping)
+
+
+def get_live_sessions(session, limit=50):
+    """Currently live broadcasts, most viewers first."""
+    rows = session.execute(text("""
+        SELECT broadcast_id, username, title, started_at, viewer_count, peak_viewers
+        FROM live_sessions
+        WHERE ended_at IS NULL
+        ORDER BY viewer_count DESC
+        LIMIT :limit
+    """), {'limit': limit}).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def get_user_live_history(session, username, limit=20):
+    """A user's most recent broadcasts with duration, peak and average viewers."""
+    rows = session.execute(text("""
+        SELECT broadcast_id, title, started_at, ended_at,
+               COALESCE(ended_at, last_seen_at) - started_at AS duration,
+               peak_viewers,
+               (SELECT ROUND(AVG(v)) FROM unnest(viewer_samples) AS v) AS avg_viewers
+        FROM live_sessions
+        WHERE username = :username
+        ORDER BY started_at DESC
+        LIMIT :limit
+    """), {'username': username.lstrip('@'), 'limit': limit}).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def get_top_live_sessions(session, since=None, limit=20):
+    """Broadcasts with the highest peak viewers, optionally started after `since`."""
+    rows = session.execute(text("""
+        SELECT broadcast_id, username, title, started_at, ended_at, peak_viewers
+        FROM live_sessions
+        WHERE CAST(:since AS TIMESTAMPTZ) IS NULL OR started_at >= :since
+        ORDER BY peak_viewers DESC, started_at DESC
+        LIMIT :limit
+    """), {'since': since, 'limit': limit}).fetchall()
+    return [dict(row._mapping) for row in rows]
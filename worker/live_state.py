@@ -0,0 +1,189 @@
+# worker/live_state.py
+#
+# Diff-based live status for insta_links. The tracker keeps the previous cycle's
+# set of live usernames in memory (rebuilt from the database on startup and every
+# RESYNC_SECONDS), computes went-live / still-live / ended each cycle and writes
+# only the transitions. Still-live rows are not touched; the checker's heartbeat
+# row (add_live_heartbeat.sql) is what freshness checks look at instead.
+# Transitions are emitted as structured events to subscribers. Viewer counts go to
+# live_sessions (live_sessions.py) in the same transaction. With a CheckerLease
+# (checker_lease.py) a cycle only writes while holding the lease, and the heartbeat
+# records the cycle's fencing number.
+
+import os
+import json
+import time
+import socket
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from live_sessions import record_live_samples
+
+logger = logging.getLogger(__name__)
+
+# Name of this checker's heartbeat row
+CHECKER_NAME = os.environ.get('IG_CHECKER_NAME') or socket.gethostname()
+# The snapshot is re-read from insta_links this often, picking up changes made elsewhere
+# (auto-expire, manual edits, another checker)
+RESYNC_SECONDS = 900
+
+WENT_LIVE = 'went_live'
+ENDED = 'ended'
+
+# One round trip per cycle, applying the current live set as a set (the upsert of
+# user-041's checker, now transition-only). Went-live and still-live usernames are both
+# upserted, but the conflict branch only writes rows that are not live already, so
+# still-live rows produce no tuple, no trigger and no WAL unless the database drifted
+# from the snapshot. Every live row outside the set is turned off, which covers the
+# snapshot's ended users and any row marked live elsewhere since the last resync.
+# Needs add_insta_links_username_unique.sql, add_live_heartbeat.sql and add_checker_lease.sql.
+APPLY_TRANSITIONS = text("""
+    WITH went_live AS (
+        INSERT INTO insta_links (username, is_live, last_live_at, total_lives, last_updated, link)
+        SELECT username, TRUE, :now, 1, :now, 'https://instagram.com/' || username
+        FROM unnest(CAST(:live AS TEXT[])) AS u(username)
+        ON CONFLICT (username) DO UPDATE
+        SET is_live = TRUE,
+            last_live_at = EXCLUDED.last_live_at,
+            total_lives = COALESCE(insta_links.total_lives, 0) + 1,
+            last_updated = EXCLUDED.last_updated
+        WHERE insta_links.is_live IS NOT TRUE
+        RETURNING username, (xmax = 0) AS inserted
+    ),
+    ended AS (
+        UPDATE insta_links
+        SET is_live = FALSE,
+            last_updated = :now
+        WHERE is_live = TRUE
+          AND username <> ALL(CAST(:live AS TEXT[]))
+        RETURNING username
+    ),
+    heartbeat AS (
+        INSERT INTO live_checker_heartbeat (checker, checked_at, live_count, fence)
+        VALUES (:checker, :now, :live_count, :fence)
+        ON CONFLICT (checker) DO UPDATE
+        SET checked_at = EXCLUDED.checked_at,
+            live_count = EXCLUDED.live_count,
+            fence = EXCLUDED.fence
+    )
+    SELECT 'went_live' AS change, username, inserted FROM went_live
+    UNION ALL
+    SELECT 'ended', username, FALSE FROM ended
+""")
+
+
+class LiveStateTracker:
+    """
+    In-memory live snapshot for one checker process.
+
+    Subscribers are called with each transition event, a dict:
+        {'event': 'went_live' | 'ended', 'username': ..., 'at': ISO timestamp,
+         'viewer_count': int or None, 'new_user': bool,
+         'broadcast_id': str or None, 'title': str or None}
+    A failing subscriber is logged and does not affect the others.
+    """
+
+    def __init__(self, checker=None, resync_seconds=RESYNC_SECONDS, record_sessions=True, lease=None):
+        self.checker = checker or CHECKER_NAME
+        self.lease = lease
+        self.resync_seconds = resync_seconds
+        self.record_sessions = record_sessions
+        self.live = set()
+        self.synced_at = None
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Register callback(event) for transition events."""
+        self._subscribers.append(callback)
+        return callback
+
+    def load(self, session):
+        """Rebuild the snapshot from the database."""
+        rows = session.execute(text("SELECT username FROM insta_links WHERE is_live = TRUE")).fetchall()
+        self.live = {row.username for row in rows if row.username}
+        self.synced_at = time.monotonic()
+        logger.info(f"Live snapshot loaded: {len(self.live)} user(s) live")
+
+    def apply(self, session, live_users, now=None):
+        """
+        Diff the current live users against the snapshot, write the transitions,
+        the heartbeat and the live_sessions samples, commit and emit events.
+
+        Returns:
+            Dict with the went_live, still_live and ended username lists, the
+            live_sessions counts (or None when not recorded) and the fencing
+            number; None when another checker holds the lease (nothing written)
+        """
+        now = now or datetime.now(timezone.utc)
+        fence = None
+        if self.lease:
+            was_leader = self.lease.held
+            fence = self.lease.claim(session)
+            if fence is None:
+                session.rollback()
+                self.synced_at = None
+                return None
+            if not was_leader:
+                # Another checker may have written since our snapshot
+                self.synced_at = None
+
+        if self.synced_at is None or time.monotonic() - self.synced_at >= self.resync_seconds:
+            self.load(session)
+
+        by_username = {user['username'].lstrip('@'): user for user in live_users}
+        current = set(by_username)
+        went_live = current - self.live
+        still_live = current & self.live
+        ended = self.live - current
+
+        rows = session.execute(APPLY_TRANSITIONS, {
+            'live': sorted(current),
+            'checker': self.checker,
+            'now': now,
+            'live_count': len(current),
+            'fence': fence,
+        }).fetchall()
+        sessions = record_live_samples(session, live_users, now) if self.record_sessions else None
+        session.commit()
+        self.live = current
+
+        # What the database actually changed: went_live also holds still-live rows that had
+        # drifted offline (e.g. auto-expired while the checker was down)
+        changed_live = {row.username: row.inserted for row in rows if row.change == WENT_LIVE}
+        resynced = still_live & set(changed_live)
+        if resynced:
+            logger.info(f"Re-marked {len(resynced)} still-live user(s) that were offline in the database")
+        stray = {row.username for row in rows if row.change == ENDED} - ended
+        if stray:
+            logger.info(f"Turned off {len(stray)} user(s) that were live only in the database: "
+                        f"{', '.join(sorted(stray))}")
+
+        at = now.isoformat()
+        events = [
+            {'event': WENT_LIVE, 'username': username, 'at': at,
+             'viewer_count': by_username[username].get('viewer_count'),
+             'new_user': changed_live.get(username, False),
+             'broadcast_id': by_username[username].get('broadcast_id') or None,
+             'title': by_username[username].get('title') or None}
+            for username in sorted(went_live)
+        ] + [
+            {'event': ENDED, 'username': username, 'at': at, 'viewer_count': None, 'new_user': False,
+             'broadcast_id': None, 'title': None}
+            for username in sorted(ended)
+        ]
+        for event in events:
+            self._emit(event)
+
+        return {'went_live': sorted(went_live), 'still_live': sorted(still_live), 'ended': sorted(ended),
+                'sessions': sessions, 'fence': fence}
+
+    def _emit(self, event):
+        logger.info(f"live_event {json.dumps(event)}")
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Live event subscriber {getattr(callback, '__name__', callback)} failed: {e}",
+                             exc_info=True)
@@ -10,12 +10,17 @@ from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 
+from circuit_breaker import CircuitOpenError, get_breaker, write_breaker_health
+from telegram_metrics import telegram_metrics
 from handlers import (
     start_handler,
     my_account_handler,
     check_live_handler,
     join_request_handler,
     broadcast_message_handler,
+    notify_live_handler,
+    watch_handler,
+    unwatch_handler,
     init_handler,
     activate_handler,
     back_handler,
@@ -31,6 +36,10 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 POLLING_INTERVAL = 2 # seconds
+MAX_DEFER_SECONDS = 300  # cap for backoff of jobs deferred by an open circuit
+# Long-running sends to many chats; processed by their own loop so they never hold up
+# the interactive updates (/start, buttons, join requests) queued behind them
+FANOUT_JOB_TYPES = ('broadcast_message', 'notify_live')
 
 async def process_job(job, session_factory):
     """
@@ -58,6 +67,10 @@ async def process_job(job, session_factory):
 
     try:
         if job_type == 'process_telegram_update':
+            # Don't start a handler (and e.g. charge points) while Telegram is known to be down
+            if os.environ.get('BOT_TOKEN'):
+                get_breaker(f"telegram:{os.environ['BOT_TOKEN'].split(':')[0]}").raise_if_open()
+
             if 'message' in payload:
                 text = payload['message'].get('text', '').strip()
                 if text.startswith('/start'):
@@ -66,6 +79,10 @@ async def process_job(job, session_factory):
                     await init_handler(session, payload)
                 elif text.startswith('/activate'):
                     await activate_handler(session, payload)
+                elif text.startswith('/watch'):
+                    await watch_handler(session, payload)
+                elif text.startswith('/unwatch'):
+                    await unwatch_handler(session, payload)
             elif 'callback_query' in payload:
                 callback_data = payload['callback_query'].get('data')
                 if callback_data == 'my_account':
@@ -92,22 +109,50 @@ async def process_job(job, session_factory):
                 logger.info(f"No handler for this update type.")
         
         elif job_type == 'broadcast_message':
-            await broadcast_message_handler(session, payload)
+            # False leaves the job pending; the retry resumes with the groups not yet done
+            return await broadcast_message_handler(session, payload, job_id=job_id)
+
+        elif job_type == 'notify_live':
+            # False leaves the job pending; the retry resumes with the watchers not yet notified
+            return await notify_live_handler(session, payload, job_id=job_id)
 
         else:
             logger.warning(f"Unknown job_type: {job_type}")
 
         return True
+    except CircuitOpenError:
+        # Let the main loop defer the job without consuming a retry
+        raise
     except Exception as e:
         logger.error(f"A handler raised an exception for job {job_id}: {e}", exc_info=True)
         return False # Explicitly return False on error
     finally:
         session.close()
 
-async def worker_main_loop(session_factory, run_once=False):
+def defer_job(session, job, error: CircuitOpenError):
+    """
+    Put a job back in the queue without consuming a retry, hidden until the
+    circuit is expected to close. Repeated deferrals back off exponentially.
+    """
+    deferrals = job.get('deferrals') or 0
+    delay = min(MAX_DEFER_SECONDS, max(error.retry_after, POLLING_INTERVAL) * (2 ** deferrals))
+    session.execute(text("""
+        UPDATE jobs
+        SET status = 'pending',
+            deferrals = COALESCE(deferrals, 0) + 1,
+            run_after = NOW() + make_interval(secs => :delay),
+            updated_at = :now
+        WHERE job_id = :job_id
+    """), {'delay': delay, 'now': datetime.now(timezone.utc), 'job_id': job['job_id']})
+    session.commit()
+    logger.warning(f"Job {job['job_id']} deferred {delay:.0f}s: {error}")
+
+
+async def worker_main_loop(session_factory, run_once=False, job_types=None, exclude_job_types=()):
     """
     The main loop for the worker.
-    - Fetches a pending job from the database.
+    - Fetches a pending job from the database (only `job_types` if given,
+      never `exclude_job_types`).
     - Marks it as 'processing'.
     - Calls process_job to handle it.
     - Updates the job status based on the result.
@@ -122,11 +167,18 @@ async def worker_main_loop(session_factory, run_once=False):
                 SELECT * FROM jobs
                 WHERE status = 'pending' 
                   AND bot_token = :bot_token
+                  AND (run_after IS NULL OR run_after <= NOW())
+                  AND (CAST(:job_types AS TEXT[]) IS NULL OR job_type = ANY(CAST(:job_types AS TEXT[])))
+                  AND job_type <> ALL(CAST(:exclude_job_types AS TEXT[]))
                 ORDER BY created_at
                 LIMIT 1
                 FOR UPDATE SKIP LOCKED
             """)
-            result = session.execute(select_query, {'bot_token': os.environ.get('BOT_TOKEN')}).fetchone()
+            result = session.execute(select_query, {
+                'bot_token': os.environ.get('BOT_TOKEN'),
+                'job_types': list(job_types) if job_types else None,
+                'exclude_job_types': list(exclude_job_types),
+            }).fetchone()
 
             if result:
                 job_to_process = dict(result._mapping)
@@ -141,7 +193,12 @@ async def worker_main_loop(session_factory, run_once=False):
 
             # --- 2. Process the Job ---
             if job_to_process:
-                success = await process_job(job_to_process, session_factory)
+                try:
+                    success = await process_job(job_to_process, session_factory)
+                except CircuitOpenError as e:
+                    defer_job(session, job_to_process, e)
+                    write_breaker_health(session, force=True)
+                    continue
                 
                 # --- 3. Update Job Status ---
                 retries = job_to_process.get('retries', 0)
@@ -167,6 +224,9 @@ async def worker_main_loop(session_factory, run_once=False):
                 session.commit()
                 logger.info(f"Job {job_to_process['job_id']} finished with status: {final_status}")
                 
+                write_breaker_health(session)
+                telegram_metrics.flush(session, force=run_once)
+
                 if run_once:
                     logger.info("run_once is True, exiting after processing one job.")
                     break
@@ -180,6 +240,7 @@ async def worker_main_loop(session_factory, run_once=False):
                     await asyncio.sleep(1) # Wait a bit for the transaction to commit
                     continue
 
+                telegram_metrics.flush(session)
                 await asyncio.sleep(POLLING_INTERVAL)
 
         except Exception as e:
@@ -191,6 +252,14 @@ async def worker_main_loop(session_factory, run_once=False):
             session.close()
 
 
+async def run_worker(session_factory):
+    """Interactive updates and fan-out jobs on separate loops, so a long fan-out never blocks the bot."""
+    await asyncio.gather(
+        worker_main_loop(session_factory, exclude_job_types=FANOUT_JOB_TYPES),
+        worker_main_loop(session_factory, job_types=FANOUT_JOB_TYPES),
+    )
+
+
 def main(run_once=False, engine=None):
     # If no engine is passed, create one (for standalone execution)
     if engine is None:
@@ -222,7 +291,10 @@ def main(run_once=False, engine=None):
     
     # Run worker (handles Telegram bot only)
     try:
-        asyncio.run(worker_main_loop(SessionFactory, run_once=run_once))
+        if run_once:
+            asyncio.run(worker_main_loop(SessionFactory, run_once=True))
+        else:
+            asyncio.run(run_worker(SessionFactory))
     except KeyboardInterrupt:
         logger.info("Worker process stopped by user.")
 
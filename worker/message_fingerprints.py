@@ -0,0 +1,98 @@
+# worker/message_fingerprints.py
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Optional persistence so multiple worker replicas share fingerprints.
+# Requires add_message_fingerprints.sql to be applied.
+FINGERPRINT_DB_ENABLED = os.environ.get('MESSAGE_FINGERPRINT_DB', 'false').lower() in ('1', 'true', 'yes')
+FINGERPRINT_CACHE_SIZE = int(os.environ.get('MESSAGE_FINGERPRINT_CACHE_SIZE', '10000'))
+
+
+def render_fingerprint(text_value: str, reply_markup: dict = None, parse_mode: str = None) -> str:
+    """Hash of everything Telegram compares when deciding if an edit is a no-op."""
+    digest = hashlib.sha1()
+    digest.update((parse_mode or '').encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update((text_value or '').encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(json.dumps(reply_markup, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """
+    Remembers the last rendered (text, markup) hash per (chat_id, message_id).
+    In-process LRU, optionally backed by the message_fingerprints table.
+    """
+
+    def __init__(self, capacity: int = FINGERPRINT_CACHE_SIZE, use_db: bool = FINGERPRINT_DB_ENABLED):
+        self.capacity = capacity
+        self.use_db = use_db
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, message_id, session=None):
+        key = (str(chat_id), int(message_id))
+        with self._lock:
+            fingerprint = self._entries.get(key)
+            if fingerprint is not None:
+                self._entries.move_to_end(key)
+                return fingerprint
+
+        if self.use_db and session is not None:
+            try:
+                row = session.execute(text("""
+                    SELECT fingerprint FROM message_fingerprints
+                    WHERE chat_id = :chat_id AND message_id = :message_id
+                """), {'chat_id': int(chat_id), 'message_id': int(message_id)}).fetchone()
+                if row:
+                    self._put(key, row[0])
+                    return row[0]
+            except Exception as e:
+                logger.warning(f"Could not read message fingerprint for {chat_id}/{message_id}: {e}")
+                session.rollback()
+        return None
+
+    def remember(self, chat_id, message_id, fingerprint: str, session=None):
+        key = (str(chat_id), int(message_id))
+        self._put(key, fingerprint)
+
+        if self.use_db and session is not None:
+            try:
+                session.execute(text("""
+                    INSERT INTO message_fingerprints (chat_id, message_id, fingerprint, updated_at)
+                    VALUES (:chat_id, :message_id, :fingerprint, :now)
+                    ON CONFLICT (chat_id, message_id) DO UPDATE SET
+                        fingerprint = EXCLUDED.fingerprint,
+                        updated_at = EXCLUDED.updated_at
+                """), {
+                    'chat_id': int(chat_id),
+                    'message_id': int(message_id),
+                    'fingerprint': fingerprint,
+                    'now': datetime.now(timezone.utc),
+                })
+                session.commit()
+            except Exception as e:
+                logger.warning(f"Could not store message fingerprint for {chat_id}/{message_id}: {e}")
+                session.rollback()
+
+    def _put(self, key, fingerprint):
+        with self._lock:
+            self._entries[key] = fingerprint
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+
+# Shared store for the worker process
+fingerprint_store = FingerprintStore()
@@ -0,0 +1,239 @@
+# worker/message_template.py
+#
+# Per-group message templates for broadcasts. A template such as
+# "Hello *{title}*, {member_count:,} members!" is parsed and validated once per
+# broadcast (placeholders, Markdown/HTML balance, Telegram's length limits) and
+# then rendered per target from the group's pre-fetched columns, with every
+# value escaped for the parse mode so a group title can never break the markup.
+# Legacy Markdown ignores escapes inside an entity, so a value inside one (the
+# *{title}* above) is rendered verbatim minus the character that would close it.
+
+import string
+from html import escape as html_escape
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+# Placeholders and the widest value each renders to, used by the up-front length check
+FIELDS = {
+    "title": 128,          # Telegram caps chat titles at 128 characters
+    "member_count": 11,    # with thousands separators
+    "group_id": 20,
+    "debug_code": 10,
+}
+DEBUG_CODE_SUFFIX = "\n\n{debug_code}"
+
+MARKDOWN_SPECIAL = "_*`["
+MARKDOWN_V2_SPECIAL = "_*[]()~`>#+-=|{}.!\\"
+_ESCAPES = {
+    "Markdown": str.maketrans({c: "\\" + c for c in MARKDOWN_SPECIAL}),
+    "MarkdownV2": str.maketrans({c: "\\" + c for c in MARKDOWN_V2_SPECIAL}),
+}
+# Stand-in for a placeholder while the markup is checked
+SLOT = "\x00"
+# Legacy Markdown has no escapes inside an entity: a value placed there is shown
+# verbatim, minus the character that would end the entity
+_ENTITY_ENDS = {"*": "*", "_": "_", "`": "`", "```": "`", "[": "]", "(": ")"}
+HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+             "span", "tg-spoiler", "tg-emoji", "blockquote"}
+
+
+class TemplateError(ValueError):
+    """Template that cannot be sent as-is (unknown placeholder, broken markup, too long)."""
+
+
+def escape(value: str, parse_mode: Optional[str]) -> str:
+    """Escape a value for literal display under `parse_mode`"""
+    if parse_mode == "HTML":
+        return html_escape(value, quote=False)
+    table = _ESCAPES.get(parse_mode)
+    return value.translate(table) if table else value
+
+
+def _check_markdown(text: str, v2: bool = False) -> List[Optional[str]]:
+    """
+    Raise TemplateError for entities Telegram would fail to parse. Returns the
+    entity open at each SLOT in `text`: None outside entities, else its marker
+    ('[' in link text, '(' in a link URL).
+    """
+    contexts: List[Optional[str]] = []
+    open_marker = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == SLOT:
+            contexts.append(open_marker)
+            i += 1
+            continue
+        if open_marker in ("`", "```"):
+            if text.startswith(open_marker, i):
+                i += len(open_marker)
+                open_marker = None
+            else:
+                i += 2 if c == "\\" and v2 else 1
+            continue
+        if c == "\\":
+            # An escaped placeholder still sits in the current entity
+            contexts.extend([open_marker] * text.count(SLOT, i, i + 2))
+            i += 2
+            continue
+        if c == "`":
+            open_marker = "```" if text.startswith("```", i) else "`"
+            i += len(open_marker)
+            continue
+        if v2 and text.startswith("||", i):
+            open_marker = None if open_marker == "||" else open_marker or "||"
+            i += 2
+            continue
+        if c in ("*", "_") or (v2 and c == "~"):
+            if open_marker == c:
+                open_marker = None
+            elif open_marker is None:
+                open_marker = c
+            elif not v2:
+                raise TemplateError(f"Markdown entities cannot be nested ('{c}' inside '{open_marker}')")
+            i += 1
+            continue
+        if c == "[":
+            end = text.find("]", i)
+            if end < 0:
+                raise TemplateError(f"Unclosed '[' at position {i}")
+            contexts.extend(["["] * text.count(SLOT, i, end))
+            if text.startswith("(", end + 1):
+                close = text.find(")", end)
+                if close < 0:
+                    raise TemplateError(f"Unclosed link URL at position {end + 1}")
+                contexts.extend(["("] * text.count(SLOT, end, close))
+                i = close + 1
+            else:
+                i = end + 1
+            continue
+        if v2 and c in MARKDOWN_V2_SPECIAL:
+            raise TemplateError(f"'{c}' at position {i} must be escaped in MarkdownV2")
+        i += 1
+    if open_marker is not None:
+        raise TemplateError(f"Unclosed Markdown entity '{open_marker}'")
+    return contexts
+
+
+class _TagChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in HTML_TAGS:
+            raise TemplateError(f"Unsupported HTML tag <{tag}>")
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            raise TemplateError(f"Unbalanced HTML closing tag </{tag}>")
+        self.stack.pop()
+
+
+def _check_html(text: str):
+    checker = _TagChecker()
+    checker.feed(text)
+    checker.close()
+    if checker.stack:
+        raise TemplateError(f"Unclosed HTML tag <{checker.stack[-1]}>")
+
+
+def _utf16_len(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class MessageTemplate:
+    """
+    A compiled template: literal chunks interleaved with (field, format_spec)
+    slots. render() only formats, escapes and joins.
+    """
+
+    def __init__(self, source: str, parse_mode: Optional[str] = "Markdown", limit: int = TEXT_LIMIT,
+                 debug_code: bool = True):
+        self.source = source or ""
+        self.parse_mode = parse_mode
+        self.limit = limit
+        if debug_code and "{debug_code" not in self.source:
+            # Every broadcast message carries its debug code
+            self.source = self.source + DEBUG_CODE_SUFFIX if self.source else "{debug_code}"
+
+        self._literals: List[str] = []
+        self._slots: List[Tuple[str, str]] = []
+        # Entity each slot renders into (legacy Markdown only); None means escape the value
+        self._entities: List[Optional[str]] = []
+        try:
+            parsed = list(string.Formatter().parse(self.source))
+        except ValueError as e:
+            raise TemplateError(f"Invalid template: {e}") from None
+
+        literal = []
+        for text, field, format_spec, conversion in parsed:
+            literal.append(text)
+            if field is None:
+                continue
+            if field not in FIELDS:
+                raise TemplateError(
+                    f"Unknown placeholder {{{field}}}; available: {', '.join('{' + f + '}' for f in FIELDS)}"
+                )
+            if conversion:
+                raise TemplateError(f"Conversions (!{conversion}) are not supported in {{{field}}}")
+            self._literals.append("".join(literal))
+            self._slots.append((field, format_spec or ""))
+            literal = []
+        self._literals.append("".join(literal))
+        self.fields = sorted({field for field, _ in self._slots})
+        self._validate()
+
+    def _validate(self):
+        # Values are escaped (or stripped of entity ends) when rendered, so neutral
+        # stand-ins are enough to check the markup
+        skeleton = "".join(
+            literal + (SLOT if i < len(self._slots) else "") for i, literal in enumerate(self._literals)
+        )
+        self._entities = [None] * len(self._slots)
+        if self.parse_mode == "Markdown":
+            self._entities = _check_markdown(skeleton)
+        elif self.parse_mode == "MarkdownV2":
+            # MarkdownV2 honours escapes inside entities too
+            _check_markdown(skeleton, v2=True)
+        elif self.parse_mode == "HTML":
+            _check_html(skeleton.replace(SLOT, "x"))
+
+        worst_case = sum(_utf16_len(literal) for literal in self._literals) + sum(
+            FIELDS[field] for field, _ in self._slots
+        )
+        if worst_case > self.limit:
+            raise TemplateError(
+                f"Message can reach {worst_case} characters with the longest placeholder values; "
+                f"Telegram's limit here is {self.limit}"
+            )
+
+    def render(self, values: Dict[str, Any]) -> str:
+        """Render for one target; raises TemplateError if the result exceeds the limit"""
+        parts = [self._literals[0]]
+        for (field, spec), entity, literal in zip(self._slots, self._entities, self._literals[1:]):
+            value = values.get(field)
+            if value is None:
+                value = ""
+            elif spec:
+                value = format(value, spec)
+            if entity is None:
+                parts.append(escape(str(value), self.parse_mode))
+            else:
+                parts.append(str(value).replace(_ENTITY_ENDS[entity], ""))
+            parts.append(literal)
+        rendered = "".join(parts)
+        if len(rendered) > self.limit and _utf16_len(rendered) > self.limit:
+            raise TemplateError(f"Rendered message is {_utf16_len(rendered)} characters (limit {self.limit})")
+        return rendered
+
+
+def compile_template(source: str, parse_mode: Optional[str] = "Markdown", limit: int = TEXT_LIMIT,
+                     debug_code: bool = True) -> MessageTemplate:
+    """Compile and validate a broadcast template once, before any target is rendered"""
+    return MessageTemplate(source, parse_mode, limit, debug_code)
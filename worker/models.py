@@ -32,7 +32,7 @@ class InstaLink(Base):
     chat_id = Column(Text)
     link = Column(Text)
     timestamp = Column(DateTime, default=datetime.now)
-    username = Column(Text)
+    username = Column(Text, unique=True)
     general_link = Column(Text)
     is_live = Column(Boolean, default=False)
     last_live_at = Column(DateTime)
@@ -0,0 +1,161 @@
+# worker/poll_schedule.py
+#
+# History-driven poll intervals for the live checker. Go-live and end counts per
+# (weekday, UTC hour) are learned from live_sessions (add_live_sessions.sql) over
+# the last HISTORY_DAYS. Each account's daily request budget (IG_POLL_BUDGET) is
+# then spread over the day's hours in proportion to the square root of the
+# expected transition rate: with polls every T seconds an event waits T/2 on
+# average, and sqrt allocation minimises the total wait for a fixed number of
+# polls. Intervals stay within the IG_MIN_INTERVAL..IG_MAX_INTERVAL safety bounds
+# and keep their random jitter. Without history the schedule is the old uniform
+# MIN..MAX draw. simulate_poll_schedule.py replays history against a budget.
+
+import os
+import math
+import time
+import random
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = int(os.environ.get('IG_MIN_INTERVAL', '120'))
+MAX_INTERVAL = int(os.environ.get('IG_MAX_INTERVAL', '240'))
+# Polls per account per day; the default matches the uniform 120-240s average
+POLL_BUDGET = int(os.environ.get('IG_POLL_BUDGET', str(86400 * 2 // (MIN_INTERVAL + MAX_INTERVAL))))
+# +/- fraction of the hour's interval
+JITTER = 0.15
+HISTORY_DAYS = 28
+# Weekday-hour counts are shrunk toward the hour-of-day average with this many weeks' weight
+PRIOR_WEEKS = 2.0
+REFRESH_SECONDS = 6 * 3600
+
+
+def uniform_interval():
+    """The schedule without history: uniform between the safety bounds."""
+    return random.randint(MIN_INTERVAL, MAX_INTERVAL)
+
+
+def transition_counts(session, days=HISTORY_DAYS):
+    """Go-live plus end events per (ISO weekday 1-7, UTC hour) from live_sessions."""
+    rows = session.execute(text("""
+        SELECT CAST(EXTRACT(ISODOW FROM at AT TIME ZONE 'UTC') AS INTEGER) AS dow,
+               CAST(EXTRACT(HOUR FROM at AT TIME ZONE 'UTC') AS INTEGER) AS hour,
+               COUNT(*) AS events
+        FROM (
+            SELECT started_at AS at FROM live_sessions
+            WHERE started_at >= NOW() - make_interval(days => :days)
+            UNION ALL
+            SELECT ended_at FROM live_sessions
+            WHERE ended_at >= NOW() - make_interval(days => :days)
+        ) transitions
+        GROUP BY 1, 2
+    """), {'days': days}).fetchall()
+    return {(row.dow, row.hour): row.events for row in rows}
+
+
+def expected_rates(counts, days=HISTORY_DAYS, prior_weeks=PRIOR_WEEKS):
+    """
+    Expected transitions per hour for each (weekday, hour), from event counts
+    over `days`. Sparse weekday-hour buckets borrow from the same hour on
+    other days.
+    """
+    weeks = max(days / 7.0, 1e-9)
+    by_hour = [sum(counts.get((dow, hour), 0) for dow in range(1, 8)) for hour in range(24)]
+    return {
+        (dow, hour): (counts.get((dow, hour), 0) + prior_weeks * by_hour[hour] / (7 * weeks)) / (weeks + prior_weeks)
+        for dow in range(1, 8)
+        for hour in range(24)
+    }
+
+
+def allocate_intervals(hourly_rates, budget=POLL_BUDGET, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    """
+    Poll interval (seconds) for each of 24 hours so that about `budget` polls
+    are spent over the day, proportional to sqrt(rate) and clamped to the
+    bounds. Hours pinned at a bound are fixed and the rest of the budget is
+    re-spread over the others.
+    """
+    weights = [math.sqrt(max(rate, 0.0)) for rate in hourly_rates]
+    polls = [None] * 24  # per hour
+    lo, hi = 3600.0 / max_interval, 3600.0 / min_interval
+    while True:
+        free = [h for h in range(24) if polls[h] is None]
+        remaining = budget - sum(p for p in polls if p is not None)
+        total_weight = sum(weights[h] for h in free)
+        if not free:
+            break
+        if total_weight <= 0:
+            share = {h: remaining / len(free) for h in free}
+        else:
+            share = {h: remaining * weights[h] / total_weight for h in free}
+        pinned = False
+        for h in free:
+            if share[h] < lo:
+                polls[h], pinned = lo, True
+            elif share[h] > hi:
+                polls[h], pinned = hi, True
+        if not pinned:
+            for h in free:
+                polls[h] = share[h]
+            break
+    return [min(max_interval, max(min_interval, 3600.0 / p)) for p in polls]
+
+
+class AdaptiveSchedule:
+    """Per-hour poll intervals for the current weekday, refreshed from history."""
+
+    def __init__(self, budget=POLL_BUDGET, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 jitter=JITTER):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.intervals = None  # {weekday: [24 intervals]}
+        self.refreshed_at = None
+
+    def stale(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= REFRESH_SECONDS
+
+    def refresh(self, session):
+        """Re-learn rates from live_sessions; keeps the previous schedule if that fails."""
+        self.refreshed_at = time.monotonic()
+        try:
+            counts = transition_counts(session)
+        except Exception as e:
+            session.rollback()
+            logger.warning(f"Could not load live history for the poll schedule: {e}")
+            return
+        if not counts:
+            self.intervals = None
+            logger.info("No live history yet; polling uniformly")
+            return
+        self.set_rates(expected_rates(counts))
+
+    def set_rates(self, rates):
+        """Build the weekly schedule from {(weekday, hour): rate}."""
+        self.intervals = {
+            dow: allocate_intervals([rates[(dow, hour)] for hour in range(24)], self.budget,
+                                    self.min_interval, self.max_interval)
+            for dow in range(1, 8)
+        }
+        today = self.intervals[datetime.now(timezone.utc).isoweekday()]
+        logger.info(
+            f"Poll schedule updated: {self.budget} polls/day, intervals {min(today):.0f}-{max(today):.0f}s today"
+        )
+
+    def base_interval(self, now=None):
+        now = now or datetime.now(timezone.utc)
+        if self.intervals is None:
+            return None
+        return self.intervals[now.isoweekday()][now.hour]
+
+    def next_interval(self, now=None):
+        """Seconds until an account's next poll: the hour's interval with jitter, within bounds."""
+        base = self.base_interval(now)
+        if base is None:
+            return uniform_interval()
+        jittered = base * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(self.max_interval, max(self.min_interval, jittered))
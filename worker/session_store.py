@@ -0,0 +1,145 @@
+# worker/session_store.py
+#
+# Encrypted, shared instagrapi sessions (add_instagram_sessions.sql). Settings are
+# serialized to JSON and encrypted with Fernet under IG_SESSION_KEY; a comma-
+# separated list rotates keys (the first encrypts, any of them decrypts). Saves bump
+# a version number, and InstagramService only writes when the settings changed and
+# at most every SAVE_INTERVAL seconds. A fresh login is claimed per account with an
+# expiring refreshing_by row lock, so one process logs in (and answers a challenge)
+# while the others wait for the session it saves.
+#
+# Requires the optional `cryptography` package. Without IG_SESSION_KEY (or without
+# the package) get_session_store returns None and sessions stay in local files.
+#
+# Generate a key:
+#   python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+
+import os
+import json
+import time
+import logging
+
+from sqlalchemy import text
+
+from live_state import CHECKER_NAME
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = os.environ.get('IG_SESSION_KEY')
+# Minimum seconds between saves of an unchanged-account session after successful calls
+SAVE_INTERVAL = int(os.environ.get('IG_SESSION_SAVE_SECONDS', '600'))
+# How often a process waiting on another's login re-reads the session
+REFRESH_POLL_SECONDS = 5
+
+
+class InstagramSessionStore:
+    """Load, save and refresh-lock encrypted sessions keyed by Instagram username."""
+
+    def __init__(self, session_factory, keys=None, holder=None):
+        from cryptography.fernet import Fernet, MultiFernet
+
+        keys = [key.strip() for key in (keys or SESSION_KEY or '').split(',') if key.strip()]
+        if not keys:
+            raise ValueError("IG_SESSION_KEY is not set")
+        self.session_factory = session_factory
+        self.holder = holder or f"{CHECKER_NAME}:{os.getpid()}"
+        self._fernet = MultiFernet([Fernet(key) for key in keys])
+
+    def _execute(self, statement, params):
+        session = self.session_factory()
+        try:
+            result = session.execute(statement, params)
+            row = result.fetchone() if result.returns_rows else None
+            session.commit()
+            return row
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def load(self, username):
+        """
+        Decrypted settings and version for an account, or (None, version)
+        when there is no usable session (missing, or encrypted with an unknown key).
+        """
+        from cryptography.fernet import InvalidToken
+
+        row = self._execute(text("""
+            SELECT settings, version FROM instagram_sessions WHERE username = :username
+        """), {'username': username})
+        if row is None or row.settings is None:
+            return None, row.version if row else 0
+        try:
+            return json.loads(self._fernet.decrypt(bytes(row.settings))), row.version
+        except InvalidToken:
+            logger.error(f"Stored Instagram session for {username} does not decrypt with IG_SESSION_KEY")
+            return None, row.version
+
+    def save(self, username, settings):
+        """Encrypt and store an account's settings; returns the new version."""
+        token = self._fernet.encrypt(json.dumps(settings, default=str).encode())
+        row = self._execute(text("""
+            INSERT INTO instagram_sessions AS s (username, settings, version, updated_at, updated_by)
+            VALUES (:username, :settings, 1, NOW(), :holder)
+            ON CONFLICT (username) DO UPDATE
+            SET settings = EXCLUDED.settings,
+                version = s.version + 1,
+                updated_at = EXCLUDED.updated_at,
+                updated_by = EXCLUDED.updated_by
+            RETURNING version
+        """), {'username': username, 'settings': token, 'holder': self.holder})
+        return row.version
+
+    def claim_refresh(self, username, ttl):
+        """Claim the right to log the account in for `ttl` seconds; False while another process holds it."""
+        row = self._execute(text("""
+            INSERT INTO instagram_sessions AS s (username, refreshing_by, refresh_until)
+            VALUES (:username, :holder, NOW() + make_interval(secs => :ttl))
+            ON CONFLICT (username) DO UPDATE
+            SET refreshing_by = EXCLUDED.refreshing_by,
+                refresh_until = EXCLUDED.refresh_until
+            WHERE s.refreshing_by IS NULL
+               OR s.refreshing_by = EXCLUDED.refreshing_by
+               OR s.refresh_until < NOW()
+            RETURNING username
+        """), {'username': username, 'holder': self.holder, 'ttl': ttl})
+        return row is not None
+
+    def release_refresh(self, username):
+        self._execute(text("""
+            UPDATE instagram_sessions
+            SET refreshing_by = NULL, refresh_until = NULL
+            WHERE username = :username AND refreshing_by = :holder
+        """), {'username': username, 'holder': self.holder})
+
+    def wait_for_refresh(self, username, after_version, timeout):
+        """
+        Block until another process saves a session newer than `after_version`
+        or its login claim ends; returns the new settings or None.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(REFRESH_POLL_SECONDS)
+            settings, version = self.load(username)
+            if settings is not None and version > after_version:
+                return settings
+            row = self._execute(text("""
+                SELECT refreshing_by IS NOT NULL AND refresh_until >= NOW() AS refreshing
+                FROM instagram_sessions WHERE username = :username
+            """), {'username': username})
+            if row is None or not row.refreshing:
+                return None
+        return None
+
+
+def get_session_store(session_factory):
+    """The shared store, or None when IG_SESSION_KEY or cryptography is missing."""
+    if not SESSION_KEY or session_factory is None:
+        return None
+    try:
+        return InstagramSessionStore(session_factory)
+    except ImportError:
+        logger.warning("IG_SESSION_KEY is set but the cryptography package is not installed; "
+                       "Instagram sessions stay in local files")
+        return None
@@ -1,19 +1,115 @@
 # worker/telegram_helper.py
 
 import os
+import time
+import asyncio
 import logging
 import httpx
 
+from circuit_breaker import get_breaker
+from telegram_metrics import telegram_metrics
+from rate_controller import get_rate_controller
+
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# Point at a mock server (see mock_telegram_api.py) for benchmarks and offline runs
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# Short flood waits (429 retry_after) are retried in place; longer ones are returned to the caller
+MAX_RETRIES = 2
+MAX_RETRY_AFTER = 5  # seconds
+
+
+def _retry_after(response):
+    """retry_after from a 429 response, if any."""
+    if response.status_code != 429:
+        return None
+    try:
+        return response.json().get('parameters', {}).get('retry_after', 1)
+    except ValueError:
+        return 1
+
+
+def _error_code(response):
+    """Bot API error_code for a failed call (None on success)."""
+    if response.status_code < 400:
+        return None
+    try:
+        return response.json().get('error_code', response.status_code)
+    except ValueError:
+        return response.status_code
+
 
 class TelegramHelper:
-    def __init__(self, token=None):
+    def __init__(self, token=None, api_url=None):
         self.token = token or BOT_TOKEN
         if not self.token:
             raise ValueError("Telegram Bot Token is not configured.")
-        self.base_url = f"https://api.telegram.org/bot{self.token}"
+        self.api_url = (api_url or TELEGRAM_API_URL).rstrip('/')
+        self.base_url = f"{self.api_url}/bot{self.token}"
+        self.bot_id = self.token.split(':')[0]
+        # One breaker per bot, shared by every helper instance in the process
+        self.breaker = get_breaker(f"telegram:{self.bot_id}")
+        # Adaptive send rate for this bot; every response feeds it and fan-outs pace on it
+        self.rate_controller = get_rate_controller(self.bot_id)
+
+    async def _send(self, client, method, payload=None, http_method='POST'):
+        """
+        Issue a Bot API request through the circuit breaker, retrying short
+        429 flood waits, and record latency/status metrics for the call.
+        Every response also feeds the bot's send rate controller.
+        """
+        retries = 0
+        started = time.perf_counter()
+        while True:
+            self.breaker.before_call()
+            attempt_started = time.perf_counter()
+            try:
+                if http_method == 'GET':
+                    response = await client.get(f"{self.base_url}/{method}")
+                else:
+                    response = await client.post(f"{self.base_url}/{method}", json=payload)
+            except httpx.RequestError as e:
+                self.breaker.record_failure(e)
+                telegram_metrics.observe(self.bot_id, method, time.perf_counter() - started, retries=retries)
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure(f"{method}: HTTP {response.status_code}")
+            else:
+                # 4xx means Telegram is up and rejected this particular call. A 429 is paced
+                # out by retry_after and the rate controller, not a sign that Telegram is down
+                self.breaker.record_success()
+
+            retry_after = _retry_after(response)
+            if retry_after is not None:
+                self.rate_controller.on_throttle(retry_after)
+            elif response.status_code < 500:
+                self.rate_controller.on_success(time.perf_counter() - attempt_started)
+            if retry_after is not None and retry_after <= MAX_RETRY_AFTER and retries < MAX_RETRIES:
+                retries += 1
+                logger.warning(f"{method} rate limited, retrying in {retry_after}s (attempt {retries})")
+                await asyncio.sleep(retry_after)
+                continue
+            break
+
+        telegram_metrics.observe(
+            self.bot_id,
+            method,
+            time.perf_counter() - started,
+            status=response.status_code,
+            error_code=_error_code(response),
+            bytes_sent=len(response.request.content or b''),
+            retries=retries,
+        )
+        return response
+
+    async def request(self, client, method, payload=None):
+        """
+        Instrumented Bot API call on a caller-owned client (fan-outs reuse one
+        pooled client). Returns the raw httpx response; network errors raise.
+        """
+        return await self._send(client, method, payload)
 
     async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
         """Sends a text message asynchronously."""
@@ -25,7 +121,7 @@ class TelegramHelper:
 
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.post(f"{self.base_url}/sendMessage", json=payload)
+                response = await self._send(client, 'sendMessage', payload)
                 response.raise_for_status()
                 logger.info(f"Message sent successfully to {chat_id}")
                 return response.json()
@@ -50,11 +146,15 @@ class TelegramHelper:
 
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.post(f"{self.base_url}/editMessageText", json=payload)
+                response = await self._send(client, 'editMessageText', payload)
                 response.raise_for_status()
                 logger.info(f"Message {message_id} edited successfully in chat {chat_id}")
                 return response.json()
             except httpx.HTTPStatusError as e:
+                if e.response.status_code == 400 and 'message is not modified' in e.response.text:
+                    # Content identical to what's shown; not an error from the user's point of view
+                    logger.info(f"Message {message_id} in chat {chat_id} not modified (identical content)")
+                    return {'ok': False, 'not_modified': True}
                 logger.error(f"Error editing message {message_id} in {chat_id}: {e.response.text}")
                 return None
             except httpx.RequestError as e:
@@ -71,7 +171,7 @@ class TelegramHelper:
 
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.post(f"{self.base_url}/answerCallbackQuery", json=payload)
+                response = await self._send(client, 'answerCallbackQuery', payload)
                 response.raise_for_status()
                 logger.info(f"Callback query {callback_query_id} answered")
                 return response.json()
@@ -87,7 +187,7 @@ class TelegramHelper:
         payload = {'chat_id': chat_id, 'user_id': user_id}
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.post(f"{self.base_url}/approveChatJoinRequest", json=payload)
+                response = await self._send(client, 'approveChatJoinRequest', payload)
                 response.raise_for_status()
                 logger.info(f"Approved join request for user {user_id} in chat {chat_id}.")
                 return response.json()
@@ -103,7 +203,7 @@ class TelegramHelper:
         payload = {'chat_id': chat_id, 'user_id': user_id}
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.post(f"{self.base_url}/getChatMember", json=payload)
+                response = await self._send(client, 'getChatMember', payload)
                 response.raise_for_status()
                 return response.json()
             except httpx.HTTPStatusError as e:
@@ -135,7 +235,7 @@ class TelegramHelper:
         """Gets the bot's own information."""
         async with httpx.AsyncClient(timeout=30.0) as client:
             try:
-                response = await client.get(f"{self.base_url}/getMe")
+                response = await self._send(client, 'getMe', http_method='GET')
                 response.raise_for_status()
                 return response.json()
             except httpx.RequestError as e: